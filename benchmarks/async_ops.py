@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Measure asynchronous operation throughput with many operations in flight.
+
+Run from the top of the source tree::
+
+    python benchmarks/async_ops.py [in_flight] [rounds]
+"""
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ldap  # noqa
+
+from mockldap import LDAPObject, RECORD_COUNTS  # noqa
+
+
+directory = {
+    'o=test': {'objectClass': ['top']},
+    'ou=people,o=test': {'objectClass': ['organizationalUnit']},
+    'uid=alice,ou=people,o=test': {'objectClass': ['person'], 'uid': ['alice'],
+                                   'userPassword': ['alicepw']},
+}
+
+
+def main(in_flight=5000, rounds=5):
+    ldapobj = LDAPObject(directory, recording=RECORD_COUNTS)
+    start = time.time()
+
+    for i in xrange(rounds):
+        msgids = []
+        for n in xrange(in_flight):
+            dn = 'uid=user%d,ou=people,o=test' % (n,)
+            msgids.append(ldapobj.add(dn, [('objectClass', ['person']), ('uid', ['user%d' % (n,)])]))
+            msgids.append(ldapobj.search(dn, ldap.SCOPE_BASE))
+            msgids.append(ldapobj.simple_bind('uid=alice,ou=people,o=test', 'alicepw'))
+            msgids.append(ldapobj.delete(dn))
+
+        for msgid in msgids:
+            ldapobj.result(msgid)
+
+    seconds = time.time() - start
+    operations = rounds * in_flight * 4
+
+    print("%d operations, %d in flight: %.0f operations/s" % (operations, in_flight * 4, operations / seconds))
+    print("outstanding after retrieval: %d" % (len(ldapobj.async_results),))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+"""
+Measure the cost of selecting attributes from wide entries in searches.
+
+Run from the top of the source tree::
+
+    python benchmarks/attrlist.py [entries] [attributes]
+"""
+import os.path
+import sys
+from timeit import Timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ldap  # noqa
+
+from mockldap.ldapobject import LDAPObject  # noqa
+
+
+def build_directory(entries, attributes):
+    directory = {
+        'o=test': {'objectClass': ['top']},
+    }
+
+    for i in xrange(entries):
+        entry = dict(('attr%d' % (j,), ['value %d' % (j,)]) for j in xrange(attributes))
+        entry['objectClass'] = ['top', 'person']
+        entry['uid'] = ['user%d' % (i,)]
+        entry['mail'] = ['user%d@example.com' % (i,)]
+        directory['uid=user%d,o=test' % (i,)] = entry
+
+    return directory
+
+
+def main(entries=2000, attributes=50):
+    ldapobj = LDAPObject(build_directory(entries, attributes))
+
+    assert len(ldapobj._search_s('o=test', ldap.SCOPE_ONELEVEL, '(objectClass=*)', None, 0)) == entries
+
+    for attrlist in [None, ['uid', 'mail'], ['UID', 'Mail'], ['*'], ['1.1']]:
+        search = lambda: ldapobj._search_s('o=test', ldap.SCOPE_ONELEVEL, '(objectClass=*)',
+                                           attrlist, 0)
+        seconds = min(Timer(search).repeat(3, 5))
+        print("attrlist=%-16r %6.2f us/result" % (attrlist, seconds / (5 * entries) * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
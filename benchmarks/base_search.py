@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+Show that base-scope searches take constant time as the directory grows.
+
+Run from the top of the source tree::
+
+    python benchmarks/base_search.py [iterations]
+"""
+import os.path
+import sys
+from timeit import Timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ldap  # noqa
+
+from mockldap import LDAPObject, RECORD_OFF  # noqa
+
+
+def build_directory(entries):
+    directory = {'ou=people,o=test': {'objectClass': ['organizationalUnit']}}
+
+    for i in xrange(entries):
+        directory['uid=user%d,ou=people,o=test' % (i,)] = {
+            'objectClass': ['top', 'person'],
+            'uid': ['user%d' % (i,)],
+        }
+
+    return directory
+
+
+def main(iterations=10000):
+    for entries in [100, 1000, 10000, 100000]:
+        ldapobj = LDAPObject(build_directory(entries), recording=RECORD_OFF)
+        dn = 'uid=user%d,ou=people,o=test' % (entries // 2,)
+        search = lambda: ldapobj.search_s(dn, ldap.SCOPE_BASE, '(objectClass=*)')
+        seconds = min(Timer(search).repeat(3, iterations)) / iterations
+        print("%7d entries %8.2f us/search" % (entries, seconds * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
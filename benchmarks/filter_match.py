@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Compare evaluating parsed filter trees with evaluating compiled filters.
+
+Run from the top of the source tree::
+
+    python benchmarks/filter_match.py [iterations]
+"""
+import os.path
+import sys
+from timeit import Timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mockldap import filter  # noqa
+
+
+entries = [
+    ('uid=alice,ou=people,o=test', {
+        'objectClass': ['top', 'person', 'posixAccount', 'inetOrgPerson'],
+        'uid': ['alice'], 'cn': ['Alice'], 'uidNumber': ['1000'],
+        'mail': ['alice@example.com'], 'memberOf': ['cn=admins,o=test'],
+    }),
+    ('uid=bob,ou=people,o=test', {
+        'objectClass': ['top', 'person', 'posixAccount'],
+        'uid': ['bob'], 'cn': ['Bob'], 'uidNumber': ['1001'],
+        'nsAccountLock': ['TRUE'],
+    }),
+    ('cn=admins,o=test', {
+        'objectClass': ['top', 'groupOfNames'], 'cn': ['admins'],
+        'member': ['uid=alice,ou=people,o=test'],
+    }),
+]
+
+
+# Nested filters of the sort that authorization layers build up.
+corpus = [
+    '(&(objectClass=posixAccount)(uid=alice))',
+    '(&(objectClass=person)(|(uid=alice)(uid=bob)(uid=carol))(!(nsAccountLock=TRUE)))',
+    '(&(objectClass=top)(&(objectClass=person)(&(objectClass=posixAccount)(&(uid=*)(cn=*)))))',
+    '(|(&(objectClass=groupOfNames)(cn=admins))(&(objectClass=person)(memberOf=cn=admins,o=test)'
+    '(!(!(mail=*)))(uidNumber>=1000)(cn=Al*)))',
+    '(&(objectClass=top)(|(cn=a)(cn=b)(cn=c)(cn=d)(cn=e)(cn=f)(cn=g)(cn=h)(cn=Bob)))',
+]
+
+
+def main(iterations=20000):
+    filters = [filter.parse(filterstr) for filterstr in corpus]
+
+    def walk():
+        for filter_expr in filters:
+            for dn, attrs in entries:
+                filter_expr.matches(dn, attrs)
+
+    matchers = [filter_expr.compile() for filter_expr in filters]
+
+    def compiled():
+        for matches in matchers:
+            for dn, attrs in entries:
+                matches(dn, attrs)
+
+    tests = len(corpus) * len(entries) * iterations
+
+    for name, func in [('tree', walk), ('compiled', compiled)]:
+        seconds = min(Timer(func).repeat(3, iterations))
+        print("%-9s %6.2f us/entry" % (name, seconds / tests * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
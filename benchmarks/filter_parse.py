@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Compare the funcparserlib grammar with the native filter parser.
+
+Run from the top of the source tree::
+
+    python benchmarks/filter_parse.py [iterations]
+"""
+import os.path
+import sys
+from timeit import Timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mockldap import filter  # noqa
+
+
+# Filters of the sort that LDAP-backed applications actually send.
+corpus = [
+    '(objectClass=*)',
+    '(uid=alice)',
+    '(&(objectClass=posixAccount)(uid=alice))',
+    '(&(objectClass=groupOfNames)(member=uid=alice,ou=people,o=test))',
+    '(|(mail=alice@example.com)(mailAlternateAddress=alice@example.com))',
+    '(&(objectClass=inetOrgPerson)(!(nsAccountLock=TRUE)))',
+    '(&(|(objectClass=groupOfNames)(objectClass=groupOfUniqueNames))(cn=admins))',
+    '(&(objectClass=posixGroup)(|(memberUid=alice)(gidNumber=1000)))',
+    '(&(objectClass=user)(sAMAccountName=alice)(!(userAccountControl=514)))',
+    '(&(objectClass=top)(|(cn=a)(cn=b)(cn=c)(cn=d)(cn=e)(cn=f)(cn=g)(cn=h)))',
+]
+
+
+def parse_corpus():
+    for filterstr in corpus:
+        filter._parse(filterstr)
+
+
+def main(iterations=2000):
+    results = {}
+
+    for name, native in [('funcparserlib', False), ('native', True)]:
+        if not native and filter.NoParseError is None:
+            print("%-14s not installed" % (name,))
+            continue
+
+        filter.use_native_parser = native
+        seconds = min(Timer(parse_corpus).repeat(3, iterations))
+        results[name] = seconds
+        print("%-14s %8.2f us/filter" % (name, seconds / (iterations * len(corpus)) * 1e6))
+
+    if len(results) == 2:
+        print("speedup        %8.1fx" % (results['funcparserlib'] / results['native'],))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
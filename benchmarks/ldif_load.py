@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+Measure how quickly MockLdap.load_ldif() loads a large LDIF file.
+
+Run from the top of the source tree::
+
+    python benchmarks/ldif_load.py [entries]
+"""
+from cStringIO import StringIO
+import os.path
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mockldap import MockLdap  # noqa
+
+
+def build_ldif(entries):
+    ldif = StringIO()
+    ldif.write("dn: o=test\nobjectClass: top\n\n")
+    ldif.write("dn: ou=people,o=test\nobjectClass: organizationalUnit\n\n")
+
+    for i in xrange(entries):
+        ldif.write("dn: uid=user%d,ou=people,o=test\n" % (i,))
+        ldif.write("objectClass: top\nobjectClass: person\nobjectClass: inetOrgPerson\n")
+        ldif.write("uid: user%d\ncn: User %d\nsn: %d\n" % (i, i, i))
+        ldif.write("mail: user%d@example.com\n\n" % (i,))
+
+    return ldif.getvalue()
+
+
+def main(entries=20000):
+    ldif = build_ldif(entries)
+
+    for indexes in [None, ['uid', 'mail']]:
+        info = MockLdap(indexes=indexes).load_ldif(StringIO(ldif))
+        print("indexes=%-15r %7d entries %6.2fs %8.0f entries/s %6.2f MB/s" % (
+            indexes, info.entries, info.seconds, info.rate, len(ldif) / info.seconds / 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
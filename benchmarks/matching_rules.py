@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""
+Compare caseIgnore equality tests against values normalized when entries are
+written with normalizing values on every comparison.
+
+Run from the top of the source tree::
+
+    python benchmarks/matching_rules.py [entries] [searches]
+"""
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from mockldap import CASE_IGNORE  # noqa
+from mockldap.directory import Directory  # noqa
+from mockldap.filter import parse  # noqa
+from mockldap.matching import MatchingRules  # noqa
+
+
+def build_directory(entries):
+    directory = {
+        'o=test': {'objectClass': ['top']},
+    }
+
+    for i in xrange(entries):
+        directory['uid=user%d,o=test' % (i,)] = {
+            'objectClass': ['top', 'person', 'inetOrgPerson'],
+            'uid': ['User%d' % (i,)],
+            'cn': ['User %d' % (i,)],
+            'mail': ['User%d@Example.com' % (i,), 'user%d@example.org' % (i,)],
+        }
+
+    return directory
+
+
+def main(entries=20000, searches=10):
+    rules = MatchingRules({'uid': CASE_IGNORE, 'cn': CASE_IGNORE, 'mail': CASE_IGNORE})
+    directory = Directory(build_directory(entries), matching_rules=rules)
+    matches = parse('(|(mail=USER123@EXAMPLE.COM)(cn=user  456))').compile(rules)
+    items = [(dn, directory.peek(dn), directory.normalized.get(dn)) for dn in directory.data]
+
+    for name, precomputed in [('per comparison', False), ('at write time', True)]:
+        start = time.time()
+        for i in xrange(searches):
+            if precomputed:
+                results = [dn for dn, attrs, normalized in items if matches(dn, attrs, normalized)]
+            else:
+                results = [dn for dn, attrs, normalized in items if matches(dn, attrs)]
+        elapsed = time.time() - start
+
+        print("%-15s %d results %6.2f us/entry" % (
+            name, len(results), elapsed / (searches * len(items)) * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
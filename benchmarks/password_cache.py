@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Compare repeated binds with hashed passwords with and without the password
+cache.
+
+Run from the top of the source tree::
+
+    python benchmarks/password_cache.py [users] [binds]
+"""
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from passlib.hash import ldap_md5_crypt, ldap_salted_sha1  # noqa
+
+from mockldap.ldapobject import LDAPObject  # noqa
+
+
+def build_directory(users):
+    directory = {
+        'o=test': {'objectClass': ['top']},
+    }
+
+    for i in xrange(users):
+        handler = ldap_md5_crypt if (i % 2) else ldap_salted_sha1
+        directory['uid=user%d,o=test' % (i,)] = {
+            'userPassword': [handler.encrypt('password%d' % (i,))],
+        }
+
+    return directory
+
+
+def main(users=20, binds=2000):
+    directory = build_directory(users)
+
+    for password_cache in [None, 1000]:
+        ldapobj = LDAPObject(directory, password_cache=password_cache, recording='off')
+
+        start = time.time()
+        for i in xrange(binds):
+            ldapobj.simple_bind_s('uid=user%d,o=test' % (i % users,), 'password%d' % (i % users,))
+        elapsed = time.time() - start
+
+        print("password_cache=%-5r %8.1f us/bind" % (password_cache, elapsed / binds * 1e6))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Compare range searches with and without an ordering index.
+
+Run from the top of the source tree::
+
+    python benchmarks/range_search.py [entries] [searches]
+"""
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ldap  # noqa
+
+from mockldap.ldapobject import LDAPObject  # noqa
+
+
+def build_directory(entries):
+    directory = {
+        'o=test': {'objectClass': ['top']},
+    }
+
+    for i in xrange(entries):
+        directory['uid=user%d,o=test' % (i,)] = {
+            'uid': ['user%d' % (i,)],
+            'uidNumber': [str(10000 + i)],
+        }
+
+    return directory
+
+
+def main(entries=20000, searches=200):
+    directory = build_directory(entries)
+    filterstr = '(&(uidNumber>=%d)(uidNumber<=%d))' % (10000 + entries // 2, 10000 + entries // 2 + 9)
+
+    for ordering_indexes in [None, ['uidNumber']]:
+        ldapobj = LDAPObject(directory, ordering_indexes=ordering_indexes, recording='off')
+
+        start = time.time()
+        for i in xrange(searches):
+            results = ldapobj.search_s('o=test', ldap.SCOPE_SUBTREE, filterstr)
+        elapsed = time.time() - start
+
+        print("ordering_indexes=%-15r %d results %8.3f ms/search" % (
+            ordering_indexes, len(results), elapsed / searches * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
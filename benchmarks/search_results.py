@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Compare search_s throughput under each result mode.
+
+Run from the top of the source tree::
+
+    python benchmarks/search_results.py [entries] [iterations]
+"""
+import os.path
+import sys
+from timeit import Timer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ldap  # noqa
+
+from mockldap import LDAPObject, RESULT_DEEPCOPY, RESULT_SHALLOW, RESULT_FROZEN  # noqa
+
+
+def build_directory(entries):
+    directory = {'ou=people,o=test': {'objectClass': ['organizationalUnit']}}
+
+    for i in xrange(entries):
+        directory['uid=user%d,ou=people,o=test' % (i,)] = {
+            'objectClass': ['top', 'person', 'posixAccount', 'inetOrgPerson'],
+            'uid': ['user%d' % (i,)],
+            'cn': ['User %d' % (i,)],
+            'mail': ['user%d@example.com' % (i,), 'u%d@example.com' % (i,)],
+            'memberOf': ['cn=group%d,ou=groups,o=test' % (n,) for n in xrange(10)],
+        }
+
+    return directory
+
+
+def main(entries=1000, iterations=20):
+    directory = build_directory(entries)
+    results = {}
+
+    for mode in [RESULT_DEEPCOPY, RESULT_SHALLOW, RESULT_FROZEN]:
+        ldapobj = LDAPObject(directory, result_mode=mode)
+        search = lambda: ldapobj.search_s('ou=people,o=test', ldap.SCOPE_ONELEVEL)
+        seconds = min(Timer(search).repeat(3, iterations)) / iterations
+        results[mode] = seconds
+        print("%-9s %8.2f ms/search %10.0f entries/s" % (mode, seconds * 1e3, entries / seconds))
+
+    for mode in [RESULT_SHALLOW, RESULT_FROZEN]:
+        print("%-9s %8.1fx" % (mode, results[RESULT_DEEPCOPY] / results[mode]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Compare the time it takes to start a MockLdap from a dictionary, from LDIF,
+and from a snapshot.
+
+Run from the top of the source tree::
+
+    python benchmarks/snapshot_load.py [entries]
+"""
+from cStringIO import StringIO
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ldif import LDIFWriter  # noqa
+
+from mockldap import MockLdap  # noqa
+
+
+INDEXES = ['uid', 'mail']
+
+
+def build_directory(entries):
+    directory = {
+        'o=test': {'objectClass': ['top']},
+        'ou=people,o=test': {'objectClass': ['organizationalUnit']},
+    }
+
+    for i in xrange(entries):
+        directory['uid=user%d,ou=people,o=test' % (i,)] = {
+            'objectClass': ['top', 'person', 'inetOrgPerson'],
+            'uid': ['user%d' % (i,)],
+            'cn': ['User %d' % (i,)],
+            'sn': ['%d' % (i,)],
+            'mail': ['user%d@example.com' % (i,)],
+        }
+
+    return directory
+
+
+def build_ldif(directory):
+    ldif = StringIO()
+    writer = LDIFWriter(ldif)
+    for dn, entry in directory.iteritems():
+        writer.unparse(dn, entry)
+
+    return ldif.getvalue()
+
+
+def build_snapshot(directory):
+    snapshot = StringIO()
+    MockLdap(directory, indexes=INDEXES).save_snapshot(snapshot)
+
+    return snapshot.getvalue()
+
+
+def start(load):
+    start = time.time()
+
+    mockldap = MockLdap(indexes=INDEXES)
+    load(mockldap)
+    mockldap.start()
+    mockldap['ldap://localhost']
+    mockldap.stop()
+
+    return time.time() - start
+
+
+def main(entries=20000):
+    directory = build_directory(entries)
+    ldif = build_ldif(directory)
+    snapshot = build_snapshot(directory)
+
+    print("%d entries, LDIF %.1f MB, snapshot %.1f MB" % (
+        entries, len(ldif) / 1e6, len(snapshot) / 1e6))
+
+    loaders = [
+        ('dict', lambda mockldap: mockldap.set_directory(directory)),
+        ('LDIF', lambda mockldap: mockldap.load_ldif(StringIO(ldif))),
+        ('snapshot', lambda mockldap: mockldap.load_snapshot(StringIO(snapshot))),
+    ]
+
+    for name, load in loaders:
+        print("%-8s %6.3fs" % (name, start(load)))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""
+Compare substring searches with and without a substring index.
+
+Run from the top of the source tree::
+
+    python benchmarks/substring_search.py [entries] [searches]
+"""
+import os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ldap  # noqa
+
+from mockldap.ldapobject import LDAPObject  # noqa
+
+
+FILTERS = ['(cn=User 123*)', '(mail=*4567@example.com)', '(cn=*ser 99*)']
+
+
+def build_directory(entries):
+    directory = {
+        'o=test': {'objectClass': ['top']},
+    }
+
+    for i in xrange(entries):
+        directory['uid=user%d,o=test' % (i,)] = {
+            'cn': ['User %d' % (i,)],
+            'mail': ['user%d@example.com' % (i,)],
+        }
+
+    return directory
+
+
+def main(entries=20000, searches=20):
+    directory = build_directory(entries)
+
+    for substring_indexes in [None, ['cn', 'mail']]:
+        ldapobj = LDAPObject(directory, substring_indexes=substring_indexes, recording='off')
+
+        for filterstr in FILTERS:
+            start = time.time()
+            for i in xrange(searches):
+                results = ldapobj.search_s('o=test', ldap.SCOPE_SUBTREE, filterstr)
+            elapsed = time.time() - start
+
+            print("substring_indexes=%-15r %-26s %4d results %8.3f ms/search" % (
+                substring_indexes, filterstr, len(results), elapsed / searches * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
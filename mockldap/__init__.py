@@ -1,9 +1,14 @@
-from collections import defaultdict
+from __future__ import with_statement
 
-from ldap.cidict import cidict
+from collections import defaultdict
 
+from .directory import Directory
 from .ldapobject import LDAPObject
+from .matching import MatchingRules
+from .matching import CASE_EXACT, CASE_IGNORE, INTEGER, DISTINGUISHED_NAME  # noqa
 from .recording import SeedRequired  # noqa
+from .recording import RESULT_DEEPCOPY, RESULT_SHALLOW, RESULT_FROZEN  # noqa
+from .recording import RECORD_FULL, RECORD_COUNTS, RECORD_OFF  # noqa
 
 
 URI_DEFAULT = '__default__'
@@ -15,15 +20,54 @@ class MockLdap(object):
 
     :param directory: Default directory contents.
 
+    :param indexes: Names of attributes to index in every
+        :class:`~mockldap.LDAPObject`.
+
+    :param ordering_indexes: Names of attributes to keep sorted indexes of in
+        every :class:`~mockldap.LDAPObject`, for ``>=`` and ``<=`` tests.
+
+    :param substring_indexes: Names of attributes to keep trigram indexes of
+        in every :class:`~mockldap.LDAPObject`, for substring tests.
+
+    :param matching_rules: Equality matching rules for particular attributes
+        in every :class:`~mockldap.LDAPObject`. See
+        :class:`~mockldap.LDAPObject`.
+
+    :param password_cache: If given, every :class:`~mockldap.LDAPObject`
+        caches up to this many results of verifying hashed passwords.
+
+    :param result_mode: How every :class:`~mockldap.LDAPObject` copies its
+        return values. See
+        :meth:`~mockldap.recording.RecordableMethods.set_result_mode`.
+
+    :param recording: How much every :class:`~mockldap.LDAPObject` records
+        about the calls made to it. See
+        :meth:`~mockldap.recording.RecordableMethods.set_recording`.
+
+    :param thread_safe: If True, every :class:`~mockldap.LDAPObject` may be
+        shared between threads.
+
     After calling :meth:`~mockldap.MockLdap.start`, ``mockldap[uri]`` returns
     an :class:`~mockldap.LDAPObject`. This is the same object that will be
     returned by ``ldap.initialize(uri)``, so you can use it to seed return
     values and discover which APIs were called.
     """
-    def __init__(self, directory=None):
+    def __init__(self, directory=None, indexes=None, result_mode=RESULT_DEEPCOPY,
+                 recording=RECORD_FULL, thread_safe=False, ordering_indexes=None,
+                 substring_indexes=None, matching_rules=None, password_cache=None):
         self.directories = {}
         self.ldap_objects = None
         self.patchers = {}
+        self.ldap_options = {
+            'indexes': indexes,
+            'ordering_indexes': ordering_indexes,
+            'substring_indexes': substring_indexes,
+            'matching_rules': matching_rules,
+            'password_cache': password_cache,
+            'result_mode': result_mode,
+            'recording': recording,
+            'thread_safe': thread_safe,
+        }
 
         if directory is not None:
             self.set_directory(directory)
@@ -48,7 +92,89 @@ class MockLdap(object):
         if self.ldap_objects is not None:
             raise Exception("You can't add a directory after calling start().")
 
-        self.directories[uri] = cidict(map_keys(lambda s: s.lower(), directory))
+        self.directories[uri] = Directory(map_keys(lambda s: s.lower(), directory),
+                                          **self._index_options())
+
+    def load_ldif(self, ldif_file, uri=URI_DEFAULT):
+        """
+        Set the mock LDAP content for a given URI from LDIF.
+
+        :param ldif_file: An LDIF file object or the path to one.
+
+        :param uri: The LDAP URI to associate this content with.
+        :type uri: string
+
+        Records are stored as they are read, so large files can be loaded
+        without holding a copy of their contents. Returns a
+        :class:`~mockldap.loader.LoadInfo` with the number of entries loaded
+        and the time it took.
+        """
+        from .loader import load_ldif
+
+        return self._load(load_ldif, ldif_file, uri)
+
+    def load_snapshot(self, snapshot_file, uri=URI_DEFAULT):
+        """
+        Set the mock LDAP content for a given URI from a snapshot written by
+        :meth:`~mockldap.MockLdap.save_snapshot`.
+
+        :param snapshot_file: A snapshot file object or the path to one.
+
+        :param uri: The LDAP URI to associate this content with.
+        :type uri: string
+
+        This is much faster than building a directory from scratch, since
+        keys and indexes are restored as they were saved. Snapshots are
+        pickles, so only load them from trusted sources. Returns a
+        :class:`~mockldap.loader.LoadInfo`.
+        """
+        from .loader import load_snapshot
+
+        return self._load(load_snapshot, snapshot_file, uri)
+
+    def save_snapshot(self, snapshot_file, uri=URI_DEFAULT):
+        """
+        Save the mock LDAP content for a given URI, along with its indexes, to
+        be restored later with :meth:`~mockldap.MockLdap.load_snapshot`.
+
+        :param snapshot_file: A writable file object or the path to one.
+
+        :param uri: The LDAP URI whose content to save.
+        :type uri: string
+        """
+        from .loader import save_snapshot
+
+        directory = self.directories[uri]
+
+        if isinstance(snapshot_file, basestring):
+            with open(snapshot_file, 'wb') as f:
+                save_snapshot(directory, f)
+        else:
+            save_snapshot(directory, snapshot_file)
+
+    def _load(self, load, path_or_file, uri):
+        if self.ldap_objects is not None:
+            raise Exception("You can't add a directory after calling start().")
+
+        directory = Directory(**self._index_options())
+
+        if isinstance(path_or_file, basestring):
+            with open(path_or_file, 'rb') as f:
+                info = load(f, directory)
+        else:
+            info = load(path_or_file, directory)
+
+        self.directories[uri] = directory
+
+        return info
+
+    def _index_options(self):
+        options = dict((name, self.ldap_options[name])
+                       for name in ['indexes', 'ordering_indexes', 'substring_indexes'])
+        if self.ldap_options['matching_rules'] is not None:
+            options['matching_rules'] = MatchingRules(self.ldap_options['matching_rules'])
+
+        return options
 
     def start(self, path='ldap.initialize'):
         """
@@ -80,7 +206,7 @@ class MockLdap(object):
             raise ValueError("%r is already patched." % (path,))
 
         if self.ldap_objects is None:
-            ldap_objects = map_values(LDAPObject, self.directories)
+            ldap_objects = map_values(self._ldap_object, self.directories)
             self.ldap_objects = defaultdict(self._new_ldap_object,
                                             ldap_objects)
 
@@ -89,13 +215,16 @@ class MockLdap(object):
         self.patchers[path] = patcher
 
     def _new_ldap_object(self):
-        from .ldapobject import LDAPObject
-
         try:
-            return LDAPObject(self.directories[URI_DEFAULT])
+            directory = self.directories[URI_DEFAULT]
         except KeyError:
             raise KeyError("No default mock LDAP content provided")
 
+        return self._ldap_object(directory)
+
+    def _ldap_object(self, directory):
+        return LDAPObject(directory, **self.ldap_options)
+
     def stop(self, path='ldap.initialize'):
         """
         Stop patching :func:`ldap.initialize`.
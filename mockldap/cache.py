@@ -0,0 +1,169 @@
+"""
+A small bounded cache for memoizing expensive parsing.
+"""
+from __future__ import with_statement
+
+from collections import namedtuple
+import threading
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class LRUCache(object):
+    """
+    A mapping that discards its least recently used items beyond a maximum
+    size.
+
+    :param maxsize: The maximum number of items to keep. ``None`` means
+        unbounded; ``0`` disables caching entirely.
+
+    Lookups through ``cache[key]`` are counted as hits or misses; see
+    :meth:`info`. The cache may be shared between threads.
+
+    >>> cache = LRUCache(2)
+    >>> cache['a'] = 1
+    >>> cache['b'] = 2
+    >>> cache['a']
+    1
+    >>> cache['c'] = 3
+    >>> 'b' in cache
+    False
+    >>> cache.info()
+    CacheInfo(hits=1, misses=0, maxsize=2, currsize=2)
+    """
+    PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+        # Circular doubly linked list of [prev, next, key, value] links, most
+        # recently used first.
+        self._links = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def __getitem__(self, key):
+        with self._lock:
+            try:
+                link = self._links[key]
+            except KeyError:
+                self.misses += 1
+                raise
+
+            self.hits += 1
+            self._unlink(link)
+            self._push(link)
+
+            return link[self.VALUE]
+
+    def __setitem__(self, key, value):
+        if self.maxsize == 0:
+            return
+
+        with self._lock:
+            link = self._links.get(key)
+            if link is not None:
+                self._unlink(link)
+                link[self.VALUE] = value
+            else:
+                link = [None, None, key, value]
+                self._links[key] = link
+
+            self._push(link)
+            self._trim()
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._unlink(self._links.pop(key))
+
+    def resize(self, maxsize):
+        """
+        Changes the maximum size, discarding items as necessary.
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            if maxsize == 0:
+                self._clear()
+            else:
+                self._trim()
+
+    def clear(self):
+        """
+        Discards all items and resets the statistics.
+        """
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._links.clear()
+        self._root[:] = [self._root, self._root, None, None]
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """
+        Returns a :class:`CacheInfo` with the current statistics.
+        """
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self))
+
+    def _push(self, link):
+        root = self._root
+        first = root[self.NEXT]
+        link[self.PREV] = root
+        link[self.NEXT] = first
+        first[self.PREV] = link
+        root[self.NEXT] = link
+
+    def _unlink(self, link):
+        link[self.PREV][self.NEXT] = link[self.NEXT]
+        link[self.NEXT][self.PREV] = link[self.PREV]
+
+    def _trim(self):
+        if self.maxsize is None:
+            return
+
+        while len(self._links) > self.maxsize:
+            last = self._root[self.PREV]
+            self._unlink(last)
+            del self._links[last[self.KEY]]
+
+
+def cache_functions(cache, items, name):
+    """
+    Returns ``(set_cache_size, clear_cache, cache_info)`` functions that
+    manage a module's :class:`LRUCache`. ``items`` describes what is cached,
+    for example ``u"filters"``, and ``name`` names the cache in
+    documentation, for example ``u"filter"``.
+    """
+    def set_cache_size(maxsize):
+        cache.resize(maxsize)
+
+    def clear_cache():
+        cache.clear()
+
+    def cache_info():
+        return cache.info()
+
+    set_cache_size.__doc__ = u"""
+    Sets the maximum number of parsed %s to cache. ``None`` means unbounded
+    and ``0`` disables the cache.
+    """ % (items,)
+    clear_cache.__doc__ = u"""
+    Discards all cached %s and resets the statistics.
+    """ % (items,)
+    cache_info.__doc__ = u"""
+    Returns a :class:`~mockldap.cache.CacheInfo` with the hits, misses,
+    maximum size, and current size of the %s cache.
+    """ % (name,)
+
+    return (set_cache_size, clear_cache, cache_info)
@@ -0,0 +1,887 @@
+"""
+Directory storage with structural indexes.
+
+Everything here is copy-on-write: :meth:`Directory.snapshot` returns an
+independent copy by sharing the underlying data, and each copy only duplicates
+the pieces that it goes on to modify.
+"""
+from __future__ import absolute_import
+
+from bisect import bisect_left, bisect_right
+from copy import deepcopy
+from string import lower
+from UserDict import UserDict
+
+import ldap
+from ldap.cidict import cidict
+
+from .dn import normalize as normalize_dn
+from .filter import ordering_key
+
+
+class Overlay(object):
+    """
+    A dictionary layered over a shared, read-only base dictionary.
+
+    Changes are recorded locally and never written through to the base. Values
+    that are mutable containers must be retrieved with :meth:`mutable` before
+    they are modified in place, so that a value from the base, or one that has
+    been shared with a snapshot, can be copied first.
+
+    >>> base = {'a': [1], 'b': [2]}
+    >>> overlay = Overlay(base)
+    >>> overlay.mutable('a', list).append(3)
+    >>> del overlay['b']
+    >>> overlay['c'] = [4]
+    >>> sorted(overlay.iteritems())
+    [('a', [1, 3]), ('c', [4])]
+    >>> sorted(base.iteritems())
+    [('a', [1]), ('b', [2])]
+    """
+    def __init__(self, base=None):
+        self.base = base if (base is not None) else {}
+        self.local = {}
+        self.deleted = set()
+        self.added = 0
+        # Local keys whose values are shared with a snapshot.
+        self.shared = set()
+
+    def __len__(self):
+        return len(self.base) - len(self.deleted) + self.added
+
+    def __contains__(self, key):
+        return (key in self.local) or ((key in self.base) and (key not in self.deleted))
+
+    has_key = __contains__
+
+    def __getitem__(self, key):
+        try:
+            return self.local[key]
+        except KeyError:
+            if key in self.deleted:
+                raise
+
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        if (key not in self.local) and (key not in self.base):
+            self.added += 1
+
+        self.local[key] = value
+        self.deleted.discard(key)
+        self.shared.discard(key)
+
+    def __delitem__(self, key):
+        if key in self.local:
+            del self.local[key]
+            self.shared.discard(key)
+            if key in self.base:
+                self.deleted.add(key)
+            else:
+                self.added -= 1
+        elif (key in self.base) and (key not in self.deleted):
+            self.deleted.add(key)
+        else:
+            raise KeyError(key)
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+
+        del self[key]
+
+        return value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+
+        return self[key]
+
+    def mutable(self, key, copy, factory=None):
+        """
+        Returns a value that may be modified in place.
+
+        If the value comes from the base or is shared with a snapshot, it is
+        replaced locally by ``copy(value)`` first. If the key is missing and
+        ``factory`` is given, ``factory()`` is stored and returned; otherwise
+        this raises KeyError.
+        """
+        try:
+            value = self.local[key]
+        except KeyError:
+            pass
+        else:
+            if key in self.shared:
+                value = copy(value)
+                self[key] = value
+            return value
+
+        if (key in self.base) and (key not in self.deleted):
+            value = copy(self.base[key])
+        elif factory is not None:
+            value = factory()
+        else:
+            raise KeyError(key)
+
+        self[key] = value
+
+        return value
+
+    def iterkeys(self):
+        for key in self.local:
+            yield key
+
+        for key in self.base:
+            if (key not in self.local) and (key not in self.deleted):
+                yield key
+
+    def itervalues(self):
+        for key, value in self.iteritems():
+            yield value
+
+    def iteritems(self):
+        for item in self.local.iteritems():
+            yield item
+
+        for key, value in self.base.iteritems():
+            if (key not in self.local) and (key not in self.deleted):
+                yield key, value
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def clear(self):
+        self.base = {}
+        self.local = {}
+        self.deleted = set()
+        self.added = 0
+        self.shared = set()
+
+    def changes(self):
+        """
+        Returns the number of local changes.
+        """
+        return len(self.local) + len(self.deleted)
+
+    def freeze(self, fraction=0):
+        """
+        Folds local changes into a new base if there are more than
+        ``fraction`` times as many of them as there are base keys. This is a
+        constant-time operation unless both the base and the local changes are
+        non-empty.
+        """
+        if self.changes() > fraction * len(self.base):
+            if self.base:
+                base = dict(self.iteritems())
+            else:
+                base = self.local
+            self.base = base
+            self.local = {}
+            self.deleted = set()
+            self.added = 0
+            self.shared = set()
+
+    def snapshot(self):
+        """
+        Returns a new overlay with the same content, sharing our base. Local
+        changes are copied, in time proportional to their number, and their
+        values are shared until either overlay asks for them with
+        :meth:`mutable`. Nothing that a concurrent reader sees is changed.
+
+        >>> overlay = Overlay({'a': [1]})
+        >>> overlay['b'] = [2]
+        >>> snapshot = overlay.snapshot()
+        >>> overlay.mutable('b', list).append(3)
+        >>> snapshot.mutable('b', list).append(4)
+        >>> overlay['b'], snapshot['b'], snapshot.base is overlay.base
+        ([2, 3], [2, 4], True)
+        """
+        overlay = Overlay(self.base)
+
+        if self.local or self.deleted:
+            overlay.local = dict(self.local)
+            overlay.deleted = set(self.deleted)
+            overlay.added = self.added
+            overlay.shared = set(self.local)
+            self.shared = set(self.local)
+
+        return overlay
+
+
+class DNTree(object):
+    """
+    An index of the parent/child relationships between directory entries.
+
+    Each node is keyed by the normalized form of a DN: a tuple of its
+    lower-cased RDNs, leaf first. ``entries`` maps the nodes that actually
+    exist in the directory to their directory keys; ``children`` maps every
+    node to the set of its immediate children. Ancestors that have no entry of
+    their own are kept as glue nodes so that subtree searches still find the
+    entries beneath them.
+    """
+    def __init__(self):
+        self.entries = Overlay()
+        self.children = Overlay()
+        self.nodes = Overlay()
+
+    def add(self, dn):
+        node = normalize_dn(dn)
+        self.entries[node] = dn.lower()
+        self.nodes[dn.lower()] = node
+
+        while node:
+            parent = node[1:]
+            siblings = self.children.mutable(parent, set, set)
+            if node in siblings:
+                break
+            siblings.add(node)
+            node = parent
+
+    def remove(self, dn):
+        node = self.nodes.pop(dn.lower(), None)
+        if node is None:
+            return
+        self.entries.pop(node, None)
+
+        # Prune glue nodes that no longer lead to any entries.
+        while node and (node not in self.entries) and not self.children.get(node):
+            self.children.pop(node, None)
+            parent = node[1:]
+            self.children.mutable(parent, set).discard(node)
+            node = parent
+
+    def clear(self):
+        self.entries.clear()
+        self.children.clear()
+        self.nodes.clear()
+
+    def snapshot(self):
+        tree = DNTree()
+        tree.entries = self.entries.snapshot()
+        tree.children = self.children.snapshot()
+        tree.nodes = self.nodes.snapshot()
+
+        return tree
+
+    def scope(self, base, scope):
+        """
+        Generates the directory keys of all entries within a search scope.
+        """
+        node = normalize_dn(base)
+
+        if scope == ldap.SCOPE_BASE:
+            nodes = [node]
+        elif scope == ldap.SCOPE_ONELEVEL:
+            nodes = self.children.get(node, ())
+        elif scope == ldap.SCOPE_SUBTREE:
+            nodes = self._walk(node)
+        else:
+            raise ValueError(u"Unrecognized scope: {0}".format(scope))
+
+        entries = self.entries
+
+        return (entries[node] for node in nodes if node in entries)
+
+    def in_scope(self, dn, base, scope):
+        """
+        Returns True if the entry with directory key ``dn`` is within a search
+        scope.
+        """
+        node = self.nodes.get(dn)
+        base = normalize_dn(base)
+
+        if node is None:
+            in_scope = False
+        elif scope == ldap.SCOPE_BASE:
+            in_scope = (node == base)
+        elif scope == ldap.SCOPE_ONELEVEL:
+            in_scope = (node[1:] == base)
+        elif scope == ldap.SCOPE_SUBTREE:
+            in_scope = (len(node) >= len(base)) and (node[len(node) - len(base):] == base)
+        else:
+            raise ValueError(u"Unrecognized scope: {0}".format(scope))
+
+        return in_scope
+
+    def scope_size(self, base, scope):
+        """
+        Returns an upper bound on the number of entries within a search scope.
+        """
+        if scope == ldap.SCOPE_BASE:
+            size = 1
+        elif scope == ldap.SCOPE_ONELEVEL:
+            size = len(self.children.get(normalize_dn(base), ()))
+        else:
+            size = len(self.entries)
+
+        return size
+
+    def _walk(self, node):
+        stack = [node]
+
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(self.children.get(node, ()))
+
+
+class AttributeIndex(object):
+    """
+    An equality index over the values of a single attribute.
+
+    ``values`` maps each value to the set of directory keys of the entries
+    that hold it. We also remember which values were indexed for each entry,
+    so entries can be removed after they've been modified in place. If the
+    attribute has a matching rule, values are indexed in normalized form.
+    """
+    def __init__(self, attr, normalize=None):
+        self.attr = attr
+        self.normalize = normalize
+        self.values = Overlay()
+        self.entries = Overlay()
+
+    def add(self, dn, entry, normalized=None):
+        """
+        Indexes an entry. If the attribute has a matching rule, ``normalized``
+        must be the entry's normalized values, from
+        :meth:`NormalizedValues.get`, so that we find the same values as a
+        search would.
+        """
+        if self.normalize is None:
+            values = frozenset(entry.get(self.attr) or ())
+        else:
+            values = normalized.get(self.attr.lower(), frozenset())
+        if not values:
+            return
+
+        self.entries[dn] = values
+        for value in values:
+            self.values.mutable(value, set, set).add(dn)
+
+    def remove(self, dn):
+        for value in self.entries.pop(dn, ()):
+            dns = self.values.mutable(value, set)
+            dns.discard(dn)
+            if not dns:
+                del self.values[value]
+
+    def clear(self):
+        self.values.clear()
+        self.entries.clear()
+
+    def freeze(self, fraction=0):
+        self.values.freeze(fraction)
+        self.entries.freeze(fraction)
+
+    def snapshot(self):
+        index = AttributeIndex(self.attr, self.normalize)
+        index.values = self.values.snapshot()
+        index.entries = self.entries.snapshot()
+
+        return index
+
+    def equal(self, value):
+        """
+        Returns the directory keys of entries with the given value.
+        """
+        if self.normalize is not None:
+            value = self.normalize(value)
+
+        return self.values.get(value, frozenset())
+
+    def present(self):
+        """
+        Returns the directory keys of entries with any value.
+        """
+        return self.entries
+
+
+class NormalizedValues(object):
+    """
+    The normalized values of each entry's attributes that have matching
+    rules, as computed by
+    :meth:`~mockldap.matching.MatchingRules.normalize_entry`. ``entries``
+    maps directory keys to ``{attr: frozenset(values)}``.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        self.entries = Overlay()
+
+    def add(self, dn, entry):
+        normalized = self.rules.normalize_entry(entry)
+        if normalized:
+            self.entries[dn] = normalized
+
+    def remove(self, dn):
+        self.entries.pop(dn, None)
+
+    def clear(self):
+        self.entries.clear()
+
+    def freeze(self, fraction=0):
+        self.entries.freeze(fraction)
+
+    def snapshot(self):
+        normalized = NormalizedValues(self.rules)
+        normalized.entries = self.entries.snapshot()
+
+        return normalized
+
+    def get(self, dn):
+        """
+        Returns the normalized values of an entry.
+        """
+        return self.entries.get(dn, _empty)
+
+
+_empty = {}
+
+
+class OrderingIndex(object):
+    """
+    A sorted index over the values of a single attribute, for ``>=`` and
+    ``<=`` tests.
+
+    ``keys`` holds the :func:`~mockldap.filter.ordering_key` of every indexed
+    value in sorted order and ``dns`` holds the directory key of the
+    corresponding entry, so ranges can be found by bisection. The two lists
+    are shared with snapshots and copied before the first change after one is
+    taken.
+
+    >>> index = OrderingIndex('uidNumber')
+    >>> index.add('cn=a', {'uidNumber': ['10']})
+    >>> index.add('cn=b', {'uidNumber': ['9', '200']})
+    >>> sorted(index.range('>=', '10'))
+    ['cn=a', 'cn=b']
+    >>> sorted(index.range('<=', '9'))
+    ['cn=b']
+    """
+    def __init__(self, attr):
+        self.attr = attr
+        self.keys = []
+        self.dns = []
+        self.entries = Overlay()
+        self._shared = False
+
+    def add(self, dn, entry):
+        keys = frozenset(ordering_key(value) for value in entry.get(self.attr) or ())
+        if not keys:
+            return
+
+        self._unshare()
+        self.entries[dn] = keys
+        for key in keys:
+            i = bisect_right(self.keys, key)
+            self.keys.insert(i, key)
+            self.dns.insert(i, dn)
+
+    def remove(self, dn):
+        keys = self.entries.pop(dn, ())
+        if not keys:
+            return
+
+        self._unshare()
+        for key in keys:
+            i = self.dns.index(dn, bisect_left(self.keys, key), bisect_right(self.keys, key))
+            del self.keys[i]
+            del self.dns[i]
+
+    def clear(self):
+        self.keys = []
+        self.dns = []
+        self.entries.clear()
+        self._shared = False
+
+    def freeze(self, fraction=0):
+        self.entries.freeze(fraction)
+
+    def snapshot(self):
+        index = OrderingIndex(self.attr)
+        index.keys = self.keys
+        index.dns = self.dns
+        index.entries = self.entries.snapshot()
+        index._shared = self._shared = True
+
+        return index
+
+    def range(self, op, value):
+        """
+        Returns the directory keys of entries matched by an ordering test:
+        those with a value that is comparable to the given one and no less
+        (``>=``) or no greater (``<=``) than it.
+        """
+        start, stop = self._bounds(op, value)
+
+        return frozenset(self.dns[start:stop])
+
+    def count(self, op, value):
+        """
+        Returns the number of indexed values matched by an ordering test. This
+        is an upper bound on the number of matching entries.
+        """
+        start, stop = self._bounds(op, value)
+
+        return stop - start
+
+    def present(self):
+        """
+        Returns the directory keys of entries with any value.
+        """
+        return self.entries
+
+    def _bounds(self, op, value):
+        key = ordering_key(value)
+
+        # (kind,) sorts before every key of that kind and after every key of
+        # the kinds before it.
+        if op == u'>=':
+            bounds = (bisect_left(self.keys, key), bisect_left(self.keys, (key[0] + 1,)))
+        elif op == u'<=':
+            bounds = (bisect_left(self.keys, (key[0],)), bisect_right(self.keys, key))
+        else:
+            raise ValueError(u"Unrecognized ordering operation: {0}".format(op))
+
+        return bounds
+
+    def _unshare(self):
+        if self._shared:
+            self.keys = list(self.keys)
+            self.dns = list(self.dns)
+            self._shared = False
+
+
+class SubstringIndex(object):
+    """
+    A trigram index over the values of a single attribute, for substring
+    tests.
+
+    Each value is lower-cased and padded with a NUL at both ends before it is
+    split into overlapping three-character grams, so grams at the ends double
+    as prefix and suffix indexes. ``grams`` maps each gram to the set of
+    directory keys of the entries whose values contain it. An entry that
+    contains every gram of a test's substrings is only a candidate: the test
+    must still be evaluated to rule out false positives.
+
+    >>> index = SubstringIndex('cn')
+    >>> index.add('cn=a', {'cn': ['Alice']})
+    >>> index.add('cn=b', {'cn': ['Malice']})
+    >>> sorted(index.candidates(('ali', (), '')))
+    ['cn=a']
+    >>> sorted(index.candidates(('', ('lic',), '')))
+    ['cn=a', 'cn=b']
+    """
+    def __init__(self, attr):
+        self.attr = attr
+        self.grams = Overlay()
+        self.entries = Overlay()
+
+    def add(self, dn, entry):
+        grams = frozenset(gram for value in entry.get(self.attr) or ()
+                          for gram in trigrams('\0' + value.lower() + '\0'))
+        if not grams:
+            return
+
+        self.entries[dn] = grams
+        for gram in grams:
+            self.grams.mutable(gram, set, set).add(dn)
+
+    def remove(self, dn):
+        for gram in self.entries.pop(dn, ()):
+            dns = self.grams.mutable(gram, set)
+            dns.discard(dn)
+            if not dns:
+                del self.grams[gram]
+
+    def clear(self):
+        self.grams.clear()
+        self.entries.clear()
+
+    def freeze(self, fraction=0):
+        self.grams.freeze(fraction)
+        self.entries.freeze(fraction)
+
+    def snapshot(self):
+        index = SubstringIndex(self.attr)
+        index.grams = self.grams.snapshot()
+        index.entries = self.entries.snapshot()
+
+        return index
+
+    def candidates(self, substrings):
+        """
+        Returns the directory keys of entries that may match the
+        ``(initial, any, final)`` substrings of a test, or None if they are
+        too short for the index to narrow anything down.
+        """
+        sets = sorted((self.grams.get(gram, frozenset()) for gram in self.query_grams(substrings)),
+                      key=len)
+        if not sets:
+            return None
+
+        dns = set(sets[0])
+        for other in sets[1:]:
+            if not dns:
+                break
+            dns.intersection_update(other)
+
+        return dns
+
+    def estimate(self, substrings):
+        """
+        Returns an upper bound on the number of entries that may match, or
+        None if the index can't narrow anything down.
+        """
+        sizes = [len(self.grams.get(gram, ())) for gram in self.query_grams(substrings)]
+
+        return min(sizes) if sizes else None
+
+    def query_grams(self, substrings):
+        """
+        Returns the grams that every matching value must contain.
+        """
+        initial, middle, final = substrings
+        pieces = ['\0' + initial.lower(), final.lower() + '\0']
+        pieces.extend(substring.lower() for substring in middle)
+
+        return set(gram for piece in pieces for gram in trigrams(piece))
+
+
+def trigrams(value):
+    return [value[i:i + 3] for i in xrange(len(value) - 2)]
+
+
+class Directory(cidict):
+    """
+    The case-insensitive ``{dn: {attr: [values]}}`` mapping behind each
+    :class:`~mockldap.LDAPObject`.
+
+    :param indexes: Names of attributes to maintain equality indexes for.
+
+    :param ordering_indexes: Names of attributes to maintain sorted indexes
+        for.
+
+    :param substring_indexes: Names of attributes to maintain trigram indexes
+        for.
+
+    :param matching_rules: A :class:`~mockldap.matching.MatchingRules` for
+        equality tests, or None to compare all values exactly.
+
+    This keeps a :class:`DNTree` in sync with its keys, so search scopes can be
+    resolved without visiting every entry, as well as an
+    :class:`AttributeIndex` for each of ``indexes``, an :class:`OrderingIndex`
+    for each of ``ordering_indexes``, and a :class:`SubstringIndex` for each of
+    ``substring_indexes``. With ``matching_rules``, this also keeps the
+    :class:`NormalizedValues` of every entry, and equality indexes hold
+    normalized values. Entries that are modified in place must be passed to
+    :meth:`reindex` afterwards.
+
+    Entries are copied from the mapping we were created from, unless it's
+    another directory, and are then shared with any snapshots. Looking up or
+    iterating over entries gives this directory its own copies of them, so the
+    results can be modified freely; :meth:`peek` is for read-only access
+    without the copy.
+    """
+    def __init__(self, default=None, indexes=(), ordering_indexes=(), substring_indexes=(),
+                 matching_rules=None):
+        if not matching_rules:
+            matching_rules = None
+            self.normalized = None
+        else:
+            self.normalized = NormalizedValues(matching_rules)
+        self.matching_rules = matching_rules
+
+        self.tree = DNTree()
+        self.indexes = dict((attr, AttributeIndex(attr, self._normalizer(attr)))
+                            for attr in indexes or ())
+        self.ordering_indexes = dict((attr, OrderingIndex(attr))
+                                     for attr in ordering_indexes or ())
+        self.substring_indexes = dict((attr, SubstringIndex(attr))
+                                      for attr in substring_indexes or ())
+
+        cidict.__init__(self)
+        self.data = Overlay()
+        self._keys = Overlay()
+        if isinstance(default, Directory):
+            self.update(default)
+        else:
+            self.update(deepcopy(default or {}))
+        self.freeze()
+
+    def __getitem__(self, key):
+        return self.data.mutable(lower(key), deepcopy)
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self._unindex(key)
+        else:
+            self.tree.add(key)
+
+        cidict.__setitem__(self, key, value)
+        self._index(key, value)
+
+    def __delitem__(self, key):
+        cidict.__delitem__(self, key)
+
+        self.tree.remove(key)
+        self._unindex(key)
+
+    def __cmp__(self, other):
+        if isinstance(other, Directory):
+            other = dict(other.data.iteritems())
+        elif isinstance(other, UserDict):
+            other = other.data
+
+        return cmp(dict(self.data.iteritems()), other)
+
+    def update(self, other):
+        if isinstance(other, Directory):
+            for lower_key, key in other._keys.iteritems():
+                self[key] = other.peek(lower_key)
+        else:
+            cidict.update(self, other)
+
+    def peek(self, key):
+        """
+        Returns an entry for reading only. The result must not be modified.
+        """
+        return self.data[lower(key)]
+
+    def iteritems(self):
+        for lower_key, key in self._keys.iteritems():
+            yield key, self.data.mutable(lower_key, deepcopy)
+
+    def itervalues(self):
+        for key, entry in self.iteritems():
+            yield entry
+
+    def values(self):
+        return list(self.itervalues())
+
+    def copy(self):
+        return self.snapshot()
+
+    def clear(self):
+        self.data.clear()
+        self._keys.clear()
+        self.tree.clear()
+        for index in self._all_indexes():
+            index.clear()
+
+    def freeze(self, fraction=0):
+        """
+        Makes the current content the shared base for future snapshots.
+
+        Snapshots copy whatever has changed since then, so it pays to do this
+        from time to time. With ``fraction``, each part of the directory is
+        only folded into its base once its changes outnumber that fraction of
+        its base, which keeps the cost of doing this after every change
+        constant on average.
+        """
+        for overlay in [self.data, self._keys, self.tree.entries, self.tree.children, self.tree.nodes]:
+            overlay.freeze(fraction)
+        for index in self._all_indexes():
+            index.freeze(fraction)
+
+    def snapshot(self):
+        """
+        Returns an independent copy of this directory. This takes time
+        proportional to the changes since the last :meth:`freeze`, and doesn't
+        change anything that other readers of this directory see.
+        """
+        directory = Directory()
+        directory.data = self.data.snapshot()
+        directory._keys = self._keys.snapshot()
+        directory.tree = self.tree.snapshot()
+        directory.indexes = dict((attr, index.snapshot())
+                                 for attr, index in self.indexes.iteritems())
+        directory.ordering_indexes = dict((attr, index.snapshot())
+                                          for attr, index in self.ordering_indexes.iteritems())
+        directory.substring_indexes = dict((attr, index.snapshot())
+                                           for attr, index in self.substring_indexes.iteritems())
+        directory.matching_rules = self.matching_rules
+        if self.normalized is not None:
+            directory.normalized = self.normalized.snapshot()
+
+        return directory
+
+    def reindex(self, key):
+        """
+        Brings the attribute indexes up to date after an entry has been
+        modified in place.
+        """
+        entry = self.data.get(lower(key))
+
+        if (entry is not None) and self._all_indexes():
+            self._unindex(key)
+            self._index(key, entry)
+
+    def has_value(self, key, attr, value):
+        """
+        Returns True if an entry has a value for ``attr`` that is equal to
+        ``value`` under the attribute's matching rule. Raises KeyError if there
+        is no such entry.
+        """
+        entry = self.peek(key)
+        normalize = self._normalizer(attr)
+
+        if normalize is None:
+            has_value = value in entry.get(attr, ())
+        else:
+            has_value = normalize(value) in self.normalized.get(lower(key)).get(attr.lower(), ())
+
+        return has_value
+
+    def _normalizer(self, attr):
+        if self.matching_rules is None:
+            normalize = None
+        else:
+            normalize = self.matching_rules.normalizer(attr)
+
+        return normalize
+
+    def _all_indexes(self):
+        indexes = (self.indexes.values() + self.ordering_indexes.values() +
+                   self.substring_indexes.values())
+        if self.normalized is not None:
+            indexes.append(self.normalized)
+
+        return indexes
+
+    def _index(self, key, entry):
+        key = key.lower()
+        normalized = None
+
+        if self.normalized is not None:
+            self.normalized.add(key, entry)
+            normalized = self.normalized.get(key)
+        for index in self.indexes.itervalues():
+            index.add(key, entry, normalized)
+        for index in self.ordering_indexes.values() + self.substring_indexes.values():
+            index.add(key, entry)
+
+    def _unindex(self, key):
+        for index in self._all_indexes():
+            index.remove(key.lower())
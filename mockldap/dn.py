@@ -0,0 +1,92 @@
+"""
+Distinguished name parsing and normalization.
+
+Every DN string is parsed at most once while it remains in a bounded LRU
+cache, so the same DNs can be validated, compared, and taken apart repeatedly
+without going back to :func:`ldap.dn.str2dn`.
+"""
+from __future__ import absolute_import
+
+import ldap
+import ldap.dn
+
+from .cache import LRUCache, cache_functions
+
+
+class ParsedDN(object):
+    """
+    The parsed form of a DN string.
+
+    .. attribute:: rdns
+
+        A tuple of RDNs, leaf first, as returned by :func:`ldap.dn.str2dn`.
+        Each RDN is a tuple of ``(attr, value, flags)`` tuples.
+
+    .. attribute:: normalized
+
+        A tuple of lower-cased RDN strings, leaf first. Two DNs that differ
+        only in case or formatting have the same normalized form.
+    """
+    __slots__ = ['rdns', 'normalized']
+
+    def __init__(self, rdns):
+        self.rdns = tuple(tuple(tuple(ava) for ava in rdn) for rdn in rdns)
+        self.normalized = tuple(ldap.dn.dn2str([rdn]).lower() for rdn in rdns)
+
+
+def parse(dn):
+    """
+    Returns the :class:`ParsedDN` for a DN string. Raises
+    :exc:`ldap.INVALID_DN_SYNTAX` if the string isn't a valid DN.
+
+    >>> parse('CN=Alice, o=test').normalized
+    ('cn=alice', 'o=test')
+    """
+    try:
+        parsed = _cache[dn]
+    except KeyError:
+        parsed = _parse(dn)
+        _cache[dn] = parsed
+
+    if parsed is None:
+        raise ldap.INVALID_DN_SYNTAX
+
+    return parsed
+
+
+def _parse(dn):
+    try:
+        parsed = ParsedDN(ldap.dn.str2dn(dn))
+    except ldap.DECODING_ERROR:
+        parsed = None
+
+    return parsed
+
+
+def normalize(dn):
+    """
+    Returns the normalized form of a DN as a tuple of lower-cased RDNs, leaf
+    first.
+    """
+    return parse(dn).normalized
+
+
+def split(dn):
+    """
+    Splits a DN into its leaf RDN and the DN of its parent.
+
+    >>> split('cn=alice,ou=example,o=test')
+    ('cn=alice', 'ou=example,o=test')
+    """
+    rdns = parse(dn).rdns
+
+    return (ldap.dn.dn2str(rdns[:1]), ldap.dn.dn2str(rdns[1:]))
+
+
+#
+# Parse cache
+#
+
+_cache = LRUCache(4096)
+
+set_cache_size, clear_cache, cache_info = cache_functions(_cache, u"DNs", u"DN")
@@ -1,12 +1,27 @@
 """
-Simple filter expression parser based on funcparserlib.
+Simple filter expression parser.
+
+Filter strings are tokenized and then parsed either by a funcparserlib grammar
+or by an equivalent hand-written recursive-descent parser. Set
+:data:`use_native_parser` to choose between them; the native parser is always
+used if funcparserlib is not installed.
 """
 from functools import partial
 import ldap
 import re
 
-from funcparserlib.parser import (a, skip, oneplus, finished,
-                                  with_forward_decls, NoParseError)
+try:
+    from funcparserlib.parser import (a, skip, oneplus, finished,
+                                      with_forward_decls, NoParseError)
+except ImportError:
+    NoParseError = None
+
+from .cache import LRUCache, cache_functions
+
+
+# If True, parse filters with NativeParser rather than the funcparserlib
+# grammar. The two produce identical trees and errors.
+use_native_parser = (NoParseError is None)
 
 
 class UnsupportedOp(Exception):
@@ -39,6 +54,34 @@ class Token(object):
     def matches(self, dn, attrs):
         raise NotImplementedError()
 
+    def compile(self, rules=None):
+        """
+        Returns a function of ``(dn, attrs, normalized=None)`` that is
+        equivalent to :meth:`matches`, with the structure of the filter and
+        its attribute names and values bound in closures.
+
+        With a :class:`~mockldap.matching.MatchingRules`, equality tests on
+        attributes that have rules compare normalized values. These are taken
+        from ``normalized``, the entry's
+        :meth:`~mockldap.matching.MatchingRules.normalize_entry`, if it's
+        given; otherwise they're computed on each call.
+
+        Functions are built on the first call for each set of rules and kept
+        on the token, so they're cached along with the parsed filter.
+        """
+        try:
+            matcher = self._matchers[rules]
+        except AttributeError:
+            matcher = self._compile(rules)
+            self._matchers = {rules: matcher}
+        except KeyError:
+            matcher = self._matchers[rules] = self._compile(rules)
+
+        return matcher
+
+    def _compile(self, rules):
+        raise NotImplementedError()
+
 
 LParen = partial(Token, Token.LPAREN)
 RParen = partial(Token, Token.RPAREN)
@@ -48,7 +91,7 @@ class And(Token):
     def __init__(self, *args, **kwargs):
         super(And, self).__init__(self.AND, *args, **kwargs)
 
-        self.terms = []
+        self.terms = ()
 
     def unparse(self):
         return u"(&%s)" % (u"".join(t.unparse() for t in self.terms),)
@@ -56,12 +99,30 @@ class And(Token):
     def matches(self, dn, attrs):
         return all(term.matches(dn, attrs) for term in self.terms)
 
+    def _compile(self, rules):
+        terms = tuple(term.compile(rules) for term in _flatten(self))
+
+        if len(terms) == 1:
+            matcher = terms[0]
+        elif len(terms) == 2:
+            first, second = terms
+            matcher = lambda dn, attrs, normalized=None: (first(dn, attrs, normalized) and
+                                                          second(dn, attrs, normalized))
+        else:
+            def matcher(dn, attrs, normalized=None):
+                for term in terms:
+                    if not term(dn, attrs, normalized):
+                        return False
+                return True
+
+        return matcher
+
 
 class Or(Token):
     def __init__(self, *args, **kwargs):
         super(Or, self).__init__(self.OR, *args, **kwargs)
 
-        self.terms = []
+        self.terms = ()
 
     def unparse(self):
         return u"(|%s)" % (u"".join(t.unparse() for t in self.terms),)
@@ -69,6 +130,24 @@ class Or(Token):
     def matches(self, dn, attrs):
         return any(term.matches(dn, attrs) for term in self.terms)
 
+    def _compile(self, rules):
+        terms = tuple(term.compile(rules) for term in _flatten(self))
+
+        if len(terms) == 1:
+            matcher = terms[0]
+        elif len(terms) == 2:
+            first, second = terms
+            matcher = lambda dn, attrs, normalized=None: (first(dn, attrs, normalized) or
+                                                          second(dn, attrs, normalized))
+        else:
+            def matcher(dn, attrs, normalized=None):
+                for term in terms:
+                    if term(dn, attrs, normalized):
+                        return True
+                return False
+
+        return matcher
+
 
 class Not(Token):
     def __init__(self, *args, **kwargs):
@@ -91,15 +170,39 @@ class Not(Token):
     def matches(self, dn, attrs):
         return (not self.term.matches(dn, attrs))
 
+    def _compile(self, rules):
+        if isinstance(self.term, Not):
+            matcher = self.term.term.compile(rules)
+        else:
+            term = self.term.compile(rules)
+            matcher = lambda dn, attrs, normalized=None: not term(dn, attrs, normalized)
+
+        return matcher
+
+
+def _flatten(token):
+    """
+    Generates the terms of an And or Or, merging in the terms of any nested
+    operators of the same kind.
+    """
+    for term in token.terms:
+        if type(term) is type(token):
+            for subterm in _flatten(term):
+                yield subterm
+        else:
+            yield term
+
 
 class Test(Token):
     TEST_RE = re.compile(r'(.+?)([~<>]?=)(.+)')
     UNESCAPE_RE = re.compile(r'\\([0-9a-f]{2})', flags=re.I)
+    SUPPORTED_OPS = frozenset([u'=', u'>=', u'<='])
 
     # Defaults
     attr = None
     op = None
     value = None
+    substrings = None
 
     def __init__(self, *args, **kwargs):
         super(Test, self).__init__(self.TEST, *args, **kwargs)
@@ -115,29 +218,126 @@ class Test(Token):
 
         self.attr, self.op, self.value = match.groups()
 
-        if self.op != '=':
+        if self.op not in self.SUPPORTED_OPS:
             raise UnsupportedOp(u"Operation '%s' is not supported" % (self.op,))
 
-        if (u'*' in self.value) and (self.value != u'*'):
-            raise UnsupportedOp(u"Wildcard matches are not supported in '%s'" % (self.value,))
+        # Resolve all escaped characters. Substring tests are split on the
+        # wildcards first, since an escaped * is not a wildcard.
+        if (self.op == u'=') and (u'*' in self.value) and (self.value != u'*'):
+            pieces = [self._unescape(piece) for piece in self.value.split(u'*')]
+            self.substrings = (pieces[0], tuple(filter(None, pieces[1:-1])), pieces[-1])
+        else:
+            self.value = self._unescape(self.value)
 
-        # Resolve all escaped characters
-        self.value = self.UNESCAPE_RE.sub(lambda m: chr(int(m.group(1), 16)), self.value)
+    def _unescape(self, value):
+        return self.UNESCAPE_RE.sub(lambda m: chr(int(m.group(1), 16)), value)
 
     def unparse(self):
         return u"(%s)" % (self.content,)
 
     def matches(self, dn, attrs):
-        values = attrs.get(self.attr)
-
-        if values is None:
-            matches = False
+        return self.compile()(dn, attrs)
+
+    def _compile(self, rules):
+        attr = self.attr
+        normalize = rules.normalizer(attr) if (rules is not None) else None
+
+        if self.op in [u'>=', u'<=']:
+            key = ordering_key(self.value)
+            kind = key[0]
+            if self.op == u'>=':
+                test = lambda k: (k[0] == kind) and (k >= key)
+            else:
+                test = lambda k: (k[0] == kind) and (k <= key)
+
+            def matcher(dn, attrs, normalized=None):
+                values = attrs.get(attr)
+                return (values is not None) and any(test(ordering_key(value)) for value in values)
+        elif self.substrings is not None:
+            substrings = self.substrings
+
+            def matcher(dn, attrs, normalized=None):
+                values = attrs.get(attr)
+                return (values is not None) and \
+                    any(substrings_match(substrings, value) for value in values)
+        elif (self.value == u'*') and (normalize is not None):
+            # Normalized values are merged by case-insensitive attribute name,
+            # as they are in the presence index.
+            lower_attr = attr.lower()
+
+            def matcher(dn, attrs, normalized=None):
+                if normalized is None:
+                    normalized = rules.normalize_entry(attrs)
+                return lower_attr in normalized
         elif self.value == u'*':
-            matches = len(values) > 0
+            def matcher(dn, attrs, normalized=None):
+                values = attrs.get(attr)
+                return (values is not None) and (len(values) > 0)
+        elif normalize is not None:
+            value = normalize(self.value)
+            lower_attr = attr.lower()
+
+            def matcher(dn, attrs, normalized=None):
+                if normalized is None:
+                    normalized = rules.normalize_entry(attrs)
+                return value in normalized.get(lower_attr, ())
         else:
-            matches = self.value in values
+            value = self.value
+
+            def matcher(dn, attrs, normalized=None):
+                values = attrs.get(attr)
+                return (values is not None) and (value in values)
+
+        return matcher
+
+
+def substrings_match(substrings, value):
+    """
+    Returns True if a value matches the ``(initial, any, final)`` substrings
+    of a test, ignoring case. ``initial`` and ``final`` may be empty.
+
+    >>> substrings_match(('al', ('c',), 'e'), 'Alice')
+    True
+    >>> substrings_match(('al', ('c',), 'e'), 'Alec')
+    False
+    """
+    initial, middle, final = substrings
+    value = value.lower()
+
+    if (len(value) < len(initial) + len(final)) or \
+            not value.startswith(initial.lower()) or not value.endswith(final.lower()):
+        return False
 
-        return matches
+    pos = len(initial)
+    end = len(value) - len(final)
+    for substring in middle:
+        pos = value.find(substring.lower(), pos, end)
+        if pos < 0:
+            return False
+        pos += len(substring)
+
+    return True
+
+
+def ordering_key(value):
+    """
+    Returns the key by which a value is ordered for ``>=`` and ``<=`` tests.
+
+    Values that look like integers are ordered numerically; all others are
+    ordered as case-insensitive strings. Values of the two kinds are never
+    comparable: the first element of each key identifies its kind.
+
+    >>> ordering_key('-10') < ordering_key('9')
+    True
+    >>> ordering_key('Alice') < ordering_key('bob')
+    True
+    """
+    try:
+        key = (0, int(value))
+    except ValueError:
+        key = (1, value.lower())
+
+    return key
 
 
 # Tokens to pull out. The operators contain positive lookbehind assertions to
@@ -183,12 +383,125 @@ def gen_tokens(substrs):
 
 
 def parse(filterstr):
+    """
+    Parses a filter string into a tree of :class:`Token` objects.
+
+    Parsed trees are cached by filter string, so they must be treated as
+    read-only; they may be shared by any number of callers.
+    """
+    try:
+        filter_expr = _cache[filterstr]
+    except KeyError:
+        filter_expr = _parse(filterstr)
+        _cache[filterstr] = filter_expr
+
+    return filter_expr
+
+
+def _parse(filterstr):
+    if use_native_parser or (NoParseError is None):
+        return NativeParser(tokenize(filterstr)).parse()
+
     try:
         return ldap_filter.parse(tokenize(filterstr))
     except NoParseError, e:
         raise ldap.FILTER_ERROR(e)
 
 
+#
+# Parse cache
+#
+
+_cache = LRUCache(256)
+
+set_cache_size, clear_cache, cache_info = cache_functions(_cache, u"filters", u"filter")
+
+
+#
+# Native parser
+#
+
+class NativeParser(object):
+    """
+    A recursive-descent parser over a list of tokens.
+
+    This accepts exactly the language of :func:`grammar` and reports errors in
+    the same way: the message describes why the outermost item failed to parse
+    and the position is that of the rightmost token that was reached.
+    """
+    class Failure(Exception):
+        pass
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+        self.max = 0
+
+    def parse(self):
+        try:
+            filter_expr = self._filter()
+        except self.Failure:
+            raise ldap.FILTER_ERROR(u"%s: %s" % (self._failure_msg(), self._token_at(self.max)))
+
+        if self.pos < len(self.tokens):
+            raise ldap.FILTER_ERROR(u"should have reached <EOF>: %s" % (self._token_at(self.pos),))
+
+        return filter_expr
+
+    def _filter(self):
+        self._take(Token.LPAREN)
+        token = self._take(Token.AND, Token.OR, Token.NOT, Token.TEST)
+
+        if token.code == Token.NOT:
+            token.terms = self._filter()
+        elif token.code != Token.TEST:
+            terms = [self._filter()]
+            while self._peek() == Token.LPAREN:
+                terms.append(self._filter())
+            token.terms = tuple(terms)
+
+        self._take(Token.RPAREN)
+
+        return token
+
+    def _peek(self):
+        if self.pos < len(self.tokens):
+            code = self.tokens[self.pos].code
+        else:
+            code = None
+
+        return code
+
+    def _take(self, *codes):
+        if self._peek() not in codes:
+            raise self.Failure()
+
+        token = self.tokens[self.pos]
+        self.pos += 1
+        self.max = max(self.max, self.pos)
+
+        return token
+
+    def _failure_msg(self):
+        # The last alternative attempted at the top level is a simple test,
+        # so that determines the message.
+        for pos, code in enumerate([Token.LPAREN, Token.TEST, Token.RPAREN]):
+            if pos >= len(self.tokens):
+                return u"no tokens left in the stream"
+            elif self.tokens[pos].code != code:
+                break
+
+        return u"got unexpected token"
+
+    def _token_at(self, pos):
+        if pos < len(self.tokens):
+            token = self.tokens[pos]
+        else:
+            token = u"<EOF>"
+
+        return token
+
+
 #
 # Grammar
 #
@@ -198,7 +511,10 @@ def grammar():
     rparen = skip(a(RParen()))
 
     def collapse(t):
-        t[0].terms = t[1]
+        if isinstance(t[1], list):
+            t[0].terms = tuple(t[1])
+        else:
+            t[0].terms = t[1]
         return t[0]
 
     @with_forward_decls
@@ -213,7 +529,8 @@ def grammar():
     return ldap_filter + skip(finished)
 
 
-ldap_filter = grammar()
+if NoParseError is not None:
+    ldap_filter = grammar()
 
 
 #
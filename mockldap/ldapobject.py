@@ -1,17 +1,23 @@
 from __future__ import absolute_import
 
+from collections import deque
 from copy import deepcopy
+from itertools import chain, count, islice
+
+import threading
 
 import ldap
 from ldap.cidict import cidict
-import ldap.dn
-
-try:
-    from passlib.hash import ldap_md5_crypt
-except ImportError:
-    pass
-
+from ldap.controls import SimplePagedResultsControl
+
+from .cache import LRUCache
+from .directory import Directory
+from .dn import parse as parse_dn, split as split_dn
+from .locking import NullLock, RWLock, with_read_lock, with_write_lock
+from .matching import MatchingRules
+from .passwords import PasswordCache, verify as verify_password
 from .recording import SeedRequired, RecordableMethods, recorded
+from .recording import RESULT_DEEPCOPY, RECORD_FULL
 
 
 class LDAPObject(RecordableMethods):
@@ -19,6 +25,42 @@ class LDAPObject(RecordableMethods):
     :param directory: The initial content of this LDAP connection.
     :type directory: :class:`ldap.cidict.cidict`: ``{dn: {attr: [values]}}``
 
+    :param indexes: Names of attributes to index for equality and presence
+        tests.
+    :type indexes: list of strings
+
+    :param ordering_indexes: Names of attributes to keep sorted indexes of for
+        ``>=`` and ``<=`` tests.
+    :type ordering_indexes: list of strings
+
+    :param substring_indexes: Names of attributes to keep trigram indexes of
+        for substring tests.
+    :type substring_indexes: list of strings
+
+    :param matching_rules: Equality matching rules for particular attributes,
+        as a dictionary mapping attribute names to
+        :data:`~mockldap.matching.CASE_IGNORE`,
+        :data:`~mockldap.matching.CASE_EXACT`,
+        :data:`~mockldap.matching.INTEGER`, or
+        :data:`~mockldap.matching.DISTINGUISHED_NAME`. Values of other
+        attributes are compared exactly.
+    :type matching_rules: dict
+
+    :param password_cache: If given, up to this many results of verifying
+        hashed passwords are cached. ``None`` disables the cache.
+    :type password_cache: int
+
+    :param result_mode: How return values are copied. See
+        :meth:`~mockldap.recording.RecordableMethods.set_result_mode`.
+
+    :param recording: How much to record about calls. See
+        :meth:`~mockldap.recording.RecordableMethods.set_recording`.
+
+    :param thread_safe: If True, this object may be shared between threads.
+        Searches and other reads proceed concurrently; writes hold a lock that
+        excludes everything else. This adds a small cost to every call.
+    :type thread_safe: bool
+
     Our mock replacement for :class:`ldap.LDAPObject`. This exports selected
     LDAP operations and allows you to set return values in advance as well as
     discover which methods were called after the fact.
@@ -27,6 +69,15 @@ class LDAPObject(RecordableMethods):
     counterparts. Some are self-explanatory; those that are only partially
     implemented are documented as such.
 
+    Searches for ``(attr=value)`` or ``(attr=*)`` on an indexed attribute, or
+    for ``(attr>=value)`` or ``(attr<=value)`` on an attribute with an ordering
+    index, are answered from the index instead of examining every entry in
+    scope. Substring searches such as ``(attr=val*)`` on an attribute with a
+    substring index only examine the entries that the index can't rule out.
+    Indexes are kept up to date by the LDAP methods; if you modify
+    :attr:`~mockldap.LDAPObject.directory` entries in place, indexed searches
+    may not see the changes.
+
     Ignore the *static* annotations; that's just a Sphinx artifact.
 
     .. attribute:: options
@@ -42,22 +93,66 @@ class LDAPObject(RecordableMethods):
 
         *string*: DN of the last successful bind. None if unbound.
     """
-    def __init__(self, directory):
+    def __init__(self, directory, indexes=None, result_mode=RESULT_DEEPCOPY,
+                 recording=RECORD_FULL, thread_safe=False, ordering_indexes=None,
+                 substring_indexes=None, matching_rules=None, password_cache=None):
         if not isinstance(directory, ldap.cidict.cidict):
             from . import map_keys
             directory = cidict(map_keys(lambda s: s.lower(), directory))
 
-        self.directory = deepcopy(directory)
-        self.async_results = []
+        wanted = [indexes, ordering_indexes, substring_indexes]
+        if matching_rules is not None:
+            matching_rules = MatchingRules(matching_rules) or None
+
+        # Directories are copy-on-write, so this is cheap unless we need to
+        # build different indexes or normalize values differently.
+        if isinstance(directory, Directory):
+            existing = [directory.indexes, directory.ordering_indexes, directory.substring_indexes]
+            wanted = [attrs if (attrs is not None) else index.keys()
+                      for attrs, index in zip(wanted, existing)]
+            if matching_rules is None:
+                matching_rules = directory.matching_rules
+
+        if isinstance(directory, Directory) and (matching_rules == directory.matching_rules) and \
+                all(set(attrs) == set(index) for attrs, index in zip(wanted, existing)):
+            self.directory = directory.snapshot()
+        else:
+            self.directory = Directory(directory, *wanted, matching_rules=matching_rules)
+        self.async_results = {}
+        # Msgids in the order they were issued, so RES_ANY can take the oldest
+        # outstanding result. Retrieved msgids are skipped over lazily.
+        self._msgid_order = deque()
+        self._msgids = count()
+        self.thread_safe = thread_safe
+        if thread_safe:
+            self._lock = RWLock()
+            self._mutex = threading.Lock()
+        else:
+            self._lock = NullLock()
+        self._password_cache = PasswordCache(password_cache) if (password_cache is not None) else None
+        self._paged_searches = LRUCache(MAX_PAGED_SEARCHES)
+        self._cookies = count(1)
         self.options = {}
         self.tls_enabled = False
         self.bound_as = None
 
+        self.set_result_mode(result_mode)
+        self.set_recording(recording)
+
+    @with_read_lock
+    def explain(self, base, scope, filterstr='(objectClass=*)'):
+        """
+        Describes how a search with these arguments would be carried out:
+        which indexes would supply candidate entries, how they would be
+        combined, and what part of the filter would be evaluated against each
+        candidate. This is not recorded.
+        """
+        self._check_valid_dn(base)
+
+        return self._plan_search(base, scope, filterstr).describe()
+
     def _check_valid_dn(self, dn):
-        try:
-            ldap.dn.str2dn(dn)
-        except ldap.DECODING_ERROR:
-            raise ldap.INVALID_DN_SYNTAX
+        parse_dn(dn)
 
     #
     # Begin LDAP methods
@@ -80,52 +175,158 @@ class LDAPObject(RecordableMethods):
         """
         self.options[option] = invalue
 
+    @recorded
+    def simple_bind(self, who='', cred=''):
+        """
+        The asynchronous form of :meth:`~mockldap.LDAPObject.simple_bind_s`.
+        As with the other asynchronous operations, errors are raised by
+        :meth:`~mockldap.LDAPObject.result`.
+        """
+        return self._async_result(ldap.RES_BIND, self._simple_bind_s, who, cred)
+
     @recorded
     def simple_bind_s(self, who='', cred=''):
         """
         """
-        success = False
+        return self._simple_bind_s(who, cred)
+
+    @recorded
+    def search(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0):
+        """
+        See :meth:`~mockldap.LDAPObject.search_s`. As with python-ldap,
+        errors in the arguments, such as :exc:`ldap.FILTER_ERROR`, are raised
+        immediately. Errors from the search itself, such as
+        :exc:`ldap.NO_SUCH_OBJECT`, are raised by
+        :meth:`~mockldap.LDAPObject.result`.
+        """
+        self._check_search_args(base, filterstr)
 
         try:
-            if(who == '' and cred == ''):
-                success = True
-            elif self._compare_s(who, 'userPassword', cred):
-                success = True
-        except ldap.NO_SUCH_OBJECT:
-            pass
+            value = self._search_s(base, scope, filterstr, attrlist, attrsonly)
+        except SEARCH_RESULT_ERRORS, e:
+            return self._add_async_result([], error=e)
 
-        if success:
-            self.bound_as = who
-            return (97, [])
-        else:
-            raise ldap.INVALID_CREDENTIALS('%s:%s' % (who, cred))
+        return self._add_async_result(value)
 
     @recorded
-    def search(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0):
+    def result(self, msgid=ldap.RES_ANY, all=1, timeout=None):
         """
-        See :meth:`~mockldap.LDAPObject.search_s`.
+        Retrieves the result of an asynchronous operation. ``msgid`` may be
+        :data:`ldap.RES_ANY` to retrieve the oldest outstanding result.
+
+        With ``all=0``, search results are returned one entry at a time as
+        :data:`ldap.RES_SEARCH_ENTRY`, followed by a final
+        :data:`ldap.RES_SEARCH_RESULT` with no entries. Results are
+        discarded once they have been retrieved in full. An unknown
+        ``msgid`` returns None in place of the result data.
         """
-        value = self._search_s(base, scope, filterstr, attrlist, attrsonly)
+        return self._pop_async_result(msgid, all)[:2]
 
-        return self._add_async_result(value)
+    @recorded
+    def result3(self, msgid=ldap.RES_ANY, all=1, timeout=None):
+        """
+        Like :meth:`~mockldap.LDAPObject.result`, but returns
+        ``(result_type, data, msgid, serverctrls)``.
+        """
+        return self._pop_async_result(msgid, all)
+
+    @recorded
+    def abandon(self, msgid):
+        """
+        Discards the result of an outstanding asynchronous operation. If it's
+        a page of a paged search, the rest of the search is discarded as well.
+        """
+        with self._mutex:
+            result = self._forget_async_result(msgid)
+            if result is not None:
+                for control in result[2]:
+                    if (control.controlType == SimplePagedResultsControl.controlType) and \
+                            (control.cookie in self._paged_searches):
+                        del self._paged_searches[control.cookie]
 
     @recorded
-    def result(self, msgid, all=1, timeout=None):
+    def abandon_ext(self, msgid, serverctrls=None, clientctrls=None):
         """
+        See :meth:`~mockldap.LDAPObject.abandon`. Controls are ignored.
         """
-        return ldap.RES_SEARCH_RESULT, self._pop_async_result(msgid)
+        self.abandon(msgid)
 
     @recorded
     def search_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0):
         """
         Supports many, but not all, filter strings.
 
-        Tests of the form ``'(foo=bar)'`` and ``'(foo=\*)'`` are supported, as
-        are the &, \|, and !  operators. attrlist and attrsonly are also
-        supported. Beyond that, this method must be seeded.
+        Tests of the form ``'(foo=bar)'``, ``'(foo=\*)'``, ``'(foo=b\*r)'``,
+        ``'(foo>=bar)'``, and ``'(foo<=bar)'`` are supported, as are the &,
+        \|, and ! operators. Substring tests ignore case. Ordering tests
+        compare integers numerically and anything else as case-insensitive
+        strings. Beyond that, this method must be seeded.
+
+        attrlist and attrsonly are also supported. Attribute names in attrlist
+        are matched without regard to case, and it may include ``'*'`` for
+        all user attributes, ``'+'`` for all operational attributes, or just
+        ``'1.1'`` for no attributes.
         """
         return self._search_s(base, scope, filterstr, attrlist, attrsonly)
 
+    @recorded
+    def search_ext(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0,
+                   serverctrls=None, clientctrls=None, timeout=-1, sizelimit=0):
+        """
+        Like :meth:`~mockldap.LDAPObject.search`, with support for
+        ``sizelimit`` and for :class:`ldap.controls.SimplePagedResultsControl`.
+
+        Each page of a paged search picks up where the previous one left off;
+        the cookie in the response control returned by
+        :meth:`~mockldap.LDAPObject.result3` identifies the search. Paged
+        searches see the directory as it was when the first page was
+        requested. If a search finds more than ``sizelimit`` entries,
+        :exc:`ldap.SIZELIMIT_EXCEEDED` is raised when the result is
+        retrieved, as are other errors from the search itself. Errors in the
+        arguments, including an invalid paged results cookie, are raised
+        immediately. Other critical controls require seeding.
+        """
+        self._check_search_args(base, filterstr)
+
+        try:
+            entries, controls, error = self._search_ext(base, scope, filterstr, attrlist, attrsonly,
+                                                        serverctrls, sizelimit)
+        except SEARCH_RESULT_ERRORS, e:
+            entries, controls, error = ([], [], e)
+
+        return self._add_async_result(entries, controls=controls, error=error)
+
+    @recorded
+    def search_ext_s(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0,
+                     serverctrls=None, clientctrls=None, timeout=-1, sizelimit=0):
+        """
+        See :meth:`~mockldap.LDAPObject.search_ext`. As with python-ldap, any
+        response controls are discarded.
+        """
+        entries, controls, error = self._search_ext(base, scope, filterstr, attrlist, attrsonly,
+                                                    serverctrls, sizelimit)
+        if error is not None:
+            raise error
+
+        return entries
+
+    @recorded
+    def search_iter(self, base, scope, filterstr='(objectClass=*)', attrlist=None, attrsonly=0):
+        """
+        Like :meth:`~mockldap.LDAPObject.search_s`, but returns an iterator
+        that finds the results as it goes. Errors in the arguments are raised
+        immediately; :exc:`ldap.REFERRAL` is raised when a referral is
+        reached. The directory must not be modified until the iterator is
+        exhausted, except in thread-safe mode, where the search runs against
+        a snapshot of the directory.
+
+        This isn't part of python-ldap. It's for tests that search very large
+        directories and only need some of the results.
+        """
+        directory = self._snapshot() if self.thread_safe else None
+
+        return self._search_iter(base, scope, filterstr, attrlist, attrsonly, directory)
+
     @recorded
     def start_tls_s(self):
         """
@@ -138,30 +339,74 @@ class LDAPObject(RecordableMethods):
         """
         return self._compare_s(dn, attr, value)
 
+    @recorded
+    def compare(self, dn, attr, value):
+        """
+        The asynchronous form of :meth:`~mockldap.LDAPObject.compare_s`.
+        :meth:`~mockldap.LDAPObject.result` raises :exc:`ldap.COMPARE_TRUE`
+        or :exc:`ldap.COMPARE_FALSE`, as python-ldap does.
+        """
+        try:
+            matched = self._compare_s(dn, attr, value)
+        except ldap.LDAPError, e:
+            error = e
+        else:
+            error = (ldap.COMPARE_TRUE if matched else ldap.COMPARE_FALSE)({})
+
+        return self._add_async_result([], ldap.RES_COMPARE, error=error)
+
     @recorded
     def modify_s(self, dn, mod_attrs):
         """
         """
         return self._modify_s(dn, mod_attrs)
 
+    @recorded
+    def modify(self, dn, mod_attrs):
+        """
+        The asynchronous form of :meth:`~mockldap.LDAPObject.modify_s`.
+        """
+        return self._async_result(ldap.RES_MODIFY, self._modify_s, dn, mod_attrs)
+
     @recorded
     def add_s(self, dn, record):
         """
         """
         return self._add_s(dn, record)
 
+    @recorded
+    def add(self, dn, record):
+        """
+        The asynchronous form of :meth:`~mockldap.LDAPObject.add_s`.
+        """
+        return self._async_result(ldap.RES_ADD, self._add_s, dn, record)
+
     @recorded
     def rename_s(self, dn, newrdn, newsuperior=None):
         """
         """
         return self._rename_s(dn, newrdn, newsuperior)
 
+    @recorded
+    def rename(self, dn, newrdn, newsuperior=None):
+        """
+        The asynchronous form of :meth:`~mockldap.LDAPObject.rename_s`.
+        """
+        return self._async_result(ldap.RES_MODRDN, self._rename_s, dn, newrdn, newsuperior)
+
     @recorded
     def delete_s(self, dn):
         """
         """
         return self._delete_s(dn)
 
+    @recorded
+    def delete(self, dn):
+        """
+        The asynchronous form of :meth:`~mockldap.LDAPObject.delete_s`.
+        """
+        return self._async_result(ldap.RES_DELETE, self._delete_s, dn)
+
     @recorded
     def unbind(self):
         """
@@ -184,119 +429,272 @@ class LDAPObject(RecordableMethods):
     # Internal implementations
     #
 
+    def _simple_bind_s(self, who, cred):
+        success = False
+
+        try:
+            if(who == '' and cred == ''):
+                success = True
+            elif self._compare_s(who, 'userPassword', cred):
+                success = True
+        except ldap.NO_SUCH_OBJECT:
+            pass
+
+        if success:
+            self.bound_as = who
+            return (97, [])
+        else:
+            raise ldap.INVALID_CREDENTIALS('%s:%s' % (who, cred))
+
+    @with_read_lock
     def _compare_s(self, dn, attr, value):
         self._check_valid_dn(dn)
 
         try:
-            values = self.directory[dn].get(attr, [])
+            values = self.directory.peek(dn).get(attr, [])
         except KeyError:
             raise ldap.NO_SUCH_OBJECT
 
         if attr == 'userPassword':
             for password in values:
-                try:
-                    if ldap_md5_crypt.verify(value, password):
-                        return 1
-                except (NameError, ValueError):
-                    pass
+                if self._verify_password(dn, value, password):
+                    return 1
 
-        return (1 if (value in values) else 0)
+        return (1 if self.directory.has_value(dn, attr, value) else 0)
 
+    def _verify_password(self, dn, cred, password):
+        if self._password_cache is None:
+            verified = verify_password(cred, password)
+        else:
+            verified = self._password_cache.verify(dn, cred, password)
+
+        return verified
+
+    def _invalidate_passwords(self, dn):
+        if self._password_cache is not None:
+            self._password_cache.invalidate(dn)
+
+    @with_read_lock
     def _search_s(self, base, scope, filterstr, attrlist, attrsonly):
-        from .filter import parse, UnsupportedOp
+        return list(self._search_iter(base, scope, filterstr, attrlist, attrsonly))
+
+    def _search_iter(self, base, scope, filterstr, attrlist, attrsonly, directory=None):
+        if directory is None:
+            directory = self.directory
 
         self._check_valid_dn(base)
 
-        if base not in self.directory:
+        if base not in directory:
             raise ldap.NO_SUCH_OBJECT
 
-        # Find directory entries within the requested scope
-        base_parts = ldap.dn.explode_dn(base.lower())
-        base_len = len(base_parts)
-        dn_parts = dict((dn, ldap.dn.explode_dn(dn)) for dn in self.directory.iterkeys())
-
-        if scope == ldap.SCOPE_BASE:
-            dns = (dn for dn, parts in dn_parts.iteritems() if parts == base_parts)
-        elif scope == ldap.SCOPE_ONELEVEL:
-            dns = (dn for dn, parts in dn_parts.iteritems() if parts[1:] == base_parts)
-        elif scope == ldap.SCOPE_SUBTREE:
-            dns = (dn for dn, parts in dn_parts.iteritems() if parts[-base_len:] == base_parts)
-        else:
-            raise ValueError(u"Unrecognized scope: {0}".format(scope))
+        # Find matching directory entries within the requested scope
+        plan = self._plan_search(base, scope, filterstr, directory)
+
+        return self._search_results(plan.dns(directory), directory,
+                                    projection(attrlist, attrsonly))
+
+    def _search_results(self, dns, directory, project):
+        """
+        Generates search results, checking for referrals and selecting
+        attributes in the same pass.
+        """
+        peek = directory.peek
+
+        for dn in dns:
+            attrs = peek(dn)
+
+            if '_referral' in attrs:
+                referral_info = {
+                    'info': 'Referral:\n' + attrs['_referral'],
+                    'desc': 'Referral'
+                }
+                raise ldap.REFERRAL(referral_info)
+
+            if project is not None:
+                attrs = project(attrs)
+
+            yield (dn, attrs)
+
+    def _plan_search(self, base, scope, filterstr, directory=None):
+        from .planner import plan_search
+
+        filter_expr = self._parse_filter(filterstr)
+
+        return plan_search(directory or self.directory, filter_expr, base, scope)
+
+    def _parse_filter(self, filterstr):
+        from .filter import parse, UnsupportedOp
 
-        # Apply the filter expression
         try:
             filter_expr = parse(filterstr)
         except UnsupportedOp, e:
             raise SeedRequired(e)
 
-        results = ((dn, self.directory[dn]) for dn in dns
-                   if filter_expr.matches(dn, self.directory[dn]))
+        return filter_expr
+
+    def _check_search_args(self, base, filterstr):
+        """
+        Raises the errors that python-ldap raises before an asynchronous
+        search is sent. Parsed filters are cached, so this costs little.
+        """
+        self._check_valid_dn(base)
+        self._parse_filter(filterstr)
+
+    def _search_ext(self, base, scope, filterstr, attrlist, attrsonly, serverctrls, sizelimit):
+        """
+        Returns ``(entries, controls, error)`` for one search or one page of a
+        paged search.
+        """
+        paging = None
+        for control in serverctrls or ():
+            if control.controlType == SimplePagedResultsControl.controlType:
+                paging = control
+            elif control.criticality:
+                raise SeedRequired("Unsupported critical control: %s" % (control.controlType,))
+
+        if paging is None:
+            with self._lock.reading():
+                results = self._search_iter(base, scope, filterstr, attrlist, attrsonly)
+                entries, rest, error = self._take_results(results, None, sizelimit, 0)
+            return (entries, [], error)
+
+        if paging.cookie:
+            try:
+                with self._mutex:
+                    results, returned = self._paged_searches[paging.cookie]
+                    del self._paged_searches[paging.cookie]
+            except KeyError:
+                raise ldap.PROTOCOL_ERROR({'desc': 'Protocol error',
+                                           'info': 'paged results cookie is invalid'})
+        else:
+            # Page through a snapshot, so that the scope walk survives any
+            # changes between pages.
+            results = self._search_iter(base, scope, filterstr, attrlist, attrsonly,
+                                        self._snapshot())
+            returned = 0
+
+        # A page size of zero abandons the search.
+        if paging.size:
+            entries, rest, error = self._take_results(results, paging.size, sizelimit, returned)
+        else:
+            entries, rest, error = ([], None, None)
+
+        cookie = ''
+        if rest is not None:
+            cookie = str(self._cookies.next())
+            with self._mutex:
+                self._paged_searches[cookie] = (rest, returned + len(entries))
 
-        # Apply attribute filtering, if any
-        if attrlist is not None:
-            results = ((dn, dict((attr, values) for attr, values in attrs.iteritems() if attr in attrlist))
-                       for dn, attrs in results)
+        return (entries, [SimplePagedResultsControl(False, 0, cookie)], error)
 
-        if attrsonly:
-            results = ((dn, dict((attr, []) for attr in attrs.iterkeys()))
-                       for dn, attrs in results)
+    def _writable_entry(self, dn):
+        """
+        Returns a directory entry to be modified in place. In thread-safe mode,
+        this is always a new copy, since other threads may still be reading
+        search results that refer to the current one.
+        """
+        if self.thread_safe:
+            self.directory[dn] = deepcopy(self.directory.peek(dn))
 
-        results_list = list(results)
-        for result in results_list:
-            if '_referral' in result[1]:
-                referral_info = {
-                    'info': 'Referral:\n' + result[1]['_referral'],
-                    'desc': 'Referral'
-                }
-                raise ldap.REFERRAL(referral_info)
+        return self.directory[dn]
 
-        return results_list
+    def _snapshot(self):
+        with self._lock.reading():
+            return self.directory.snapshot()
+
+    def _changed(self):
+        """
+        Called after every change to the directory. Snapshots copy the changes
+        made since the directory was last frozen, so we refreeze it once there
+        are enough of them.
+        """
+        self.directory.freeze(FREEZE_FRACTION)
 
+    def _take_results(self, results, count, sizelimit, returned):
+        """
+        Takes up to ``count`` results (or all of them if ``count`` is None),
+        subject to a ``sizelimit`` of which ``returned`` have already been
+        used. Returns ``(entries, rest, error)``, where ``rest`` is an
+        iterator over the remaining results or None if there are none.
+        """
+        if sizelimit:
+            remaining = max(sizelimit - returned, 0)
+            if (count is None) or (count > remaining):
+                entries = list(islice(results, remaining + 1))
+                if len(entries) > remaining:
+                    error = ldap.SIZELIMIT_EXCEEDED({'desc': 'Size limit exceeded'})
+                    return (entries[:remaining], None, error)
+
+                return (entries, None, None)
+
+        if count is None:
+            return (list(results), None, None)
+
+        # Look one past the end of the page to see whether there's more.
+        entries = list(islice(results, count + 1))
+        if len(entries) > count:
+            rest = chain(entries[count:], results)
+            entries = entries[:count]
+        else:
+            rest = None
+
+        return (entries, rest, None)
+
+    @with_write_lock
     def _modify_s(self, dn, mod_attrs):
         self._check_valid_dn(dn)
 
-        for item in mod_attrs:
-            op, key, value = item
+        # Modifications that were applied before an error are kept, so the
+        # indexes must be brought up to date either way.
+        try:
+            for item in mod_attrs:
+                op, key, value = item
 
-            try:
-                entry = self.directory[dn]
-            except KeyError:
-                raise ldap.NO_SUCH_OBJECT
-
-            if value is None:
-                value = []
-            elif type(value) is str:
-                value = [value]
-
-            if op == ldap.MOD_ADD:
-                if value == []:
-                    raise ldap.PROTOCOL_ERROR
-
-                if key not in entry:
-                    entry[key] = value
-                else:
-                    for subvalue in value:
-                        if subvalue not in entry[key]:
-                            entry[key].append(subvalue)
-            elif op == ldap.MOD_DELETE:
-                if key not in entry:
-                    pass
-                elif value == []:
-                    del entry[key]
-                else:
-                    entry[key] = [v for v in entry[key] if v not in value]
-                    if entry[key] == []:
-                        del entry[key]
-            elif op == ldap.MOD_REPLACE:
-                if value == []:
-                    if key in entry:
+                try:
+                    entry = self._writable_entry(dn)
+                except KeyError:
+                    raise ldap.NO_SUCH_OBJECT
+
+                if value is None:
+                    value = []
+                elif type(value) is str:
+                    value = [value]
+
+                if op == ldap.MOD_ADD:
+                    if value == []:
+                        raise ldap.PROTOCOL_ERROR
+
+                    if key not in entry:
+                        entry[key] = value
+                    else:
+                        for subvalue in value:
+                            if subvalue not in entry[key]:
+                                entry[key].append(subvalue)
+                elif op == ldap.MOD_DELETE:
+                    if key not in entry:
+                        pass
+                    elif value == []:
                         del entry[key]
-                else:
-                    entry[key] = value
+                    else:
+                        entry[key] = [v for v in entry[key] if v not in value]
+                        if entry[key] == []:
+                            del entry[key]
+                elif op == ldap.MOD_REPLACE:
+                    if value == []:
+                        if key in entry:
+                            del entry[key]
+                    else:
+                        entry[key] = value
+
+                if key.lower() == 'userpassword':
+                    self._invalidate_passwords(dn)
+        finally:
+            self.directory.reindex(dn)
+            self._changed()
 
         return (103, [])
 
+    @with_write_lock
     def _add_s(self, dn, record):
         self._check_valid_dn(dn)
 
@@ -305,12 +703,14 @@ class LDAPObject(RecordableMethods):
         for item in record:
             entry[item[0]] = list(item[1])
         try:
-            self.directory[dn]
+            self.directory.peek(dn)
             raise ldap.ALREADY_EXISTS
         except KeyError:
             self.directory[dn] = entry
-            return (105, [], len(self.methods_called()), [])
+            self._changed()
+            return (105, [], self.total_calls(), [])
 
+    @with_write_lock
     def _rename_s(self, dn, newrdn, newsuperior):
         self._check_valid_dn(dn)
         self._check_valid_dn(newrdn)
@@ -318,35 +718,47 @@ class LDAPObject(RecordableMethods):
             self._check_valid_dn(newsuperior)
 
         try:
-            entry = self.directory[dn]
+            entry = self.directory.peek(dn)
         except KeyError:
             raise ldap.NO_SUCH_OBJECT
 
         if newsuperior:
             superior = newsuperior
         else:
-            superior = ','.join(dn.split(',')[1:])
+            superior = split_dn(dn)[1]
 
         newfulldn = '%s,%s' % (newrdn, superior)
-        oldattr, oldvalue = dn.split(',')[0].split('=')
-        newattr, newvalue = newrdn.split('=')
+        oldattr, oldvalue = parse_dn(dn).rdns[0][0][:2]
+        newattr, newvalue = parse_dn(newrdn).rdns[0][0][:2]
 
-        try:
-            if newvalue not in entry[newattr]:
-                entry[newattr].append(newvalue)
-        except KeyError:
-            entry[newattr] = [newvalue]
+        # Work out the new RDN values before changing anything, so that the
+        # entry and its indexes are left alone if they can't be found.
+        changes = {newattr: list(entry.get(newattr, []))}
+        if newvalue not in changes[newattr]:
+            changes[newattr].append(newvalue)
 
         if oldattr == newattr or len(entry[oldattr]) > 1:
-            entry[oldattr].remove(oldvalue)
+            values = changes.get(oldattr) or list(entry[oldattr])
+            values.remove(oldvalue)
+            changes[oldattr] = values
         else:
-            del entry[oldattr]
+            changes[oldattr] = None
+
+        entry = self._writable_entry(dn)
+        for attr, values in changes.iteritems():
+            if values is None:
+                del entry[attr]
+            else:
+                entry[attr] = values
 
         self.directory[newfulldn] = entry
         del self.directory[dn]
+        self._changed()
+        self._invalidate_passwords(dn)
 
         return (109, [])
 
+    @with_write_lock
     def _delete_s(self, dn):
         self._check_valid_dn(dn)
 
@@ -355,22 +767,179 @@ class LDAPObject(RecordableMethods):
         except KeyError:
             raise ldap.NO_SUCH_OBJECT
 
+        self._changed()
+        self._invalidate_passwords(dn)
+
         return (107, [])
 
     #
     # Async
     #
 
-    def _add_async_result(self, value):
-        self.async_results.append(value)
+    def _add_async_result(self, value, result_type=ldap.RES_SEARCH_RESULT,
+                          controls=(), error=None):
+        """
+        Stores the result of an asynchronous operation and returns its msgid.
+        If ``error`` is given, it is raised once any entries in ``value`` have
+        been retrieved.
+        """
+        with self._mutex:
+            msgid = self._msgids.next()
+            self.async_results[msgid] = (result_type, deque(value), list(controls), error)
+            self._msgid_order.append(msgid)
 
-        return len(self.async_results) - 1
+        return msgid
 
-    def _pop_async_result(self, msgid):
-        if msgid in xrange(len(self.async_results)):
-            value = self.async_results[msgid]
-            self.async_results[msgid] = None
+    def _async_result(self, result_type, func, *args):
+        """
+        Performs an operation immediately and stores its outcome for
+        :meth:`result`. LDAP errors are deferred until the result is
+        retrieved.
+        """
+        try:
+            func(*args)
+        except ldap.LDAPError, e:
+            msgid = self._add_async_result([], result_type, error=e)
+        else:
+            msgid = self._add_async_result([], result_type)
+
+        return msgid
+
+    def _pop_async_result(self, msgid, all=1):
+        """
+        Returns ``(result_type, data, msgid, controls)`` for an outstanding
+        asynchronous operation.
+        """
+        with self._mutex:
+            if (msgid == ldap.RES_ANY) and self.async_results:
+                order = self._msgid_order
+                while order[0] not in self.async_results:
+                    order.popleft()
+                msgid = order[0]
+
+            try:
+                result_type, entries, controls, error = self.async_results[msgid]
+            except KeyError:
+                return (ldap.RES_SEARCH_RESULT, None, msgid, [])
+
+            if (not all) and (result_type == ldap.RES_SEARCH_RESULT) and entries:
+                return (ldap.RES_SEARCH_ENTRY, [entries.popleft()], msgid, [])
+
+            self._forget_async_result(msgid)
+
+        if error is not None:
+            raise error
+
+        return (result_type, list(entries), msgid, controls)
+
+    def _forget_async_result(self, msgid):
+        """
+        Removes an outstanding result, returning it or None if there isn't
+        one. The caller must hold ``self._mutex``.
+        """
+        result = self.async_results.pop(msgid, None)
+
+        # Results retrieved out of order leave their msgids behind; once those
+        # outnumber the outstanding ones, it's cheaper to start over.
+        order = self._msgid_order
+        if order and (order[0] == msgid):
+            order.popleft()
+        elif len(order) > 2 * len(self.async_results) + 32:
+            self._msgid_order = deque(m for m in order if m in self.async_results)
+
+        return result
+
+
+# Errors from an asynchronous search that are raised by result() rather than
+# when the search is started.
+SEARCH_RESULT_ERRORS = (ldap.NO_SUCH_OBJECT, ldap.REFERRAL)
+
+
+# The directory is refrozen once its changes outnumber this fraction of its
+# content, so a snapshot never copies more than this fraction of the directory
+# and refreezing costs a constant amount per change on average.
+FREEZE_FRACTION = 0.125
+
+
+# The most paged searches that may be left unfinished at once. Beyond this, the
+# least recently continued searches are discarded and their cookies become
+# invalid.
+MAX_PAGED_SEARCHES = 100
+
+
+# Attributes that are only returned if they're requested by name or with +.
+OPERATIONAL_ATTRIBUTES = frozenset([
+    'createtimestamp', 'modifytimestamp', 'creatorsname', 'modifiersname',
+    'subschemasubentry', 'structuralobjectclass', 'governingstructurerule',
+    'hassubordinates', 'numsubordinates', 'entrydn', 'entryuuid', 'entrycsn',
+])
+
+
+def projection(attrlist, attrsonly):
+    """
+    Returns a function that selects the attributes of an entry that a search
+    should return, or None if entries are returned as they are.
+
+    Attribute names are matched without regard to case. ``*`` selects all
+    user attributes, ``+`` all operational attributes, and ``1.1`` on its own
+    selects nothing. No attrlist selects everything.
+    """
+    if attrlist:
+        names = frozenset(attr.lower() for attr in attrlist)
+    else:
+        names = None
+
+    if names is None:
+        select = None
+    elif names == frozenset(['1.1']):
+        select = lambda attr: False
+    elif ('*' in names) or ('+' in names):
+        user = ('*' in names)
+        operational = ('+' in names)
+
+        def select(attr):
+            attr = attr.lower()
+            if attr in OPERATIONAL_ATTRIBUTES:
+                selected = operational or (attr in names)
+            else:
+                selected = user or (attr in names)
+            return selected
+    else:
+        select = lambda attr: attr.lower() in names
+
+    if select is None:
+        project = (lambda attrs: dict((attr, []) for attr in attrs)) if attrsonly else None
+    else:
+        project = _Projection(select, attrsonly)
+
+    return project
+
+
+class _Projection(object):
+    """
+    Selects attributes from entries. Entries tend to share attribute names, so
+    each name is only examined once per search and the rest of the work is
+    done with set operations.
+    """
+    def __init__(self, select, attrsonly):
+        self.select = select
+        self.attrsonly = attrsonly
+        self.seen = set()
+        self.selected = set()
+
+    def __call__(self, attrs):
+        if not self.seen.issuperset(attrs):
+            new = set(attrs).difference(self.seen)
+            self.seen.update(new)
+            self.selected.update(attr for attr in new if self.select(attr))
+
+        if self.attrsonly:
+            projected = dict((attr, []) for attr in self.selected if attr in attrs)
+        elif len(self.selected) == len(self.seen):
+            # Every attribute is selected, so the entry can be returned as it
+            # is, just like a search without an attrlist.
+            projected = attrs
         else:
-            value = None
+            projected = dict((attr, attrs[attr]) for attr in self.selected if attr in attrs)
 
-        return value
+        return projected
@@ -0,0 +1,167 @@
+"""
+Loading directory content from LDIF and from snapshots.
+"""
+from __future__ import absolute_import
+
+from collections import namedtuple
+import cPickle
+import time
+
+import ldap
+from ldif import LDIFParser
+
+from .dn import parse as parse_dn
+
+
+SNAPSHOT_VERSION = 1
+
+
+class LoadInfo(namedtuple('LoadInfo', ['entries', 'seconds'])):
+    """
+    The number of entries loaded and the time it took.
+    """
+    __slots__ = ()
+
+    @property
+    def rate(self):
+        """
+        Entries loaded per second.
+        """
+        return (self.entries / self.seconds) if self.seconds else float(self.entries)
+
+
+class DirectoryLoader(LDIFParser):
+    """
+    Stores each LDIF record in a :class:`~mockldap.directory.Directory` as it
+    is parsed.
+
+    Every DN is validated with :func:`mockldap.dn.parse`. Invalid DNs raise
+    :exc:`ldap.INVALID_DN_SYNTAX` and repeated DNs raise
+    :exc:`ldap.ALREADY_EXISTS`.
+    """
+    def __init__(self, input_file, directory):
+        LDIFParser.__init__(self, input_file)
+        self.directory = directory
+        self.entries = 0
+
+    def handle(self, dn, entry):
+        try:
+            parse_dn(dn)
+        except ldap.INVALID_DN_SYNTAX:
+            raise ldap.INVALID_DN_SYNTAX({'desc': 'Invalid DN syntax', 'info': dn})
+
+        key = dn.lower()
+        if key in self.directory:
+            raise ldap.ALREADY_EXISTS({'desc': 'Already exists', 'info': dn})
+
+        self.directory[key] = entry
+        self.entries += 1
+
+
+def load_ldif(ldif_file, directory):
+    """
+    Streams the records in an LDIF file into a
+    :class:`~mockldap.directory.Directory` and returns a :class:`LoadInfo`.
+    """
+    start = time.time()
+
+    loader = DirectoryLoader(ldif_file, directory)
+    loader.parse()
+    directory.freeze()
+
+    return LoadInfo(loader.entries, time.time() - start)
+
+
+def save_snapshot(directory, snapshot_file):
+    """
+    Writes a :class:`~mockldap.directory.Directory` to a file, along with its
+    normalized keys, DN tree, and indexes.
+    """
+    directory.freeze()
+
+    tree = directory.tree
+    state = {
+        'data': directory.data.base,
+        'keys': directory._keys.base,
+        'tree': (tree.entries.base, tree.children.base, tree.nodes.base),
+        'indexes': dict((attr, (index.values.base, index.entries.base))
+                        for attr, index in directory.indexes.iteritems()),
+        'ordering_indexes': dict((attr, (index.keys, index.dns, index.entries.base))
+                                 for attr, index in directory.ordering_indexes.iteritems()),
+        'substring_indexes': dict((attr, (index.grams.base, index.entries.base))
+                                  for attr, index in directory.substring_indexes.iteritems()),
+        'matching_rules': _rules(directory),
+        'normalized': directory.normalized.entries.base if directory.normalized else None,
+    }
+
+    cPickle.dump((SNAPSHOT_VERSION, state), snapshot_file, cPickle.HIGHEST_PROTOCOL)
+
+
+def load_snapshot(snapshot_file, directory):
+    """
+    Restores a snapshot written by :func:`save_snapshot` into an empty
+    :class:`~mockldap.directory.Directory` and returns a :class:`LoadInfo`.
+
+    Indexes saved with the snapshot are reused if the directory asks for them
+    and, for equality indexes, uses the same matching rules; any others that
+    it asks for are built from the entries. Snapshots are
+    pickles, so only load them from trusted sources.
+    """
+    start = time.time()
+
+    version, state = cPickle.load(snapshot_file)
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(u"Unsupported snapshot version: {0}".format(version))
+
+    directory.data.base = state['data']
+    directory._keys.base = state['keys']
+    tree = directory.tree
+    tree.entries.base, tree.children.base, tree.nodes.base = state['tree']
+
+    # Equality indexes and normalized values depend on the matching rules.
+    if state.get('matching_rules', {}) == _rules(directory):
+        indexes = state['indexes']
+        normalized = state.get('normalized')
+    else:
+        indexes = {}
+        normalized = None
+
+    if directory.normalized is not None:
+        if normalized is not None:
+            directory.normalized.entries.base = normalized
+        else:
+            _build_index(directory.normalized, directory)
+
+    for attr, index in directory.indexes.iteritems():
+        try:
+            index.values.base, index.entries.base = indexes[attr]
+        except KeyError:
+            _build_index(index, directory, directory.normalized)
+
+    for attr, index in directory.ordering_indexes.iteritems():
+        try:
+            index.keys, index.dns, index.entries.base = state.get('ordering_indexes', {})[attr]
+        except KeyError:
+            _build_index(index, directory)
+
+    for attr, index in directory.substring_indexes.iteritems():
+        try:
+            index.grams.base, index.entries.base = state.get('substring_indexes', {})[attr]
+        except KeyError:
+            _build_index(index, directory)
+
+    return LoadInfo(len(directory), time.time() - start)
+
+
+def _rules(directory):
+    return directory.matching_rules.rules if directory.matching_rules else {}
+
+
+def _build_index(index, directory, normalized=None):
+    for key, entry in directory.data.iteritems():
+        if normalized is None:
+            index.add(key, entry)
+        else:
+            index.add(key, entry, normalized.get(key))
+
+    index.freeze()
@@ -0,0 +1,157 @@
+"""
+Locks for the optional thread-safe mode.
+"""
+from __future__ import with_statement
+
+from functools import wraps
+import thread
+import threading
+
+
+class NullLock(object):
+    """
+    Stands in for both a mutex and a :class:`RWLock` when thread safety isn't
+    needed.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def reading(self):
+        return self
+
+    def writing(self):
+        return self
+
+
+class RWLock(object):
+    """
+    A reader/writer lock. Any number of threads may hold it for reading at
+    once; a thread holding it for writing excludes all others.
+
+    Both sides are reentrant, and a thread holding the lock for writing may
+    also acquire it for reading. A thread holding the lock only for reading
+    can't upgrade it. Waiting writers take priority over threads that don't
+    already hold the lock, so a steady stream of readers can't starve them.
+
+    >>> lock = RWLock()
+    >>> with lock.writing():
+    ...     with lock.reading():
+    ...         pass
+    >>> with lock.reading():
+    ...     lock.acquire_write()
+    Traceback (most recent call last):
+        ...
+    RuntimeError: Can't upgrade a read lock to a write lock
+    """
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = {}
+        self._writer = None
+        self._writes = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        me = thread.get_ident()
+
+        with self._cond:
+            if (self._writer != me) and (me not in self._readers):
+                while (self._writer is not None) or self._waiting_writers:
+                    self._cond.wait()
+
+            self._readers[me] = self._readers.get(me, 0) + 1
+
+    def release_read(self):
+        me = thread.get_ident()
+
+        with self._cond:
+            count = self._readers[me] - 1
+            if count:
+                self._readers[me] = count
+            else:
+                del self._readers[me]
+                if not self._readers:
+                    self._cond.notify_all()
+
+    def acquire_write(self):
+        me = thread.get_ident()
+
+        with self._cond:
+            if self._writer == me:
+                self._writes += 1
+                return
+
+            if me in self._readers:
+                raise RuntimeError("Can't upgrade a read lock to a write lock")
+
+            self._waiting_writers += 1
+            try:
+                while (self._writer is not None) or self._readers:
+                    self._cond.wait()
+            finally:
+                self._waiting_writers -= 1
+                self._cond.notify_all()
+
+            self._writer = me
+            self._writes = 1
+
+    def release_write(self):
+        with self._cond:
+            self._writes -= 1
+            if self._writes == 0:
+                self._writer = None
+                self._cond.notify_all()
+
+    def reading(self):
+        """
+        Returns a context manager that holds the lock for reading.
+        """
+        return _Held(self.acquire_read, self.release_read)
+
+    def writing(self):
+        """
+        Returns a context manager that holds the lock for writing.
+        """
+        return _Held(self.acquire_write, self.release_write)
+
+
+class _Held(object):
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+        return False
+
+
+def with_read_lock(method):
+    """
+    Decorates a method to hold ``self._lock`` for reading while it runs.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.reading():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def with_write_lock(method):
+    """
+    Decorates a method to hold ``self._lock`` for writing while it runs.
+    """
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock.writing():
+            return method(self, *args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,138 @@
+"""
+Schema-lite matching rules for equality tests.
+
+By default, attribute values are compared exactly, as strings. A
+:class:`MatchingRules` assigns other rules to particular attributes. Each rule
+is a function that maps a value to its normalized form, and two values are
+equal under a rule if their normalized forms are. Directories normalize the
+values of these attributes as entries are written, so that searches only have
+to normalize the assertion value.
+"""
+from __future__ import absolute_import
+
+import ldap
+
+from .dn import normalize as normalize_dn
+
+
+CASE_EXACT = 'caseExact'
+CASE_IGNORE = 'caseIgnore'
+INTEGER = 'integer'
+DISTINGUISHED_NAME = 'distinguishedName'
+
+
+def case_ignore(value):
+    """
+    Ignores case and insignificant spaces.
+
+    >>> case_ignore('  Alice   Smith ')
+    'alice smith'
+    """
+    return ' '.join(value.split()).lower()
+
+
+def integer(value):
+    """
+    Compares values as integers. Values that aren't integers are only equal to
+    identical strings.
+
+    >>> integer('0100') == integer('100')
+    True
+    """
+    try:
+        value = int(value)
+    except ValueError:
+        pass
+
+    return value
+
+
+def distinguished_name(value):
+    """
+    Compares values as DNs, ignoring case and formatting. Invalid DNs are
+    only equal to identical strings.
+
+    >>> distinguished_name('CN=Alice, o=test') == distinguished_name('cn=alice,o=test')
+    True
+    """
+    try:
+        value = normalize_dn(value)
+    except ldap.INVALID_DN_SYNTAX:
+        pass
+
+    return value
+
+
+normalizers = {
+    CASE_EXACT: None,
+    CASE_IGNORE: case_ignore,
+    INTEGER: integer,
+    DISTINGUISHED_NAME: distinguished_name,
+}
+
+
+class MatchingRules(object):
+    """
+    The equality matching rules for a set of attributes.
+
+    :param rules: A dictionary mapping attribute names to
+        :data:`CASE_EXACT`, :data:`CASE_IGNORE`, :data:`INTEGER`, or
+        :data:`DISTINGUISHED_NAME`. Attribute names are case-insensitive.
+
+    Rules are immutable and compare equal if they assign the same rules to
+    the same attributes.
+
+    >>> rules = MatchingRules({'uid': CASE_IGNORE, 'uidNumber': INTEGER})
+    >>> rules.normalizer('UID')('Alice')
+    'alice'
+    >>> rules.normalize_entry({'uid': ['Alice'], 'cn': ['Alice']})
+    {'uid': frozenset(['alice'])}
+    """
+    def __init__(self, rules):
+        self.rules = {}
+
+        for attr, rule in rules.iteritems():
+            if rule not in normalizers:
+                raise ValueError(u"Unrecognized matching rule: {0}".format(rule))
+            if normalizers[rule] is not None:
+                self.rules[attr.lower()] = rule
+
+        self._key = frozenset(self.rules.iteritems())
+        self._normalizers = dict((attr, normalizers[rule]) for attr, rule in self.rules.iteritems())
+
+    def __eq__(self, other):
+        return isinstance(other, MatchingRules) and (self._key == other._key)
+
+    def __ne__(self, other):
+        return not (self == other)
+
+    def __hash__(self):
+        return hash(self._key)
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __repr__(self):
+        return "%s(%r)" % (self.__class__.__name__, self.rules)
+
+    def normalizer(self, attr):
+        """
+        Returns the function that normalizes values of ``attr``, or None if
+        they're compared exactly.
+        """
+        return self._normalizers.get(attr.lower())
+
+    def normalize_entry(self, entry):
+        """
+        Returns the normalized values of an entry's attributes that have
+        matching rules, as ``{attr: frozenset(values)}`` with lower-cased
+        attribute names.
+        """
+        normalized = {}
+
+        for attr, values in entry.iteritems():
+            normalize = self._normalizers.get(attr.lower())
+            if (normalize is not None) and values:
+                normalized[attr.lower()] = frozenset(normalize(value) for value in values)
+
+        return normalized
@@ -0,0 +1,140 @@
+"""
+Verification of hashed ``userPassword`` values.
+
+Hashed values are recognized by their RFC 2307 scheme prefix and verified
+with `passlib <https://pypi.python.org/pypi/passlib/>`_, if it's installed.
+Hashing is deliberately slow, so results can be kept in a
+:class:`PasswordCache`.
+"""
+from __future__ import absolute_import, with_statement
+
+import hashlib
+import threading
+
+from .cache import LRUCache
+
+try:
+    from passlib.hash import ldap_md5_crypt, ldap_salted_sha1, ldap_sha1
+except ImportError:
+    handlers = []
+else:
+    handlers = [ldap_md5_crypt, ldap_salted_sha1, ldap_sha1]
+
+
+def identify(password):
+    """
+    Returns the passlib handler for a hashed password, or None if it isn't a
+    hash that we can verify.
+    """
+    for handler in handlers:
+        try:
+            if handler.identify(password):
+                return handler
+        except ValueError:
+            pass
+
+    return None
+
+
+def verify(cred, password):
+    """
+    Returns True if ``cred`` matches a hashed password, False if it doesn't,
+    or None if ``password`` isn't a hash that we can verify.
+
+    Supported schemes are ``{CRYPT}`` (MD5-crypt only), ``{SSHA}``, and
+    ``{SHA}``.
+    """
+    handler = identify(password)
+
+    if handler is None:
+        verified = None
+    else:
+        try:
+            verified = handler.verify(cred, password)
+        except ValueError:
+            verified = False
+
+    return verified
+
+
+class PasswordCache(object):
+    """
+    Remembers the results of :func:`verify`.
+
+    :param maxsize: The maximum number of results to remember. ``None`` means
+        unbounded.
+
+    Results are keyed by the entry's DN, the hashed password, and a digest of
+    the presented credentials, so the credentials themselves are not kept.
+    Since the hash is part of the key, a changed password can't match a stale
+    result, but :meth:`invalidate` should still be called to discard results
+    for an entry whose passwords have changed.
+    """
+    def __init__(self, maxsize=4096):
+        self._results = LRUCache(maxsize)
+        # The keys of each entry's results, for invalidate(). These may include
+        # results that have since been discarded from the cache.
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def verify(self, dn, cred, password):
+        """
+        Like :func:`verify`, but consults the cache first. Passwords that
+        aren't hashed are not cached.
+        """
+        if identify(password) is None:
+            return None
+
+        dn = dn.lower()
+        if isinstance(cred, unicode):
+            digest = hashlib.sha256(cred.encode('utf-8')).digest()
+        else:
+            digest = hashlib.sha256(cred).digest()
+        key = (dn, password, digest)
+
+        try:
+            return self._results[key]
+        except KeyError:
+            pass
+
+        result = self._results[key] = verify(cred, password)
+
+        with self._lock:
+            keys = self._keys.setdefault(dn, set())
+            keys.add(key)
+
+            # Forget keys whose results have been discarded each time the set
+            # reaches a power of two, so that it can't grow far beyond the
+            # number of the entry's results that are still remembered.
+            if (len(keys) >= 16) and not (len(keys) & (len(keys) - 1)):
+                keys.intersection_update([k for k in keys if k in self._results])
+
+        return result
+
+    def invalidate(self, dn):
+        """
+        Discards all results for an entry.
+        """
+        with self._lock:
+            keys = self._keys.pop(dn.lower(), ())
+
+        for key in keys:
+            try:
+                del self._results[key]
+            except KeyError:
+                pass
+
+    def clear(self):
+        """
+        Discards all results and resets the statistics.
+        """
+        with self._lock:
+            self._keys.clear()
+        self._results.clear()
+
+    def info(self):
+        """
+        Returns a :class:`~mockldap.cache.CacheInfo` describing the cached
+        results.
+        """
+        return self._results.info()
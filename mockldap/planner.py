@@ -0,0 +1,401 @@
+"""
+Search planning over attribute indexes.
+
+A parsed filter tree is turned into set operations over the directory keys
+held by attribute, ordering, and substring indexes: intersection for &, union
+for |, and difference for !. Whatever can't be answered exactly from an index
+is left as a residual filter that is evaluated against each candidate entry.
+"""
+from __future__ import absolute_import
+
+from string import lower
+
+import ldap
+
+from .filter import And, Or, Not, Test
+
+
+class SetPlan(object):
+    """
+    A plan that produces an exact set of directory keys, regardless of scope.
+    """
+    def estimate(self):
+        """
+        Returns the approximate number of keys this plan will produce.
+        """
+        raise NotImplementedError()
+
+    def dns(self):
+        raise NotImplementedError()
+
+    def describe(self, indent=0):
+        raise NotImplementedError()
+
+
+class IndexEqual(SetPlan):
+    def __init__(self, index, value):
+        self.index = index
+        self.value = value
+
+    def estimate(self):
+        return len(self.index.equal(self.value))
+
+    def dns(self):
+        return self.index.equal(self.value)
+
+    def describe(self, indent=0):
+        return [u"%sindex %s=%s (~%d)" % (u"  " * indent, self.index.attr, self.value, self.estimate())]
+
+
+class IndexPresent(SetPlan):
+    def __init__(self, index):
+        self.index = index
+
+    def estimate(self):
+        return len(self.index.present())
+
+    def dns(self):
+        return self.index.present()
+
+    def describe(self, indent=0):
+        return [u"%sindex %s=* (~%d)" % (u"  " * indent, self.index.attr, self.estimate())]
+
+
+class IndexRange(SetPlan):
+    def __init__(self, index, op, value):
+        self.index = index
+        self.op = op
+        self.value = value
+
+    def estimate(self):
+        return self.index.count(self.op, self.value)
+
+    def dns(self):
+        return self.index.range(self.op, self.value)
+
+    def describe(self, indent=0):
+        return [u"%sindex %s%s%s (~%d)" % (u"  " * indent, self.index.attr, self.op, self.value, self.estimate())]
+
+
+class IndexSubstring(SetPlan):
+    """
+    Candidates for a substring test. These are not exact, so the test must
+    also be kept as a residual filter.
+    """
+    def __init__(self, index, test):
+        self.index = index
+        self.test = test
+
+    def estimate(self):
+        return self.index.estimate(self.test.substrings)
+
+    def dns(self):
+        return self.index.candidates(self.test.substrings)
+
+    def describe(self, indent=0):
+        return [u"%sindex %s=%s (~%d)" % (u"  " * indent, self.index.attr, self.test.value, self.estimate())]
+
+
+class Intersect(SetPlan):
+    def __init__(self, plans):
+        self.plans = sorted(plans, key=lambda plan: plan.estimate())
+
+    def estimate(self):
+        return min(plan.estimate() for plan in self.plans)
+
+    def dns(self):
+        plans = iter(self.plans)
+        dns = set(plans.next().dns())
+
+        for plan in plans:
+            if not dns:
+                break
+            dns.intersection_update(plan.dns())
+
+        return dns
+
+    def describe(self, indent=0):
+        lines = [u"%sintersect (~%d)" % (u"  " * indent, self.estimate())]
+        for plan in self.plans:
+            lines.extend(plan.describe(indent + 1))
+
+        return lines
+
+
+class Union(SetPlan):
+    def __init__(self, plans):
+        self.plans = plans
+
+    def estimate(self):
+        return sum(plan.estimate() for plan in self.plans)
+
+    def dns(self):
+        dns = set()
+        for plan in self.plans:
+            dns.update(plan.dns())
+
+        return dns
+
+    def describe(self, indent=0):
+        lines = [u"%sunion (~%d)" % (u"  " * indent, self.estimate())]
+        for plan in self.plans:
+            lines.extend(plan.describe(indent + 1))
+
+        return lines
+
+
+class Difference(SetPlan):
+    """
+    The keys of ``left`` that are not in ``right``. If ``left`` is None, this
+    is the complement of ``right``, which can only be resolved against a
+    search scope.
+    """
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def estimate(self):
+        return self.left.estimate()
+
+    def dns(self):
+        return set(self.left.dns()).difference(self.right.dns())
+
+    def describe(self, indent=0):
+        lines = [u"%sdifference (~%d)" % (u"  " * indent, self.estimate())]
+        lines.extend(self.left.describe(indent + 1))
+        lines.extend(self.right.describe(indent + 1))
+
+        return lines
+
+
+class SearchPlan(object):
+    """
+    The complete plan for one search.
+
+    :param candidates: A :class:`SetPlan` for the matching keys, or None to
+        walk every entry in scope.
+    :param exclude: A :class:`SetPlan` for keys to skip while walking the
+        scope, or None.
+    :param residual: A filter to evaluate against each candidate entry, or
+        None if the candidates are exact.
+    """
+    def __init__(self, base, scope, candidates=None, exclude=None, residual=None):
+        self.base = base
+        self.scope = scope
+        self.candidates = candidates
+        self.exclude = exclude
+        self.residual = residual
+
+    def dns(self, directory):
+        """
+        Generates the directory keys of the matching entries.
+        """
+        tree = directory.tree
+
+        if self.scope == ldap.SCOPE_BASE:
+            dns = [lower(self.base)] if (self.base in directory) else []
+        elif self.candidates is not None:
+            dns = (dn for dn in self.candidates.dns()
+                   if tree.in_scope(dn, self.base, self.scope))
+        elif self.exclude is not None:
+            exclude = self.exclude.dns()
+            dns = (dn for dn in tree.scope(self.base, self.scope)
+                   if dn not in exclude)
+        else:
+            dns = tree.scope(self.base, self.scope)
+
+        if self.residual is not None:
+            matches = self.residual.compile(directory.matching_rules)
+            peek = directory.peek
+            if directory.normalized is None:
+                dns = (dn for dn in dns if matches(dn, peek(dn)))
+            else:
+                normalized = directory.normalized.get
+                dns = (dn for dn in dns if matches(dn, peek(dn), normalized(dn)))
+
+        return dns
+
+    def describe(self):
+        if self.scope == ldap.SCOPE_BASE:
+            lines = [u"lookup %s" % (self.base,)]
+        elif self.candidates is not None:
+            lines = [u"candidates in scope %d of %s" % (self.scope, self.base)]
+            lines.extend(self.candidates.describe(1))
+        else:
+            lines = [u"walk scope %d of %s" % (self.scope, self.base)]
+            if self.exclude is not None:
+                lines.append(u"  excluding")
+                lines.extend(self.exclude.describe(2))
+
+        if self.residual is not None:
+            lines.append(u"filter %s" % (self.residual.unparse(),))
+
+        return u"\n".join(lines)
+
+
+def plan_search(directory, filter_expr, base, scope):
+    """
+    Returns a :class:`SearchPlan` for a parsed filter against a
+    :class:`~mockldap.directory.Directory`.
+    """
+    # A base search looks at one entry at most, so indexes can't help.
+    if scope == ldap.SCOPE_BASE:
+        return SearchPlan(base, scope, residual=filter_expr)
+
+    planner = Planner(directory.indexes, directory.ordering_indexes, directory.substring_indexes)
+    candidates, residual = planner.plan(filter_expr)
+    exclude = None
+
+    if isinstance(candidates, Difference) and (candidates.left is None):
+        exclude = candidates.right
+        candidates = None
+    elif candidates is not None:
+        if candidates.estimate() > directory.tree.scope_size(base, scope):
+            candidates, residual = None, filter_expr
+
+    return SearchPlan(base, scope, candidates, exclude, residual)
+
+
+class Planner(object):
+    """
+    Converts a filter tree into a :class:`SetPlan` and a residual filter.
+
+    :meth:`plan` returns ``(candidates, residual)``. ``candidates`` is None if
+    no index applies. ``residual`` is None if ``candidates`` are exact.
+    """
+    def __init__(self, indexes, ordering_indexes=None, substring_indexes=None):
+        self.indexes = indexes
+        self.ordering_indexes = ordering_indexes or {}
+        self.substring_indexes = substring_indexes or {}
+
+    def plan(self, filter_expr):
+        if isinstance(filter_expr, Test):
+            result = self._plan_test(filter_expr)
+        elif isinstance(filter_expr, And):
+            result = self._plan_and(filter_expr)
+        elif isinstance(filter_expr, Or):
+            result = self._plan_or(filter_expr)
+        elif isinstance(filter_expr, Not):
+            result = self._plan_not(filter_expr)
+        else:
+            result = (None, filter_expr)
+
+        return result
+
+    def _plan_test(self, test):
+        if test.substrings is not None:
+            index = self.substring_indexes.get(test.attr)
+        elif test.op == u'=':
+            index = self.indexes.get(test.attr)
+        else:
+            index = self.ordering_indexes.get(test.attr)
+
+        if index is None:
+            result = (None, test)
+        elif test.substrings is not None:
+            result = self._plan_substrings(index, test)
+        elif test.op != u'=':
+            result = (IndexRange(index, test.op, test.value), None)
+        elif test.value == u'*':
+            result = (IndexPresent(index), None)
+        else:
+            result = (IndexEqual(index, test.value), None)
+
+        return result
+
+    def _plan_substrings(self, index, test):
+        # Substrings shorter than a gram can't narrow anything down.
+        if index.estimate(test.substrings) is None:
+            result = (None, test)
+        else:
+            result = (IndexSubstring(index, test), test)
+
+        return result
+
+    def _plan_not(self, not_expr):
+        candidates, residual = self.plan(not_expr.term)
+
+        if (candidates is None) or (residual is not None) or self._is_complement(candidates):
+            result = (None, not_expr)
+        else:
+            result = (Difference(None, candidates), None)
+
+        return result
+
+    def _plan_and(self, and_expr):
+        positive = []
+        negative = []
+        residual = []
+
+        for term in and_expr.terms:
+            candidates, term_residual = self.plan(term)
+
+            if candidates is None:
+                pass
+            elif self._is_complement(candidates):
+                negative.append(candidates.right)
+            else:
+                positive.append(candidates)
+
+            if term_residual is not None:
+                residual.append(term_residual)
+
+        if len(positive) == 0:
+            candidates = None
+        elif len(positive) == 1:
+            candidates = positive[0]
+        else:
+            candidates = Intersect(positive)
+
+        if negative:
+            right = negative[0] if (len(negative) == 1) else Union(negative)
+            candidates = Difference(candidates, right)
+
+        if len(residual) == 0:
+            residual = None
+        elif len(residual) == 1:
+            residual = residual[0]
+        else:
+            residual = self._residual_and(and_expr, tuple(residual))
+
+        return (candidates, residual)
+
+    def _residual_and(self, and_expr, terms):
+        """
+        Returns an And of some of ``and_expr``'s residual terms. This is
+        ``and_expr`` itself if none of its terms were planned away; otherwise
+        it's kept on ``and_expr``, so that the filter it compiles to is cached
+        along with the parsed filter, just like the original's.
+        """
+        if (len(terms) == len(and_expr.terms)) and \
+                all(term is original for term, original in zip(terms, and_expr.terms)):
+            return and_expr
+
+        # Residual terms are always parsed terms or other cached residuals, so
+        # they live as long as and_expr does and their ids are stable.
+        key = tuple(id(term) for term in terms)
+
+        try:
+            residuals = and_expr._residuals
+        except AttributeError:
+            residuals = and_expr._residuals = {}
+
+        try:
+            residual = residuals[key]
+        except KeyError:
+            residual = residuals[key] = And()
+            residual.terms = terms
+
+        return residual
+
+    def _plan_or(self, or_expr):
+        plans = [self.plan(term) for term in or_expr.terms]
+
+        for candidates, residual in plans:
+            if (candidates is None) or (residual is not None) or self._is_complement(candidates):
+                return (None, or_expr)
+
+        return (Union([candidates for candidates, residual in plans]), None)
+
+    def _is_complement(self, candidates):
+        return isinstance(candidates, Difference) and (candidates.left is None)
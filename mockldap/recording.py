@@ -1,12 +1,15 @@
 """
 Tools for recording method calls and seeding return values.
 """
+import collections
 from collections import defaultdict
 from copy import deepcopy
 from functools import partial
-from itertools import ifilter
+from itertools import count
 import types
 
+from .locking import NullLock
+
 
 class SeedRequired(Exception):
     """
@@ -19,19 +22,287 @@ class SeedRequired(Exception):
     pass
 
 
+# How recorded methods copy their return values. See
+# RecordableMethods.set_result_mode.
+RESULT_DEEPCOPY = 'deepcopy'
+RESULT_SHALLOW = 'shallow'
+RESULT_FROZEN = 'frozen'
+
+
+# How much of each call recorded methods keep. See
+# RecordableMethods.set_recording.
+RECORD_FULL = 'full'
+RECORD_COUNTS = 'counts'
+RECORD_OFF = 'off'
+
+
+class FrozenDict(dict):
+    """
+    A dictionary that can't be modified. This is returned in place of dicts in
+    :data:`RESULT_FROZEN` mode.
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("%s is immutable" % (self.__class__.__name__,))
+
+    __setitem__ = __delitem__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    # The default protocols fill in a new instance one item at a time, so
+    # copies and pickles must be built from a complete dict instead.
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return FrozenDict(deepcopy(dict(self), memo))
+
+
+def shallow_copy(value):
+    """
+    Copies the dicts, lists, and tuples in a value, sharing everything else.
+    Anything that isn't a simple immutable value is deep-copied.
+    """
+    if type(value) in _atomic_types:
+        copied = value
+    elif isinstance(value, dict):
+        copied = dict((k, v if (type(v) in _atomic_types) else shallow_copy(v))
+                      for k, v in value.iteritems())
+    elif isinstance(value, list):
+        copied = [v if (type(v) in _atomic_types) else shallow_copy(v) for v in value]
+    elif isinstance(value, tuple):
+        copied = tuple(v if (type(v) in _atomic_types) else shallow_copy(v) for v in value)
+    else:
+        copied = deepcopy(value)
+
+    return copied
+
+
+def freeze(value):
+    """
+    Like :func:`shallow_copy`, but converts dicts to :class:`FrozenDict` and
+    lists to tuples.
+    """
+    if type(value) in _atomic_types:
+        frozen = value
+    elif isinstance(value, dict):
+        frozen = FrozenDict((k, v if (type(v) in _atomic_types) else freeze(v))
+                            for k, v in value.iteritems())
+    elif isinstance(value, (list, tuple)):
+        frozen = tuple(v if (type(v) in _atomic_types) else freeze(v) for v in value)
+    else:
+        frozen = deepcopy(value)
+
+    return frozen
+
+
+# Exact types, so that mutable subclasses are still copied.
+_atomic_types = frozenset([str, unicode, int, long, float, bool, types.NoneType])
+
+_result_copiers = {
+    RESULT_DEEPCOPY: deepcopy,
+    RESULT_SHALLOW: shallow_copy,
+    RESULT_FROZEN: freeze,
+}
+
+
+class SeedTable(object):
+    """
+    The seeded return values for one method.
+
+    Seeds are found by hashing a canonical form of their arguments, so lookups
+    don't slow down as seeds accumulate. Seeds with arguments that aren't built
+    from plain strings, numbers, and containers are kept in a list and compared
+    one by one. Either way, the most recent matching seed wins.
+
+    >>> class Unhashable(object):
+    ...     __hash__ = None
+    ...     def __eq__(self, other):
+    ...         return isinstance(other, Unhashable)
+    >>>
+    >>> seeds = SeedTable()
+    >>> seeds.add((['a'], 1), {}, 'first')
+    >>> seeds.add((['a'], 1), {}, 'second')
+    >>> seeds.add((Unhashable(),), {}, 'unhashable')
+    >>> seeds.lookup((['a'], 1), {})
+    'second'
+    >>> seeds.lookup((Unhashable(),), {})
+    'unhashable'
+    >>> seeds.lookup((('a',), 1), {})
+    Traceback (most recent call last):
+        ...
+    KeyError: ((('a',), 1), {})
+    """
+    def __init__(self):
+        self.hashed = {}
+        self.unhashed = []
+        self._serials = count()
+
+    def __len__(self):
+        return len(self.hashed) + len(self.unhashed)
+
+    def add(self, args, kwargs, value):
+        serial = self._serials.next()
+        key = canonical_args(args, kwargs)
+
+        if key is not None:
+            self.hashed[key] = (serial, value)
+        else:
+            self.unhashed.insert(0, (serial, (args, kwargs), value))
+
+    def lookup(self, args, kwargs):
+        """
+        Returns the value of the most recent seed matching these arguments.
+        Raises KeyError if there isn't one.
+        """
+        key = canonical_args(args, kwargs)
+        serial, value = (-1, None)
+
+        if key is not None:
+            serial, value = self.hashed.get(key, (serial, value))
+
+        for seed_serial, seed_args, seed_value in self.unhashed:
+            if seed_serial < serial:
+                break
+            if seed_args == (args, kwargs):
+                serial, value = (seed_serial, seed_value)
+                break
+
+        if serial < 0:
+            raise KeyError((args, kwargs))
+
+        return value
+
+
+def canonical_args(args, kwargs):
+    """
+    Returns a hashable value that is equal for equal sets of arguments, or None
+    if the arguments can't be represented this way.
+    """
+    try:
+        key = (_canonical(args), _canonical(kwargs))
+        hash(key)
+    except TypeError:
+        key = None
+
+    return key
+
+
+def _canonical(value):
+    # Containers are tagged so that, for example, lists and tuples with the
+    # same items stay distinct, just as they compare unequal. Anything else,
+    # including subclasses of these types, may define equality in a way that
+    # its hash doesn't agree with, so it can only be compared directly.
+    value_type = type(value)
+
+    if value_type in _atomic_types:
+        canonical = value
+    elif value_type is dict:
+        canonical = (dict, frozenset((_canonical(k), _canonical(v))
+                                     for k, v in value.iteritems()))
+    elif value_type is list:
+        canonical = (list, tuple(_canonical(v) for v in value))
+    elif value_type is tuple:
+        canonical = (tuple, tuple(_canonical(v) for v in value))
+    elif value_type in (set, frozenset):
+        canonical = (frozenset, frozenset(_canonical(v) for v in value))
+    else:
+        raise TypeError(value)
+
+    return canonical
+
+
 class RecordableMethods(object):
     """
     This is a mixin class to be used as a companion with recorded, below. Any
     class that wants to use the recordable decorator must inherit from this.
     """
+    def set_result_mode(self, mode):
+        """
+        Sets how recorded methods copy their return values, so that callers
+        can't modify our internal state through them.
+
+        :param mode: :data:`RESULT_DEEPCOPY` (the default) deep-copies every
+            return value. :data:`RESULT_SHALLOW` copies only dicts, lists, and
+            tuples, sharing strings and other immutable values; this is much
+            faster for large search results. :data:`RESULT_FROZEN` returns
+            tuples in place of lists and :class:`FrozenDict` in place of
+            dicts, so any attempt to modify them raises :exc:`TypeError`.
+
+        Individual methods can override this with
+        :meth:`~mockldap.recording.RecordedMethod.set_result_mode`.
+        """
+        if mode not in _result_copiers:
+            raise ValueError("Unknown result mode: %r" % (mode,))
+
+        self._result_mode = mode
+
+    def set_recording(self, mode):
+        """
+        Sets how much we remember about calls to recorded methods.
+
+        :param mode: :data:`RECORD_FULL` (the default) keeps every call with
+            its arguments. An integer ``n`` keeps only the last ``n`` calls.
+            :data:`RECORD_COUNTS` only counts calls to each method.
+            :data:`RECORD_OFF` records nothing.
+
+        :meth:`methods_called` only reports the calls that were kept. Long
+        soak tests should use one of the bounded modes to keep memory use
+        constant.
+        """
+        if mode in [RECORD_FULL, RECORD_COUNTS, RECORD_OFF]:
+            maxlen = None
+        elif isinstance(mode, (int, long)) and not isinstance(mode, bool) and (mode > 0):
+            maxlen = mode
+        else:
+            raise ValueError("Unknown recording mode: %r" % (mode,))
+
+        if mode in [RECORD_COUNTS, RECORD_OFF]:
+            calls = []
+        elif maxlen is not None:
+            calls = collections.deque(self._recorded_calls, maxlen)
+        else:
+            calls = list(self._recorded_calls)
+
+        with self._mutex:
+            self._recording = mode
+            self._recorded_calls_internal = calls
+
+    def call_counts(self):
+        """
+        Returns a dictionary mapping the name of each recorded method to the
+        number of times it was called. This is maintained unless recording
+        is off.
+        """
+        with self._mutex:
+            return dict(self._call_counts)
+
+    def total_calls(self):
+        """
+        Returns the total number of calls to recorded methods. This is
+        maintained unless recording is off.
+        """
+        return self._total_calls
+
     def methods_called(self, with_args=False):
+        with self._mutex:
+            calls = list(self._recorded_calls)
+
         if with_args:
-            calls = deepcopy(self._recorded_calls)
+            calls = deepcopy(calls)
         else:
-            calls = [call[0] for call in self._recorded_calls]
+            calls = [call[0] for call in calls]
 
         return calls
 
+    _recording = RECORD_FULL
+    _total_calls = 0
+
+    # Guards recording and seeding. Subclasses replace this with a real lock
+    # to make them thread-safe.
+    _mutex = NullLock()
+
     @property
     def _recorded_calls(self):
         if not hasattr(self, '_recorded_calls_internal'):
@@ -39,13 +310,29 @@ class RecordableMethods(object):
 
         return self._recorded_calls_internal
 
+    @property
+    def _call_counts(self):
+        if not hasattr(self, '_call_counts_internal'):
+            self._call_counts_internal = defaultdict(int)
+
+        return self._call_counts_internal
+
     @property
     def _seeded_calls(self):
         if not hasattr(self, '_seeded_calls_internal'):
-            self._seeded_calls_internal = defaultdict(list)
+            self._seeded_calls_internal = defaultdict(SeedTable)
 
         return self._seeded_calls_internal
 
+    @property
+    def _result_modes(self):
+        if not hasattr(self, '_result_modes_internal'):
+            self._result_modes_internal = {}
+
+        return self._result_modes_internal
+
+    _result_mode = RESULT_DEEPCOPY
+
 
 class recorded(object):
     """
@@ -110,8 +397,9 @@ class RecordedMethod(object):
         self._record(args, kwargs)
 
         try:
-            value = self._seeded_values(args, kwargs).next()[1]
-        except StopIteration:
+            with self.instance._mutex:
+                value = self._seeded_calls.lookup(args, kwargs)
+        except KeyError:
             try:
                 value = self.func(self.instance, *args, **kwargs)
             except SeedRequired, e:
@@ -121,7 +409,7 @@ class RecordedMethod(object):
             if self._is_exception(value):
                 raise value
 
-        return deepcopy(value)
+        return self._copy_result(value)
 
     def seed(self, *args, **kwargs):
         """
@@ -156,18 +444,45 @@ class RecordedMethod(object):
         kwargs = deepcopy(kwargs)
         value = deepcopy(value)
 
-        self._seeded_calls.insert(0, ((args, kwargs), value))
+        with self.instance._mutex:
+            self._seeded_calls.add(args, kwargs, value)
 
-    def _record(self, args, kwargs):
-        self._recorded_calls.append((self.func.__name__, args, kwargs))
+    def set_result_mode(self, mode):
+        """
+        Sets how this method copies its return values, overriding
+        :meth:`~mockldap.recording.RecordableMethods.set_result_mode`. Pass
+        None to go back to the default.
+        """
+        if mode is None:
+            self.instance._result_modes.pop(self.func.__name__, None)
+        elif mode not in _result_copiers:
+            raise ValueError("Unknown result mode: %r" % (mode,))
+        else:
+            self.instance._result_modes[self.func.__name__] = mode
 
-    def _seeded_values(self, args, kwargs):
-        func = partial(self._seed_matches, args, kwargs)
+    def _copy_result(self, value):
+        mode = self.instance._result_modes.get(self.func.__name__,
+                                               self.instance._result_mode)
+        copier = _result_copiers[mode]
 
-        return ifilter(func, self._seeded_calls)
+        # Generators are copied one item at a time as they are consumed.
+        if isinstance(value, types.GeneratorType):
+            copied = (copier(item) for item in value)
+        else:
+            copied = copier(value)
 
-    def _seed_matches(self, args, kwargs, seed):
-        return (seed[0] == (args, kwargs))
+        return copied
+
+    def _record(self, args, kwargs):
+        recording = self.instance._recording
+        if recording == RECORD_OFF:
+            return
+
+        with self.instance._mutex:
+            self.instance._call_counts[self.func.__name__] += 1
+            self.instance._total_calls += 1
+            if recording != RECORD_COUNTS:
+                self._recorded_calls.append((self.func.__name__, args, kwargs))
 
     @property
     def _seeded_calls(self):
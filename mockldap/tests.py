@@ -1,13 +1,18 @@
 from __future__ import absolute_import, with_statement
 
-from copy import copy
+from copy import copy, deepcopy
+import cPickle
+from cStringIO import StringIO
 from doctest import DocTestSuite
+import pickle
+import threading
 try:
     import unittest2 as unittest
 except ImportError:
     import unittest
 
 import ldap
+from ldap.controls import SimplePagedResultsControl
 import ldap.modlist
 import ldap.filter
 try:
@@ -15,8 +20,10 @@ try:
 except ImportError:
     passlib = None
 
-from . import MockLdap
-from .recording import SeedRequired
+from . import MockLdap, RESULT_SHALLOW, RESULT_FROZEN
+from . import RECORD_FULL, RECORD_COUNTS, RECORD_OFF
+from . import CASE_EXACT, CASE_IGNORE, INTEGER, DISTINGUISHED_NAME
+from .recording import FrozenDict, SeedRequired
 
 
 test = ("o=test", {"objectClass": ["top"]})
@@ -46,6 +53,12 @@ def load_tests(loader, tests, pattern):
 
     suite.addTests(tests)
     suite.addTest(DocTestSuite('mockldap.recording'))
+    suite.addTest(DocTestSuite('mockldap.cache'))
+    suite.addTest(DocTestSuite('mockldap.directory'))
+    suite.addTest(DocTestSuite('mockldap.dn'))
+    suite.addTest(DocTestSuite('mockldap.filter'))
+    suite.addTest(DocTestSuite('mockldap.matching'))
+    suite.addTest(DocTestSuite('mockldap.locking'))
 
     return suite
 
@@ -158,6 +171,55 @@ class TestLDAPObject(unittest.TestCase):
 
         self.assertEqual(results, [(alice[0], {'userPassword': []})])
 
+    def test_search_s_attrlist_ignores_case(self):
+        results = self.ldapobj.search_s("cn=alice,ou=example,o=test", ldap.SCOPE_BASE,
+                                        attrlist=["USERPASSWORD", "Uid"])
+
+        self.assertEqual(results, [(alice[0], {'userPassword': ['alicepw'], 'uid': ['alice']})])
+
+    def test_search_s_attrlist_empty(self):
+        results = self.ldapobj.search_s("cn=alice,ou=example,o=test", ldap.SCOPE_BASE,
+                                        attrlist=[])
+
+        self.assertEqual(results, [alice])
+
+    def test_search_s_attrlist_no_attrs(self):
+        results = self.ldapobj.search_s("ou=example,o=test", ldap.SCOPE_ONELEVEL,
+                                        '(uid=alice)', attrlist=["1.1"])
+
+        self.assertEqual(results, [(alice[0], {})])
+
+    def test_search_s_attrlist_no_attrs_ignored(self):
+        results = self.ldapobj.search_s("cn=alice,ou=example,o=test", ldap.SCOPE_BASE,
+                                        attrlist=["1.1", "cn"])
+
+        self.assertEqual(results, [(alice[0], {'cn': ['alice']})])
+
+    def test_search_s_attrlist_user_attrs(self):
+        self.ldapobj.modify_s(alice[0], [(ldap.MOD_ADD, 'createTimestamp', ['20140101000000Z'])])
+
+        results = self.ldapobj.search_s("cn=alice,ou=example,o=test", ldap.SCOPE_BASE,
+                                        attrlist=["*"])
+
+        self.assertEqual(results, [alice])
+
+    def test_search_s_attrlist_operational_attrs(self):
+        self.ldapobj.modify_s(alice[0], [(ldap.MOD_ADD, 'createTimestamp', ['20140101000000Z'])])
+
+        plus = self.ldapobj.search_s("cn=alice,ou=example,o=test", ldap.SCOPE_BASE,
+                                     attrlist=["+"])
+        both = self.ldapobj.search_s("cn=alice,ou=example,o=test", ldap.SCOPE_BASE,
+                                     attrlist=["*", "createTimestamp"])
+
+        self.assertEqual(plus, [(alice[0], {'createTimestamp': ['20140101000000Z']})])
+        self.assertEqual(both, [(alice[0], dict(alice[1], createTimestamp=['20140101000000Z']))])
+
+    def test_search_s_attrsonly_user_attrs(self):
+        results = self.ldapobj.search_s("cn=alice,ou=example,o=test", ldap.SCOPE_BASE,
+                                        attrlist=["*"], attrsonly=1)
+
+        self.assertEqual(results, [(alice[0], dict((attr, []) for attr in alice[1]))])
+
     def test_search_s_specific_attr_in_filterstr(self):
         results = self.ldapobj.search_s("ou=example,o=test", ldap.SCOPE_ONELEVEL,
                                         '(userPassword=alicepw)')
@@ -182,9 +244,31 @@ class TestLDAPObject(unittest.TestCase):
                                   '(invalid=)')
 
     def test_search_s_filterstr_wildcard(self):
-        with self.assertRaises(SeedRequired):
-            self.ldapobj.search_s("ou=example,o=test", ldap.SCOPE_ONELEVEL,
-                                  '(invalid=foo*bar)')
+        results = self.ldapobj.search_s("ou=example,o=test", ldap.SCOPE_ONELEVEL,
+                                        '(invalid=foo*bar)')
+
+        self.assertEqual(results, [])
+
+    def test_search_s_substring_initial(self):
+        results = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE, '(cn=ALI*)')
+
+        self.assertEqual(results, [alice])
+
+    def test_search_s_substring_any_final(self):
+        results = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE,
+                                        '(objectClass=*os*acc*nt)')
+
+        self.assertEqual(sorted(results), sorted([alice, manager, theo]))
+
+    def test_search_s_substring_no_overlap(self):
+        results = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE, '(uid=alic*ice)')
+
+        self.assertEqual(results, [])
+
+    def test_search_s_substring_escaped(self):
+        from .filter import parse
+
+        self.assertEqual(parse('(cn=a\\2a*b\\29*)').substrings, ('a*', ('b)',), ''))
 
     def test_search_s_invalid_filterstr(self):
         results = self.ldapobj.search_s("ou=example,o=test", ldap.SCOPE_ONELEVEL,
@@ -203,6 +287,145 @@ class TestLDAPObject(unittest.TestCase):
 
         self.assertEqual(results, (ldap.RES_SEARCH_RESULT, [alice]))
 
+    def test_search_async_retrieved_once(self):
+        msgid = self.ldapobj.search("cn=alice,ou=example,o=test", ldap.SCOPE_BASE)
+        self.ldapobj.result(msgid)
+
+        self.assertEqual(self.ldapobj.result(msgid), (ldap.RES_SEARCH_RESULT, None))
+        self.assertEqual(self.ldapobj.async_results, {})
+
+    def test_search_async_incremental(self):
+        msgid = self.ldapobj.search("ou=example,o=test", ldap.SCOPE_ONELEVEL, '(uid=alice)')
+
+        self.assertEqual(self.ldapobj.result(msgid, all=0), (ldap.RES_SEARCH_ENTRY, [alice]))
+        self.assertEqual(self.ldapobj.result(msgid, all=0), (ldap.RES_SEARCH_RESULT, []))
+        self.assertEqual(self.ldapobj.async_results, {})
+
+    def test_search_async_no_such_object(self):
+        msgid = self.ldapobj.search("cn=nobody,ou=example,o=test", ldap.SCOPE_BASE)
+
+        with self.assertRaises(ldap.NO_SUCH_OBJECT):
+            self.ldapobj.result(msgid)
+        self.assertEqual(self.ldapobj.async_results, {})
+
+    def test_search_async_filter_error(self):
+        with self.assertRaises(ldap.FILTER_ERROR):
+            self.ldapobj.search("cn=nobody,ou=example,o=test", ldap.SCOPE_ONELEVEL, '(uid=alice')
+
+        self.assertEqual(self.ldapobj.async_results, {})
+
+    def test_search_async_invalid_dn(self):
+        with self.assertRaises(ldap.INVALID_DN_SYNTAX):
+            self.ldapobj.search("invalid", ldap.SCOPE_BASE)
+
+    def test_search_ext_no_such_object(self):
+        msgid = self.ldapobj.search_ext("cn=nobody,ou=example,o=test", ldap.SCOPE_BASE)
+
+        with self.assertRaises(ldap.NO_SUCH_OBJECT):
+            self.ldapobj.result3(msgid)
+
+    def test_search_async_any(self):
+        first = self.ldapobj.search(alice[0], ldap.SCOPE_BASE)
+        self.ldapobj.search(bob[0], ldap.SCOPE_BASE)
+
+        self.assertEqual(self.ldapobj.result(ldap.RES_ANY), (ldap.RES_SEARCH_RESULT, [alice]))
+        self.assertEqual(self.ldapobj.result(), (ldap.RES_SEARCH_RESULT, [bob]))
+        self.assertNotIn(first, self.ldapobj.async_results)
+
+    def test_search_async_any_after_abandon(self):
+        first = self.ldapobj.search(alice[0], ldap.SCOPE_BASE)
+        self.ldapobj.search(bob[0], ldap.SCOPE_BASE)
+        self.ldapobj.search(theo[0], ldap.SCOPE_BASE)
+        self.ldapobj.abandon(first)
+
+        self.assertEqual(self.ldapobj.result(ldap.RES_ANY), (ldap.RES_SEARCH_RESULT, [bob]))
+        self.assertEqual(self.ldapobj.result(ldap.RES_ANY), (ldap.RES_SEARCH_RESULT, [theo]))
+
+    def test_search_async_any_after_out_of_order(self):
+        first = self.ldapobj.search(alice[0], ldap.SCOPE_BASE)
+        for i in range(100):
+            self.ldapobj.result(self.ldapobj.search(bob[0], ldap.SCOPE_BASE))
+        last = self.ldapobj.search(theo[0], ldap.SCOPE_BASE)
+
+        self.assertTrue(len(self.ldapobj._msgid_order) < 100)
+        self.assertEqual(self.ldapobj.result(ldap.RES_ANY), (ldap.RES_SEARCH_RESULT, [alice]))
+        self.assertEqual(self.ldapobj.result(ldap.RES_ANY), (ldap.RES_SEARCH_RESULT, [theo]))
+        self.assertNotIn(first, self.ldapobj.async_results)
+        self.assertNotIn(last, self.ldapobj.async_results)
+
+    def test_abandon(self):
+        msgid = self.ldapobj.search(alice[0], ldap.SCOPE_BASE)
+        self.ldapobj.abandon(msgid)
+
+        self.assertEqual(self.ldapobj.result(msgid), (ldap.RES_SEARCH_RESULT, None))
+
+    def test_search_iter(self):
+        results = self.ldapobj.search_iter("ou=example,o=test", ldap.SCOPE_ONELEVEL,
+                                           '(userPassword=*)')
+
+        self.assertEqual(sorted(results), sorted([alice, manager, theo]))
+
+    def test_search_iter_lazy(self):
+        results = self.ldapobj.search_iter("o=test", ldap.SCOPE_SUBTREE)
+
+        self.assertIn(next(results), [test, example, other, manager, alice, theo, john, bob])
+
+    def test_search_iter_invalid_dn(self):
+        with self.assertRaises(ldap.INVALID_DN_SYNTAX):
+            self.ldapobj.search_iter("invalid", ldap.SCOPE_BASE)
+
+    def test_search_iter_referral(self):
+        self.ldapobj.directory['cn=ref,ou=example,o=test'] = {
+            'objectClass': ['referral'], '_referral': 'ldap://elsewhere/'}
+
+        results = self.ldapobj.search_iter('cn=ref,ou=example,o=test', ldap.SCOPE_BASE)
+
+        self.assertRaises(ldap.REFERRAL, list, results)
+
+    def test_search_s_referral(self):
+        self.ldapobj.directory['cn=ref,ou=example,o=test'] = {
+            'objectClass': ['referral'], '_referral': 'ldap://elsewhere/'}
+
+        self.assertRaises(ldap.REFERRAL, self.ldapobj.search_s,
+                          'ou=example,o=test', ldap.SCOPE_SUBTREE)
+
+    def test_simple_bind_async(self):
+        msgid = self.ldapobj.simple_bind(alice[0], 'alicepw')
+
+        self.assertEqual(self.ldapobj.result(msgid), (ldap.RES_BIND, []))
+        self.assertEqual(self.ldapobj.bound_as, alice[0])
+
+    def test_simple_bind_async_invalid_credentials(self):
+        msgid = self.ldapobj.simple_bind(alice[0], 'bogus')
+
+        self.assertRaises(ldap.INVALID_CREDENTIALS, self.ldapobj.result, msgid)
+
+    def test_compare_async(self):
+        true = self.ldapobj.compare(alice[0], 'uid', 'alice')
+        false = self.ldapobj.compare(alice[0], 'uid', 'bob')
+
+        self.assertRaises(ldap.COMPARE_TRUE, self.ldapobj.result, true)
+        self.assertRaises(ldap.COMPARE_FALSE, self.ldapobj.result, false)
+
+    def test_write_async(self):
+        msgids = [
+            self.ldapobj.add('cn=mike,ou=example,o=test', [('cn', ['mike'])]),
+            self.ldapobj.modify('cn=mike,ou=example,o=test', [(ldap.MOD_ADD, 'uid', ['mike'])]),
+            self.ldapobj.rename('cn=mike,ou=example,o=test', 'uid=mike'),
+            self.ldapobj.delete('uid=mike,ou=example,o=test'),
+        ]
+
+        results = [self.ldapobj.result(ldap.RES_ANY) for msgid in msgids]
+
+        self.assertEqual(results, [(ldap.RES_ADD, []), (ldap.RES_MODIFY, []),
+                                   (ldap.RES_MODRDN, []), (ldap.RES_DELETE, [])])
+        self.assertEqual(self.ldapobj.async_results, {})
+
+    def test_delete_async_no_such_object(self):
+        msgid = self.ldapobj.delete('cn=mike,ou=example,o=test')
+
+        self.assertRaises(ldap.NO_SUCH_OBJECT, self.ldapobj.result, msgid)
+
     def test_useful_seed_required_message(self):
         filterstr = '(invalid~=bogus)'
         try:
@@ -213,6 +436,54 @@ class TestLDAPObject(unittest.TestCase):
         else:
             self.fail("Expected SeedRequired exception")
 
+    def test_seed_with_attrlist(self):
+        self.ldapobj.search_s.seed("ou=example,o=test", ldap.SCOPE_ONELEVEL,
+                                   '(invalid~=bogus)', attrlist=['ou'])([example])
+        self.ldapobj.search_s.seed("ou=example,o=test", ldap.SCOPE_ONELEVEL,
+                                   '(invalid~=bogus)', attrlist=('ou',))([])
+
+        results = self.ldapobj.search_s("ou=example,o=test", ldap.SCOPE_ONELEVEL,
+                                        '(invalid~=bogus)', attrlist=['ou'])
+
+        self.assertEqual(results, [example])
+
+    def test_seed_most_recent_wins(self):
+        for i in xrange(3):
+            self.ldapobj.search_s.seed("ou=example,o=test", ldap.SCOPE_ONELEVEL,
+                                       '(invalid~=bogus)')([(str(i), {})])
+
+        results = self.ldapobj.search_s("ou=example,o=test", ldap.SCOPE_ONELEVEL,
+                                        '(invalid~=bogus)')
+
+        self.assertEqual(results, [('2', {})])
+
+    def test_seed_with_value_equality(self):
+        class Base(object):
+            def __init__(self, base):
+                self.base = base
+
+            def __eq__(self, other):
+                return isinstance(other, Base) and (self.base == other.base)
+
+            def __ne__(self, other):
+                return not (self == other)
+
+        class DN(str):
+            pass
+
+        self.ldapobj.search_s.seed(Base("ou=example,o=test"), ldap.SCOPE_ONELEVEL,
+                                   '(invalid~=bogus)')([example])
+        self.ldapobj.search_s.seed(DN("ou=example,o=test"), ldap.SCOPE_BASE,
+                                   '(invalid~=bogus)')([example])
+
+        results = self.ldapobj.search_s(Base("ou=example,o=test"), ldap.SCOPE_ONELEVEL,
+                                        '(invalid~=bogus)')
+        self.assertEqual(results, [example])
+
+        results = self.ldapobj.search_s(DN("ou=example,o=test"), ldap.SCOPE_BASE,
+                                        '(invalid~=bogus)')
+        self.assertEqual(results, [example])
+
     def test_search_s_get_items_that_have_userpassword_set(self):
         results = self.ldapobj.search_s(
             "ou=example,o=test", ldap.SCOPE_ONELEVEL, '(userPassword=*)')
@@ -279,6 +550,39 @@ class TestLDAPObject(unittest.TestCase):
         with self.assertRaises(ldap.INVALID_DN_SYNTAX):
             self.ldapobj.search_s("invalid", ldap.SCOPE_SUBTREE)
 
+    def test_search_s_scope_after_add_s(self):
+        dn = 'cn=mike,ou=example,o=test'
+        self.ldapobj.add_s(dn, ldap.modlist.addModlist({'cn': ['mike'], 'objectClass': ['top']}))
+
+        results = self.ldapobj.search_s("ou=example,o=test", ldap.SCOPE_ONELEVEL)
+
+        self.assertIn(dn, [result[0] for result in results])
+
+    def test_search_s_scope_after_delete_s(self):
+        self.ldapobj.delete_s(alice[0])
+
+        results = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE)
+
+        self.assertNotIn(alice[0], [result[0] for result in results])
+
+    def test_search_s_scope_after_rename_s(self):
+        self.ldapobj.rename_s(alice[0], 'uid=alice1', 'ou=other,o=test')
+
+        results = self.ldapobj.search_s("ou=other,o=test", ldap.SCOPE_ONELEVEL)
+
+        self.assertEqual(sorted(result[0] for result in results),
+                         ['cn=bob,ou=other,o=test', 'uid=alice1,ou=other,o=test'])
+
+    def test_search_s_subtree_below_missing_parent(self):
+        dn = 'cn=mike,ou=missing,o=test'
+        self.ldapobj.add_s(dn, ldap.modlist.addModlist({'cn': ['mike'], 'objectClass': ['top']}))
+
+        subtree = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE)
+        onelevel = self.ldapobj.search_s("o=test", ldap.SCOPE_ONELEVEL)
+
+        self.assertIn(dn, [result[0] for result in subtree])
+        self.assertNotIn(dn, [result[0] for result in onelevel])
+
     def test_start_tls_s_disabled_by_default(self):
         self.assertEqual(self.ldapobj.tls_enabled, False)
 
@@ -516,6 +820,15 @@ class TestLDAPObject(unittest.TestCase):
         self.assertIn('alice1', self.ldapobj.directory['uid=alice1,ou=example,o=test']['cn'])
         self.assertNotIn('alice', self.ldapobj.directory['uid=alice1,ou=example,o=test']['cn'])
 
+    def test_rename_s_escaped_rdn(self):
+        self.ldapobj.add_s('cn=smith\\, john,ou=example,o=test',
+                           [('cn', ['smith, john']), ('objectClass', ['top'])])
+
+        self.ldapobj.rename_s('cn=smith\\, john,ou=example,o=test', 'cn=john smith')
+
+        self.assertEqual(self.ldapobj.directory['cn=john smith,ou=example,o=test']['cn'],
+                         ['john smith'])
+
     def test_rename_s_newsuperior_check_dn(self):
         self.ldapobj.rename_s(alice[0], 'uid=alice1', 'ou=new,o=test')
 
@@ -572,83 +885,1317 @@ class TestLDAPObject(unittest.TestCase):
         self.assertEqual(self.ldapobj.whoami_s(), 'dn:cn=alice,ou=example,o=test')
 
 
-def initialize(*args, **kwargs):
-    """ Dummy patch target for the tests below. """
-    pass
-
-
-class TestMockLdap(unittest.TestCase):
+class TestIndexedLDAPObject(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
-        cls.mockldap = MockLdap(directory)
+        cls.mockldap = MockLdap(directory, indexes=['uid', 'userPassword'])
 
     @classmethod
     def tearDownClass(cls):
         del cls.mockldap
 
+    def setUp(self):
+        self.mockldap.start()
+        self.ldapobj = self.mockldap['ldap://localhost']
+
     def tearDown(self):
-        self.mockldap.stop_all()
+        self.mockldap.stop()
 
-    def test_uninitialized(self):
-        self.assertRaises(KeyError, lambda: self.mockldap[''])
+    def test_search_s_equality(self):
+        results = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE, '(uid=alice)')
 
-    def test_duplicate_patch(self):
-        self.mockldap.start()
+        self.assertEqual(results, [alice])
 
-        self.assertRaises(ValueError, lambda: self.mockldap.start())
+    def test_search_s_presence(self):
+        results = self.ldapobj.search_s("ou=example,o=test", ldap.SCOPE_SUBTREE,
+                                        '(userPassword=*)')
 
-    def test_unbalanced_stop(self):
-        self.assertRaises(ValueError, lambda: self.mockldap.stop())
+        self.assertEqual(sorted(results), sorted([alice, manager, theo]))
 
-    def test_stop_penultimate(self):
-        self.mockldap.start()
-        self.mockldap.start('mockldap.tests.initialize')
-        self.mockldap.stop()
+    def test_search_s_out_of_scope(self):
+        results = self.ldapobj.search_s("ou=other,o=test", ldap.SCOPE_SUBTREE,
+                                        '(userPassword=alicepw)')
 
-        self.assert_(self.mockldap[''] is not None)
+        self.assertEqual(results, [])
 
-    def test_stop_last(self):
-        self.mockldap.start()
-        self.mockldap.start('mockldap.tests.initialize')
-        self.mockldap.stop()
-        self.mockldap.stop('mockldap.tests.initialize')
+    def test_search_s_after_add_s(self):
+        self.ldapobj.add_s('uid=mike,ou=other,o=test', [('uid', ['mike'])])
 
-        self.assertRaises(KeyError, lambda: self.mockldap[''])
+        results = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE, '(uid=mike)')
 
-    def test_initialize(self):
-        self.mockldap.start()
-        conn = ldap.initialize('ldap:///')
+        self.assertEqual(results, [('uid=mike,ou=other,o=test', {'uid': ['mike']})])
 
-        self.assertEqual(conn.methods_called(), ['initialize'])
+    def test_search_s_after_modify_s(self):
+        self.ldapobj.modify_s(alice[0], [(ldap.MOD_REPLACE, 'uid', 'alice2')])
 
-    def test_specific_content(self):
-        tmp_directory = dict([alice, bob])
-        self.mockldap.set_directory(tmp_directory, uri='ldap://example.com/')
-        self.mockldap.start()
-        conn = ldap.initialize('ldap://example.com/')
+        old = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE, '(uid=alice)')
+        new = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE, '(uid=alice2)')
 
-        self.assertEqual(conn.directory, tmp_directory)
+        self.assertEqual(old, [])
+        self.assertEqual([result[0] for result in new], [alice[0]])
 
-    def test_no_default(self):
-        mockldap = MockLdap()
-        mockldap.start()
+    def test_search_s_after_failed_modify_s(self):
+        with self.assertRaises(ldap.PROTOCOL_ERROR):
+            self.ldapobj.modify_s(alice[0], [(ldap.MOD_REPLACE, 'uid', ['bob']),
+                                             (ldap.MOD_ADD, 'cn', [])])
 
-        self.assertRaises(KeyError, lambda: mockldap[''])
+        old = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE, '(uid=alice)')
+        new = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE, '(uid=bob)')
 
-    def test_indepdendent_connections(self):
-        self.mockldap.start()
+        self.assertEqual(old, [])
+        self.assertEqual([result[0] for result in new], [alice[0]])
 
-        self.assertNotEqual(self.mockldap['foo'], self.mockldap['bar'])
+    def test_search_s_after_rename_s(self):
+        self.ldapobj.rename_s(alice[0], 'uid=alice1')
 
-    def test_volatile_modification(self):
+        results = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE, '(uid=alice1)')
+
+        self.assertEqual([result[0] for result in results],
+                         ['uid=alice1,ou=example,o=test'])
+
+    def test_search_s_after_failed_rename_s(self):
+        # john has no cn value to match his RDN.
+        with self.assertRaises(KeyError):
+            self.ldapobj.rename_s(john[0], 'uid=jack')
+
+        results = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE, '(uid=jack)')
+
+        self.assertEqual(results, [])
+        self.assertEqual(self.ldapobj.directory[john[0]], john[1])
+
+    def test_search_s_after_delete_s(self):
+        self.ldapobj.delete_s(alice[0])
+
+        results = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE, '(uid=alice)')
+
+        self.assertEqual(results, [])
+        self.assertEqual(len(self.ldapobj.directory.indexes['uid'].values), 0)
+
+    def test_search_s_and_with_residual(self):
+        results = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE,
+                                        '(&(userPassword=*)(objectClass=posixAccount))')
+
+        self.assertEqual(sorted(results), sorted([alice, manager, theo]))
+
+    def test_search_s_and_not(self):
+        results = self.ldapobj.search_s("ou=example,o=test", ldap.SCOPE_ONELEVEL,
+                                        '(&(userPassword=*)(!(uid=alice)))')
+
+        self.assertEqual(sorted(results), sorted([manager, theo]))
+
+    def test_search_s_not(self):
+        results = self.ldapobj.search_s("ou=example,o=test", ldap.SCOPE_SUBTREE,
+                                        '(!(userPassword=*))')
+
+        self.assertEqual(sorted(results), sorted([example, john]))
+
+    def test_search_s_or(self):
+        results = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE,
+                                        '(|(uid=alice)(userPassword=bobpw))')
+
+        self.assertEqual(sorted(results), sorted([alice, bob]))
+
+    def test_explain_intersect(self):
+        plan = self.ldapobj.explain("o=test", ldap.SCOPE_SUBTREE,
+                                    '(&(userPassword=*)(uid=alice)(objectClass=top))')
+
+        self.assertEqual(plan.splitlines(), [
+            'candidates in scope 2 of o=test',
+            '  intersect (~1)',
+            '    index uid=alice (~1)',
+            '    index userPassword=* (~4)',
+            'filter (objectClass=top)',
+        ])
+
+    def test_plan_unindexed_and_residual(self):
+        from .filter import parse
+
+        filterstr = '(&(objectClass=top)(cn=alice))'
+        plan = self.ldapobj._plan_search("o=test", ldap.SCOPE_SUBTREE, filterstr)
+
+        self.assertTrue(plan.residual is parse(filterstr))
+
+    def test_plan_partial_and_residual_reused(self):
+        filterstr = '(&(uid=alice)(objectClass=top)(cn=alice))'
+        first = self.ldapobj._plan_search("o=test", ldap.SCOPE_SUBTREE, filterstr)
+        second = self.ldapobj._plan_search("o=test", ldap.SCOPE_SUBTREE, filterstr)
+
+        self.assertEqual(first.residual.unparse(), '(&(objectClass=top)(cn=alice))')
+        self.assertTrue(first.residual is second.residual)
+        self.assertTrue(first.residual.compile() is second.residual.compile())
+
+    def test_explain_unindexed(self):
+        plan = self.ldapobj.explain("o=test", ldap.SCOPE_SUBTREE, '(cn=alice)')
+
+        self.assertEqual(plan.splitlines(), [
+            'walk scope 2 of o=test',
+            'filter (cn=alice)',
+        ])
+
+    def test_search_s_base(self):
+        results = self.ldapobj.search_s(alice[0], ldap.SCOPE_BASE, '(uid=alice)')
+
+        self.assertEqual(results, [alice])
+
+    def test_search_s_base_no_match(self):
+        results = self.ldapobj.search_s(manager[0], ldap.SCOPE_BASE, '(uid=alice)')
+
+        self.assertEqual(results, [])
+
+    def test_explain_base(self):
+        plan = self.ldapobj.explain(alice[0], ldap.SCOPE_BASE, '(uid=alice)')
+
+        self.assertEqual(plan.splitlines(), [
+            'lookup cn=alice,ou=example,o=test',
+            'filter (uid=alice)',
+        ])
+
+    def test_explain_not_recorded(self):
+        self.ldapobj.explain("o=test", ldap.SCOPE_SUBTREE)
+
+        self.assertEqual(self.ldapobj.methods_called(), [])
+
+
+class TestOrdering(unittest.TestCase):
+    ordering_indexes = None
+
+    people = dict([test, example] + [
+        ("uid=user%d,ou=example,o=test" % (i,), {
+            "uid": ["user%d" % (i,)], "uidNumber": [str(i)], "sn": [sn]})
+        for i, sn in [(5, "Alpha"), (9, "bravo"), (10, "Charlie"), (100, "delta")]
+    ])
+
+    def setUp(self):
+        self.mockldap = MockLdap(self.people, ordering_indexes=self.ordering_indexes)
         self.mockldap.start()
-        conn1 = ldap.initialize('')
-        conn1.directory['cn=alice,ou=example,o=test'][
-            'userPassword'][0] = 'modified'
-        self.mockldap.stop()
+        self.ldapobj = self.mockldap['ldap://localhost']
+
+    def tearDown(self):
+        self.mockldap.stop_all()
+
+    def search_uids(self, filterstr):
+        results = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE, filterstr)
+
+        return sorted(int(attrs['uidNumber'][0]) for dn, attrs in results)
+
+    def test_greater_or_equal_numeric(self):
+        self.assertEqual(self.search_uids('(uidNumber>=10)'), [10, 100])
+
+    def test_less_or_equal_numeric(self):
+        self.assertEqual(self.search_uids('(uidNumber<=9)'), [5, 9])
+
+    def test_range(self):
+        self.assertEqual(self.search_uids('(&(uidNumber>=6)(uidNumber<=10))'), [9, 10])
+
+    def test_string_case_insensitive(self):
+        self.assertEqual(self.search_uids('(sn>=BRAVO)'), [9, 10, 100])
+        self.assertEqual(self.search_uids('(sn<=charlie)'), [5, 9, 10])
+
+    def test_incomparable(self):
+        self.assertEqual(self.search_uids('(uidNumber>=abc)'), [])
+
+    def test_after_modify_s(self):
+        self.ldapobj.modify_s("uid=user5,ou=example,o=test",
+                              [(ldap.MOD_REPLACE, 'uidNumber', ['50'])])
+
+        self.assertEqual(self.search_uids('(uidNumber>=50)'), [50, 100])
+        self.assertEqual(self.search_uids('(uidNumber<=5)'), [])
+
+    def test_after_delete_s(self):
+        self.ldapobj.delete_s("uid=user100,ou=example,o=test")
 
+        self.assertEqual(self.search_uids('(uidNumber>=10)'), [10])
+
+    def test_not(self):
+        self.assertEqual(self.search_uids('(&(uid=*)(!(uidNumber>=10)))'), [5, 9])
+
+
+class TestOrderingIndex(TestOrdering):
+    ordering_indexes = ['uidNumber', 'sn']
+
+    def test_explain(self):
+        plan = self.ldapobj.explain("o=test", ldap.SCOPE_SUBTREE, '(uidNumber>=10)')
+
+        self.assertEqual(plan.splitlines(), [
+            'candidates in scope 2 of o=test',
+            '  index uidNumber>=10 (~2)',
+        ])
+
+    def test_snapshot_isolation(self):
+        other = self.mockldap['ldap://other']
+        other.delete_s("uid=user100,ou=example,o=test")
+
+        self.assertEqual(self.search_uids('(uidNumber>=10)'), [10, 100])
+
+
+class TestSubstringIndex(unittest.TestCase):
+    people = dict([test, example] + [
+        ("uid=%s,ou=example,o=test" % (uid,), {"uid": [uid], "mail": ["%s@%s" % (uid, domain)]})
+        for uid, domain in [("alice", "example.com"), ("malice", "example.org"),
+                            ("alicia", "example.com"), ("bob", "example.com")]
+    ])
+
+    def setUp(self):
+        self.mockldap = MockLdap(self.people, substring_indexes=['uid', 'mail'])
         self.mockldap.start()
-        conn2 = ldap.initialize('')
-        self.mockldap.stop()
+        self.ldapobj = self.mockldap['ldap://localhost']
 
-        self.assertNotEqual(conn1.directory, conn2.directory)
+    def tearDown(self):
+        self.mockldap.stop_all()
+
+    def search_uids(self, filterstr):
+        results = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE, filterstr)
+
+        return sorted(attrs['uid'][0] for dn, attrs in results)
+
+    def test_initial(self):
+        self.assertEqual(self.search_uids('(uid=Ali*)'), ['alice', 'alicia'])
+
+    def test_final(self):
+        self.assertEqual(self.search_uids('(mail=*@example.com)'), ['alice', 'alicia', 'bob'])
+
+    def test_any(self):
+        self.assertEqual(self.search_uids('(uid=*lic*)'), ['alice', 'alicia', 'malice'])
+
+    def test_false_positive(self):
+        # Every gram occurs in the .com addresses, but not in this order.
+        self.assertEqual(self.search_uids('(mail=*com*example*)'), [])
+        self.assertEqual(self.search_uids('(uid=ali*ice)'), [])
+
+    def test_short_substrings(self):
+        self.assertEqual(self.search_uids('(uid=*b*)'), ['bob'])
+        self.assertEqual(self.ldapobj.explain("o=test", ldap.SCOPE_SUBTREE, '(uid=*b*)').splitlines(), [
+            'walk scope 2 of o=test',
+            'filter (uid=*b*)',
+        ])
+
+    def test_after_modify_s(self):
+        self.ldapobj.modify_s("uid=bob,ou=example,o=test",
+                              [(ldap.MOD_REPLACE, 'mail', ['bob@example.net'])])
+
+        self.assertEqual(self.search_uids('(mail=*.com)'), ['alice', 'alicia'])
+        self.assertEqual(self.search_uids('(mail=*.net)'), ['bob'])
+
+    def test_explain(self):
+        plan = self.ldapobj.explain("o=test", ldap.SCOPE_SUBTREE, '(uid=ali*)')
+
+        self.assertEqual(plan.splitlines(), [
+            'candidates in scope 2 of o=test',
+            '  index uid=ali* (~2)',
+            'filter (uid=ali*)',
+        ])
+
+
+class TestMatchingRules(unittest.TestCase):
+    indexes = None
+
+    group = ("cn=admins,o=test", {
+        "cn": ["admins"], "member": ["cn=alice,ou=example,o=test"], "gidNumber": ["100"],
+        "objectClass": ["top", "groupOfNames"]})
+
+    rules = {
+        'uid': CASE_IGNORE,
+        'cn': CASE_IGNORE,
+        'gidNumber': INTEGER,
+        'member': DISTINGUISHED_NAME,
+        'objectClass': CASE_EXACT,
+    }
+
+    def setUp(self):
+        self.mockldap = MockLdap(dict(directory, **dict([self.group])),
+                                 indexes=self.indexes, matching_rules=self.rules)
+        self.mockldap.start()
+        self.ldapobj = self.mockldap['ldap://localhost']
+
+    def tearDown(self):
+        self.mockldap.stop_all()
+
+    def search_dns(self, filterstr):
+        results = self.ldapobj.search_s("o=test", ldap.SCOPE_SUBTREE, filterstr)
+
+        return sorted(dn for dn, attrs in results)
+
+    def test_case_ignore(self):
+        self.assertEqual(self.search_dns('(uid=  ALICE )'), [alice[0]])
+
+    def test_case_exact(self):
+        self.assertEqual(self.search_dns('(objectClass=GROUPOFNAMES)'), [])
+        self.assertEqual(self.search_dns('(objectClass=groupOfNames)'), [self.group[0]])
+
+    def test_no_rule(self):
+        self.assertEqual(self.search_dns('(userPassword=ALICEPW)'), [])
+
+    def test_integer(self):
+        self.assertEqual(self.search_dns('(gidNumber=0100)'), [self.group[0]])
+
+    def test_distinguished_name(self):
+        self.assertEqual(self.search_dns('(member=CN=Alice, OU=Example, O=Test)'), [self.group[0]])
+
+    def test_after_modify_s(self):
+        self.ldapobj.modify_s(alice[0], [(ldap.MOD_REPLACE, 'uid', ['Alice2'])])
+
+        self.assertEqual(self.search_dns('(uid=alice)'), [])
+        self.assertEqual(self.search_dns('(uid=ALICE2)'), [alice[0]])
+
+    def test_after_add_s(self):
+        self.ldapobj.add_s('cn=mike,ou=other,o=test', [('cn', ['Mike'])])
+
+        self.assertEqual(self.search_dns('(cn=mike)'), ['cn=mike,ou=other,o=test'])
+
+    def test_attribute_case(self):
+        self.ldapobj.add_s('cn=mike,ou=other,o=test', [('UID', ['Mike']), ('GIDNUMBER', ['07'])])
+
+        self.assertEqual(self.search_dns('(uid=mike)'), ['cn=mike,ou=other,o=test'])
+        self.assertEqual(self.search_dns('(gidNumber=7)'), ['cn=mike,ou=other,o=test'])
+
+    def test_presence_attribute_case(self):
+        self.ldapobj.add_s('cn=mike,ou=other,o=test', [('UID', ['Mike'])])
+
+        self.assertEqual(self.search_dns('(uid=*)'), [alice[0], 'cn=mike,ou=other,o=test'])
+
+    def test_presence_with_and_without_index(self):
+        people = {
+            "o=test": {"objectClass": ["top"]},
+            "cn=alice,o=test": {"CN": ["Alice"]},
+            "cn=bob,o=test": {"cn": ["Bob"]},
+        }
+
+        for indexes in [None, ['cn']]:
+            mockldap = MockLdap(people, indexes=indexes, matching_rules={'cn': CASE_IGNORE})
+            mockldap.start()
+            try:
+                results = mockldap['ldap://localhost'].search_s("o=test", ldap.SCOPE_SUBTREE, '(cn=*)')
+            finally:
+                mockldap.stop()
+
+            self.assertEqual(sorted(dn for dn, attrs in results),
+                             ['cn=alice,o=test', 'cn=bob,o=test'], indexes)
+
+    def test_compare_s(self):
+        self.assertEqual(self.ldapobj.compare_s(alice[0], 'uid', 'ALICE'), 1)
+        self.assertEqual(self.ldapobj.compare_s(alice[0], 'userPassword', 'ALICEPW'), 0)
+
+    def test_not(self):
+        self.assertEqual(self.search_dns('(&(uid=*)(!(uid=ALICE)))'), [])
+
+    def test_unknown_rule(self):
+        with self.assertRaises(ValueError):
+            MockLdap(directory, matching_rules={'uid': 'bogus'})
+
+
+class TestIndexedMatchingRules(TestMatchingRules):
+    indexes = ['uid', 'gidNumber']
+
+    def test_explain(self):
+        plan = self.ldapobj.explain("o=test", ldap.SCOPE_SUBTREE, '(uid=ALICE)')
+
+        self.assertEqual(plan.splitlines(), [
+            'candidates in scope 2 of o=test',
+            '  index uid=ALICE (~1)',
+        ])
+
+
+@unittest.skipIf(not passlib, "passlib needs to be installed")
+class TestPasswordCache(unittest.TestCase):
+    def setUp(self):
+        from passlib.hash import ldap_salted_sha1, ldap_sha1
+
+        self.people = dict(directory)
+        self.people['cn=sam,ou=example,o=test'] = {
+            'userPassword': [ldap_salted_sha1.encrypt('sampw')]}
+        self.people['cn=sue,ou=example,o=test'] = {
+            'userPassword': [ldap_sha1.encrypt('suepw')]}
+
+        self.mockldap = MockLdap(self.people, password_cache=100)
+        self.mockldap.start()
+        self.ldapobj = self.mockldap['ldap://localhost']
+        self.cache = self.ldapobj._password_cache
+
+    def tearDown(self):
+        self.mockldap.stop_all()
+
+    def test_ssha(self):
+        self.assertEqual(self.ldapobj.simple_bind_s('cn=sam,ou=example,o=test', 'sampw'), (97, []))
+        with self.assertRaises(ldap.INVALID_CREDENTIALS):
+            self.ldapobj.simple_bind_s('cn=sam,ou=example,o=test', 'sampw2')
+
+    def test_sha(self):
+        self.assertEqual(self.ldapobj.simple_bind_s('cn=sue,ou=example,o=test', 'suepw'), (97, []))
+        with self.assertRaises(ldap.INVALID_CREDENTIALS):
+            self.ldapobj.simple_bind_s('cn=sue,ou=example,o=test', 'suepw2')
+
+    def test_cached(self):
+        for i in xrange(3):
+            self.ldapobj.simple_bind_s('cn=theo,ou=example,o=test', 'theopw')
+            self.ldapobj.simple_bind_s('CN=Theo,ou=example,o=test', 'theopw2')
+
+        # theopw matches the first hash; theopw2 is checked against both.
+        self.assertEqual(self.cache.info().currsize, 3)
+        self.assertEqual(self.cache.info().misses, 3)
+
+    def test_wrong_passwords_bounded(self):
+        for i in xrange(200):
+            with self.assertRaises(ldap.INVALID_CREDENTIALS):
+                self.ldapobj.simple_bind_s('cn=sam,ou=example,o=test', 'wrong%d' % (i,))
+
+        self.assertEqual(self.cache.info().currsize, 100)
+        self.assertTrue(len(self.cache._keys['cn=sam,ou=example,o=test']) <= 256)
+
+    def test_cached_failure(self):
+        for i in xrange(2):
+            with self.assertRaises(ldap.INVALID_CREDENTIALS):
+                self.ldapobj.simple_bind_s('cn=theo,ou=example,o=test', 'wrong')
+
+    def test_cached_unicode(self):
+        for i in xrange(2):
+            with self.assertRaises(ldap.INVALID_CREDENTIALS):
+                self.ldapobj.simple_bind_s('cn=sam,ou=example,o=test', u'w\xf6rong')
+
+        self.assertEqual(self.cache.info().currsize, 1)
+
+    def test_modify_s_invalidates(self):
+        from passlib.hash import ldap_salted_sha1
+
+        self.ldapobj.simple_bind_s('cn=sam,ou=example,o=test', 'sampw')
+        self.ldapobj.modify_s('cn=sam,ou=example,o=test', [
+            (ldap.MOD_REPLACE, 'userPassword', [ldap_salted_sha1.encrypt('newpw')])])
+
+        self.assertEqual(self.cache.info().currsize, 0)
+        self.assertEqual(self.ldapobj.simple_bind_s('cn=sam,ou=example,o=test', 'newpw'), (97, []))
+        with self.assertRaises(ldap.INVALID_CREDENTIALS):
+            self.ldapobj.simple_bind_s('cn=sam,ou=example,o=test', 'sampw')
+
+    def test_delete_s_invalidates(self):
+        self.ldapobj.simple_bind_s('cn=sam,ou=example,o=test', 'sampw')
+        self.ldapobj.delete_s('cn=sam,ou=example,o=test')
+
+        self.assertEqual(self.cache.info().currsize, 0)
+
+    def test_invalidate_one_entry(self):
+        self.ldapobj.simple_bind_s('cn=sam,ou=example,o=test', 'sampw')
+        self.ldapobj.simple_bind_s('cn=sue,ou=example,o=test', 'suepw')
+        self.ldapobj.delete_s('cn=sam,ou=example,o=test')
+
+        self.assertEqual(self.cache.info().currsize, 1)
+
+    def test_plain_not_cached(self):
+        self.ldapobj.simple_bind_s(alice[0], 'alicepw')
+
+        self.assertEqual(self.cache.info().currsize, 0)
+
+    def test_compare_s(self):
+        self.assertEqual(self.ldapobj.compare_s('cn=sam,ou=example,o=test', 'userPassword', 'sampw'), 1)
+        self.assertEqual(self.ldapobj.compare_s('cn=sam,ou=example,o=test', 'userPassword', 'x'), 0)
+
+
+class TestResultModes(unittest.TestCase):
+    def setUp(self):
+        self.mockldap = MockLdap(directory, result_mode=RESULT_SHALLOW)
+        self.mockldap.start()
+        self.ldapobj = self.mockldap['ldap://localhost']
+
+    def tearDown(self):
+        self.mockldap.stop()
+        del self.mockldap
+
+    def test_shallow_results(self):
+        results = self.ldapobj.search_s(alice[0], ldap.SCOPE_BASE)
+
+        self.assertEqual(results, [alice])
+
+    def test_shallow_results_isolated(self):
+        results = self.ldapobj.search_s(alice[0], ldap.SCOPE_BASE)
+        results[0][1]['cn'].append('mallory')
+        results[0][1]['uid'] = ['mallory']
+
+        self.assertEqual(self.ldapobj.directory[alice[0]], alice[1])
+        self.assertEqual(self.ldapobj.search_s(alice[0], ldap.SCOPE_BASE), [alice])
+
+    def test_shallow_seeded_results_isolated(self):
+        self.ldapobj.search_s.seed('o=test', ldap.SCOPE_ONELEVEL)([example])
+
+        self.ldapobj.search_s('o=test', ldap.SCOPE_ONELEVEL)[0][1]['objectClass'].append('x')
+
+        self.assertEqual(self.ldapobj.search_s('o=test', ldap.SCOPE_ONELEVEL), [example])
+
+    def test_frozen_results(self):
+        self.ldapobj.set_result_mode(RESULT_FROZEN)
+
+        results = self.ldapobj.search_s(alice[0], ldap.SCOPE_BASE)
+
+        self.assertEqual(results, ((alice[0], dict((k, tuple(v)) for k, v in alice[1].items())),))
+        with self.assertRaises(TypeError):
+            results[0][1]['uid'] = ['mallory']
+        with self.assertRaises(AttributeError):
+            results[0][1]['cn'].append('mallory')
+
+    def test_frozen_results_copied(self):
+        self.ldapobj.set_result_mode(RESULT_FROZEN)
+
+        results = self.ldapobj.search_s(alice[0], ldap.SCOPE_BASE)
+
+        for copied in [copy(results), deepcopy(results), pickle.loads(pickle.dumps(results)),
+                       cPickle.loads(cPickle.dumps(results, cPickle.HIGHEST_PROTOCOL))]:
+            self.assertEqual(copied, results)
+            self.assertIsInstance(copied[0][1], FrozenDict)
+
+    def test_method_result_mode(self):
+        self.ldapobj.search_s.set_result_mode(RESULT_FROZEN)
+
+        self.assertIsInstance(self.ldapobj.search_s(alice[0], ldap.SCOPE_BASE), tuple)
+        self.assertIsInstance(self.ldapobj.result(self.ldapobj.search(alice[0], ldap.SCOPE_BASE))[1], list)
+
+    def test_method_result_mode_reset(self):
+        self.ldapobj.search_s.set_result_mode(RESULT_FROZEN)
+        self.ldapobj.search_s.set_result_mode(None)
+
+        self.assertIsInstance(self.ldapobj.search_s(alice[0], ldap.SCOPE_BASE), list)
+
+    def test_unknown_result_mode(self):
+        with self.assertRaises(ValueError):
+            self.ldapobj.set_result_mode('bogus')
+
+
+class TestRecording(unittest.TestCase):
+    def setUp(self):
+        self.mockldap = MockLdap(directory, recording=2)
+        self.mockldap.start()
+        self.ldapobj = self.mockldap['ldap://localhost']
+
+    def tearDown(self):
+        self.mockldap.stop()
+        del self.mockldap
+
+    def test_ring_buffer(self):
+        self.ldapobj.simple_bind_s(alice[0], 'alicepw')
+        self.ldapobj.search_s(alice[0], ldap.SCOPE_BASE)
+        self.ldapobj.unbind_s()
+
+        self.assertEqual(self.ldapobj.methods_called(), ['search_s', 'unbind_s'])
+        self.assertEqual(self.ldapobj.methods_called(with_args=True)[0],
+                         ('search_s', (alice[0], ldap.SCOPE_BASE), {}))
+
+    def test_counts_only(self):
+        self.ldapobj.set_recording(RECORD_COUNTS)
+        self.ldapobj.simple_bind_s(alice[0], 'alicepw')
+
+        self.assertEqual(self.ldapobj.methods_called(), [])
+        self.assertEqual(self.ldapobj.call_counts(), {'simple_bind_s': 1})
+        self.assertEqual(self.ldapobj.bound_as, alice[0])
+
+    def test_off(self):
+        self.ldapobj.set_recording(RECORD_OFF)
+        self.ldapobj.simple_bind_s(alice[0], 'alicepw')
+
+        self.assertEqual(self.ldapobj.methods_called(), [])
+        self.assertEqual(self.ldapobj.call_counts(), {})
+
+    def test_call_counts(self):
+        self.ldapobj.simple_bind_s(alice[0], 'alicepw')
+        self.ldapobj.search_s(alice[0], ldap.SCOPE_BASE)
+        self.ldapobj.search_s(alice[0], ldap.SCOPE_BASE)
+
+        self.assertEqual(self.ldapobj.call_counts(), {'simple_bind_s': 1, 'search_s': 2})
+        self.assertEqual(self.ldapobj.total_calls(), 3)
+
+    def test_add_s_result_counts_calls(self):
+        self.ldapobj.search_s(alice[0], ldap.SCOPE_BASE)
+        self.ldapobj.search_s(alice[0], ldap.SCOPE_BASE)
+
+        result = self.ldapobj.add_s('cn=mike,ou=example,o=test', [('cn', ['mike'])])
+
+        self.assertEqual(result[2], 3)
+
+    def test_switch_to_full(self):
+        self.ldapobj.simple_bind_s(alice[0], 'alicepw')
+        self.ldapobj.set_recording(RECORD_FULL)
+        self.ldapobj.unbind_s()
+        self.ldapobj.unbind_s()
+
+        self.assertEqual(self.ldapobj.methods_called(),
+                         ['simple_bind_s', 'unbind_s', 'unbind_s'])
+
+    def test_invalid_recording(self):
+        with self.assertRaises(ValueError):
+            self.ldapobj.set_recording(0)
+
+
+class TestSearchExt(unittest.TestCase):
+    def setUp(self):
+        self.mockldap = MockLdap(directory)
+        self.mockldap.start()
+        self.ldapobj = self.mockldap['ldap://localhost']
+
+    def tearDown(self):
+        self.mockldap.stop()
+        del self.mockldap
+
+    def _paged_search(self, size, *args, **kwargs):
+        control = SimplePagedResultsControl(True, size, '')
+        pages = []
+
+        while True:
+            msgid = self.ldapobj.search_ext(serverctrls=[control], *args, **kwargs)
+            rtype, rdata, rmsgid, serverctrls = self.ldapobj.result3(msgid)
+            pages.append(rdata)
+
+            control.cookie = serverctrls[0].cookie
+            if not control.cookie:
+                break
+
+        return pages
+
+    def test_search_ext_s(self):
+        results = self.ldapobj.search_ext_s("ou=example,o=test", ldap.SCOPE_ONELEVEL,
+                                            '(userPassword=*)')
+
+        self.assertEqual(sorted(results), sorted([alice, manager, theo]))
+
+    def test_search_ext_result3(self):
+        msgid = self.ldapobj.search_ext(alice[0], ldap.SCOPE_BASE)
+
+        self.assertEqual(self.ldapobj.result3(msgid), (ldap.RES_SEARCH_RESULT, [alice], msgid, []))
+
+    def test_paged(self):
+        pages = self._paged_search(3, "o=test", ldap.SCOPE_SUBTREE)
+
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual(sorted(sum(pages, [])), sorted(directory.items()))
+        self.assertEqual(len(self.ldapobj._paged_searches), 0)
+
+    def test_paged_exact_pages(self):
+        pages = self._paged_search(4, "o=test", ldap.SCOPE_SUBTREE)
+
+        self.assertEqual([len(page) for page in pages], [4, 4])
+
+    def test_paged_sees_snapshot(self):
+        control = SimplePagedResultsControl(True, 1, '')
+        msgid = self.ldapobj.search_ext("ou=example,o=test", ldap.SCOPE_ONELEVEL,
+                                        serverctrls=[control])
+        control.cookie = self.ldapobj.result3(msgid)[3][0].cookie
+
+        for dn in [manager[0], alice[0], theo[0], john[0]]:
+            self.ldapobj.delete_s(dn)
+        pages = [self.ldapobj.search_ext_s("ou=example,o=test", ldap.SCOPE_ONELEVEL,
+                                           serverctrls=[control])]
+
+        self.assertEqual(len(pages[0]), 1)
+
+    def test_paged_abandon(self):
+        control = SimplePagedResultsControl(True, 1, '')
+        msgid = self.ldapobj.search_ext("o=test", ldap.SCOPE_SUBTREE, serverctrls=[control])
+        control.cookie = self.ldapobj.result3(msgid)[3][0].cookie
+        control.size = 0
+
+        msgid = self.ldapobj.search_ext("o=test", ldap.SCOPE_SUBTREE, serverctrls=[control])
+
+        self.assertEqual(self.ldapobj.result3(msgid)[1], [])
+        self.assertEqual(len(self.ldapobj._paged_searches), 0)
+
+    def test_paged_abandon_msgid(self):
+        control = SimplePagedResultsControl(True, 1, '')
+        msgid = self.ldapobj.search_ext("o=test", ldap.SCOPE_SUBTREE, serverctrls=[control])
+        self.ldapobj.abandon_ext(msgid)
+
+        self.assertEqual(self.ldapobj.result3(msgid)[1], None)
+        self.assertEqual(len(self.ldapobj._paged_searches), 0)
+
+    def test_paged_limit(self):
+        from .ldapobject import MAX_PAGED_SEARCHES
+
+        control = SimplePagedResultsControl(True, 1, '')
+        cookies = []
+        for i in xrange(MAX_PAGED_SEARCHES + 1):
+            msgid = self.ldapobj.search_ext("o=test", ldap.SCOPE_SUBTREE, serverctrls=[control])
+            cookies.append(self.ldapobj.result3(msgid)[3][0].cookie)
+
+        self.assertEqual(len(self.ldapobj._paged_searches), MAX_PAGED_SEARCHES)
+        control.cookie = cookies[0]
+        with self.assertRaises(ldap.PROTOCOL_ERROR):
+            self.ldapobj.search_ext("o=test", ldap.SCOPE_SUBTREE, serverctrls=[control])
+        control.cookie = cookies[-1]
+        self.assertEqual(len(self.ldapobj.search_ext_s("o=test", ldap.SCOPE_SUBTREE,
+                                                       serverctrls=[control])), 1)
+
+    def test_paged_invalid_cookie(self):
+        control = SimplePagedResultsControl(True, 1, 'bogus')
+
+        with self.assertRaises(ldap.PROTOCOL_ERROR):
+            self.ldapobj.search_ext("o=test", ldap.SCOPE_SUBTREE, serverctrls=[control])
+
+    def test_paged_sizelimit(self):
+        with self.assertRaises(ldap.SIZELIMIT_EXCEEDED):
+            self._paged_search(3, "o=test", ldap.SCOPE_SUBTREE, sizelimit=5)
+
+    def test_sizelimit_s(self):
+        with self.assertRaises(ldap.SIZELIMIT_EXCEEDED):
+            self.ldapobj.search_ext_s("o=test", ldap.SCOPE_SUBTREE, sizelimit=2)
+
+    def test_sizelimit_not_exceeded(self):
+        results = self.ldapobj.search_ext_s("ou=other,o=test", ldap.SCOPE_SUBTREE, sizelimit=2)
+
+        self.assertEqual(sorted(results), sorted([other, bob]))
+
+    def test_sizelimit_incremental(self):
+        msgid = self.ldapobj.search_ext("o=test", ldap.SCOPE_SUBTREE, sizelimit=1)
+
+        self.assertEqual(self.ldapobj.result(msgid, all=0)[0], ldap.RES_SEARCH_ENTRY)
+        with self.assertRaises(ldap.SIZELIMIT_EXCEEDED):
+            self.ldapobj.result(msgid, all=0)
+
+    def test_unsupported_critical_control(self):
+        control = ldap.controls.LDAPControl('1.2.3.4', True)
+
+        with self.assertRaises(SeedRequired):
+            self.ldapobj.search_ext_s("o=test", ldap.SCOPE_SUBTREE, serverctrls=[control])
+
+
+class TestThreadSafety(unittest.TestCase):
+    def setUp(self):
+        self.mockldap = MockLdap(directory, indexes=['uid'], thread_safe=True)
+        self.mockldap.start()
+        self.ldapobj = self.mockldap['ldap://localhost']
+
+    def tearDown(self):
+        self.mockldap.stop()
+        del self.mockldap
+
+    def _hammer(self, worker, threads=8):
+        errors = []
+
+        def run(n):
+            try:
+                worker(n)
+            except Exception, e:
+                errors.append(e)
+
+        workers = [threading.Thread(target=run, args=(n,)) for n in xrange(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+    def test_stress(self):
+        ldapobj = self.ldapobj
+        rounds = 50
+
+        def worker(n):
+            for i in xrange(rounds):
+                dn = 'uid=user%d-%d,ou=example,o=test' % (n, i)
+                ldapobj.add_s(dn, [('uid', ['user%d-%d' % (n, i)]), ('objectClass', ['top'])])
+                ldapobj.modify_s(dn, [(ldap.MOD_ADD, 'cn', ['user'])])
+                ldapobj.simple_bind_s(alice[0], 'alicepw')
+                found = ldapobj.search_s('o=test', ldap.SCOPE_SUBTREE, '(uid=user%d-%d)' % (n, i))
+                assert [result[0] for result in found] == [dn], found
+                msgid = ldapobj.search('ou=example,o=test', ldap.SCOPE_ONELEVEL)
+                assert ldapobj.result(msgid)[0] == ldap.RES_SEARCH_RESULT
+                if i % 2:
+                    ldapobj.delete_s(dn)
+
+        self._hammer(worker)
+
+        self.assertEqual(ldapobj.total_calls(), 8 * rounds * 13 // 2)
+        self.assertEqual(len(ldapobj.methods_called()), ldapobj.total_calls())
+        self.assertEqual(ldapobj.async_results, {})
+
+        results = ldapobj.search_s('ou=example,o=test', ldap.SCOPE_ONELEVEL, '(cn=user)')
+        self.assertEqual(len(results), 8 * rounds // 2)
+
+    def test_paged_search_during_writes(self):
+        ldapobj = self.ldapobj
+
+        def worker(n):
+            for i in xrange(20):
+                if n % 2:
+                    dn = 'uid=user%d-%d,ou=example,o=test' % (n, i)
+                    ldapobj.add_s(dn, [('uid', ['x']), ('objectClass', ['top'])])
+                else:
+                    control = SimplePagedResultsControl(True, 2, '')
+                    entries = []
+                    while True:
+                        msgid = ldapobj.search_ext('o=test', ldap.SCOPE_SUBTREE, serverctrls=[control])
+                        rtype, rdata, rmsgid, serverctrls = ldapobj.result3(msgid)
+                        entries.extend(rdata)
+                        control.cookie = serverctrls[0].cookie
+                        if not control.cookie:
+                            break
+                    assert len(entries) >= len(directory)
+
+        self._hammer(worker)
+
+    def test_search_iter_under_read_lock(self):
+        with self.ldapobj._lock.reading():
+            results = list(self.ldapobj.search_iter(alice[0], ldap.SCOPE_BASE))
+
+        self.assertEqual(results, [alice])
+
+    def test_search_iter_after_write_shares_base(self):
+        self.ldapobj.modify_s(alice[0], [(ldap.MOD_REPLACE, 'uid', ['alice2'])])
+        base = self.ldapobj.directory.data.base
+
+        results = list(self.ldapobj.search_iter('o=test', ldap.SCOPE_SUBTREE, '(uid=alice2)'))
+
+        self.assertEqual([result[0] for result in results], [alice[0]])
+        self.assertTrue(self.ldapobj.directory.data.base is base)
+
+    def test_rwlock_excludes_writers(self):
+        from .locking import RWLock
+
+        lock = RWLock()
+        state = {'readers': 0, 'writers': 0, 'overlap': False}
+
+        def worker(n):
+            for i in xrange(200):
+                if (n + i) % 4:
+                    with lock.reading():
+                        state['readers'] += 1
+                        if state['writers']:
+                            state['overlap'] = True
+                        state['readers'] -= 1
+                else:
+                    with lock.writing():
+                        state['writers'] += 1
+                        if state['writers'] > 1:
+                            state['overlap'] = True
+                        state['writers'] -= 1
+
+        self._hammer(worker)
+
+        self.assertFalse(state['overlap'])
+
+
+class TestFilterCache(unittest.TestCase):
+    def setUp(self):
+        from . import filter
+
+        self.filter = filter
+        self.filter.clear_cache()
+
+    def tearDown(self):
+        self.filter.set_cache_size(256)
+        self.filter.clear_cache()
+
+    def test_parse_shared(self):
+        first = self.filter.parse('(&(uid=alice)(objectClass=top))')
+        second = self.filter.parse('(&(uid=alice)(objectClass=top))')
+
+        self.assertTrue(first is second)
+        self.assertEqual(self.filter.cache_info().hits, 1)
+        self.assertEqual(self.filter.cache_info().misses, 1)
+
+    def test_parse_terms_immutable(self):
+        filter_expr = self.filter.parse('(|(uid=alice)(uid=bob))')
+
+        self.assertRaises(AttributeError, lambda: filter_expr.terms.append(None))
+
+    def test_set_cache_size(self):
+        self.filter.set_cache_size(2)
+        for filterstr in ['(a=1)', '(a=2)', '(a=3)']:
+            self.filter.parse(filterstr)
+
+        self.assertEqual(self.filter.cache_info().currsize, 2)
+
+    def test_disabled(self):
+        self.filter.set_cache_size(0)
+
+        self.assertFalse(self.filter.parse('(a=1)') is self.filter.parse('(a=1)'))
+
+    def test_errors_not_cached(self):
+        self.assertRaises(ldap.FILTER_ERROR, self.filter.parse, '(a=)')
+
+        self.assertEqual(self.filter.cache_info().currsize, 0)
+
+    def test_compile_cached(self):
+        first = self.filter.parse('(&(uid=alice)(objectClass=top))').compile()
+        second = self.filter.parse('(&(uid=alice)(objectClass=top))').compile()
+
+        self.assertTrue(first is second)
+
+    def test_compile_matches(self):
+        filterstrs = [
+            '(uid=alice)', '(uid=*)', '(userPassword=ali*)', '(cn>=b)', '(cn<=b)',
+            '(&(objectClass=top)(&(objectClass=posixAccount)(uid=*)))',
+            '(|(uid=alice)(|(cn=bob)(userPassword=*pw2)))',
+            '(!(!(uid=alice)))', '(&(objectClass=top)(!(userPassword=*)))',
+            '(|(&(uid=alice)(cn=alice))(!(objectClass=posixAccount)))',
+        ]
+
+        for filterstr in filterstrs:
+            filter_expr = self.filter.parse(filterstr)
+            matches = filter_expr.compile()
+            for dn, attrs in directory.iteritems():
+                self.assertEqual(bool(matches(dn, attrs)), bool(filter_expr.matches(dn, attrs)),
+                                 (filterstr, dn))
+
+
+class TestDNCache(unittest.TestCase):
+    def setUp(self):
+        from . import dn
+
+        self.dn = dn
+        self.dn.clear_cache()
+
+    def tearDown(self):
+        self.dn.set_cache_size(4096)
+        self.dn.clear_cache()
+
+    def test_parse_shared(self):
+        first = self.dn.parse('cn=alice,ou=example,o=test')
+        second = self.dn.parse('cn=alice,ou=example,o=test')
+
+        self.assertTrue(first is second)
+        self.assertEqual(self.dn.cache_info().hits, 1)
+        self.assertEqual(self.dn.cache_info().misses, 1)
+
+    def test_normalize(self):
+        self.assertEqual(self.dn.normalize('CN=Alice, OU=Example,o=test'),
+                         ('cn=alice', 'ou=example', 'o=test'))
+
+    def test_invalid_cached(self):
+        self.assertRaises(ldap.INVALID_DN_SYNTAX, self.dn.parse, 'invalid')
+        self.assertRaises(ldap.INVALID_DN_SYNTAX, self.dn.parse, 'invalid')
+
+        self.assertEqual(self.dn.cache_info().misses, 1)
+
+    def test_set_cache_size(self):
+        self.dn.set_cache_size(2)
+        for dn in ['o=a', 'o=b', 'o=c']:
+            self.dn.parse(dn)
+
+        self.assertEqual(self.dn.cache_info().currsize, 2)
+
+    def test_search_s_reuses_parsed_dns(self):
+        mockldap = MockLdap(directory)
+        mockldap.start()
+        try:
+            ldapobj = mockldap['ldap://localhost']
+            ldapobj.search_s(alice[0], ldap.SCOPE_BASE)
+            misses = self.dn.cache_info().misses
+            ldapobj.search_s(alice[0], ldap.SCOPE_BASE)
+        finally:
+            mockldap.stop()
+
+        self.assertEqual(self.dn.cache_info().misses, misses)
+
+
+class TestNativeParser(unittest.TestCase):
+    filterstrs = [
+        '(uid=alice)',
+        '(objectClass=*)',
+        '(&(objectClass=top)(objectClass=posixAccount)(userPassword=*))',
+        '(|(objectClass=inetOrgPerson)(!(userPassword=alicepw)))',
+        '(objectClass=a & b | c ! d)',
+        '', '(', 'invalid=*', '(&)', '(!)', '(&(a=b)', '(a=b)(c=d)',
+        '(!(a=b)(c=d))', '(a=b))', '((a=b))', '(invalid=)',
+    ]
+
+    def setUp(self):
+        from . import filter
+
+        self.filter = filter
+        self.use_native_parser = filter.use_native_parser
+
+    def tearDown(self):
+        self.filter.use_native_parser = self.use_native_parser
+
+    def _parse(self, filterstr, native):
+        self.filter.use_native_parser = native
+        try:
+            return self.filter._parse(filterstr).unparse()
+        except ldap.FILTER_ERROR, e:
+            return str(e)
+
+    def test_parse(self):
+        filter_expr = self.filter.NativeParser(self.filter.tokenize('(&(a=b)(!(c=*)))')).parse()
+
+        self.assertEqual(filter_expr.unparse(), '(&(a=b)(!(c=*)))')
+
+    def test_parse_error(self):
+        parser = self.filter.NativeParser(self.filter.tokenize('(&(a=b)'))
+
+        self.assertRaises(ldap.FILTER_ERROR, parser.parse)
+
+    def test_same_as_grammar(self):
+        if self.filter.NoParseError is None:
+            self.skipTest("funcparserlib needs to be installed")
+
+        for filterstr in self.filterstrs:
+            self.assertEqual(self._parse(filterstr, True),
+                             self._parse(filterstr, False))
+
+
+def initialize(*args, **kwargs):
+    """ Dummy patch target for the tests below. """
+    pass
+
+
+class TestLoadLdif(unittest.TestCase):
+    ldif = (
+        "dn: o=test\n"
+        "objectClass: top\n"
+        "\n"
+        "dn: ou=example,o=test\n"
+        "objectClass: top\n"
+        "\n"
+        "dn: cn=alice,ou=example,o=test\n"
+        "cn: alice\n"
+        "uid: alice\n"
+        "userPassword: alicepw\n"
+        "objectClass: top\n"
+        "objectClass: posixAccount\n"
+        "\n"
+    )
+
+    def setUp(self):
+        self.mockldap = MockLdap(indexes=['uid'])
+
+    def tearDown(self):
+        self.mockldap.stop_all()
+
+    def test_load_ldif(self):
+        info = self.mockldap.load_ldif(StringIO(self.ldif))
+        self.mockldap.start()
+        ldapobj = self.mockldap['ldap://localhost']
+
+        self.assertEqual(info.entries, 3)
+        self.assertEqual(ldapobj.search_s('o=test', ldap.SCOPE_SUBTREE, '(uid=alice)'),
+                         [alice])
+        self.assertEqual(ldapobj.explain('o=test', ldap.SCOPE_SUBTREE, '(uid=alice)').splitlines()[1],
+                         '  index uid=alice (~1)')
+
+    def test_load_ldif_uri(self):
+        self.mockldap.load_ldif(StringIO(self.ldif), 'ldap://example/')
+        self.mockldap.start()
+
+        self.assertEqual(len(self.mockldap['ldap://example/'].directory), 3)
+        self.assertRaises(KeyError, lambda: self.mockldap['ldap://localhost'])
+
+    def test_load_ldif_invalid_dn(self):
+        with self.assertRaises(ldap.INVALID_DN_SYNTAX):
+            self.mockldap.load_ldif(StringIO("dn: cn=a+,o=test\nobjectClass: top\n\n"))
+
+    def test_load_ldif_duplicate_dn(self):
+        with self.assertRaises(ldap.ALREADY_EXISTS):
+            self.mockldap.load_ldif(StringIO(self.ldif + "dn: O=Test\nobjectClass: top\n\n"))
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.snapshot = StringIO()
+        MockLdap(directory, indexes=['uid']).save_snapshot(self.snapshot)
+        self.snapshot.seek(0)
+
+    def tearDown(self):
+        self.mockldap.stop_all()
+
+    def test_load_snapshot(self):
+        self.mockldap = MockLdap(indexes=['uid'])
+        info = self.mockldap.load_snapshot(self.snapshot)
+        self.mockldap.start()
+        ldapobj = self.mockldap['ldap://localhost']
+
+        self.assertEqual(info.entries, len(directory))
+        self.assertEqual(ldapobj.directory, directory)
+        self.assertEqual(sorted(ldapobj.search_s('o=test', ldap.SCOPE_ONELEVEL, '(objectClass=*)')),
+                         [example, other])
+        self.assertEqual(ldapobj.explain('o=test', ldap.SCOPE_SUBTREE, '(uid=alice)').splitlines()[1],
+                         '  index uid=alice (~1)')
+
+    def test_load_snapshot_new_index(self):
+        self.mockldap = MockLdap(indexes=['cn'])
+        self.mockldap.load_snapshot(self.snapshot)
+        self.mockldap.start()
+        ldapobj = self.mockldap['ldap://localhost']
+
+        self.assertEqual(ldapobj.explain('o=test', ldap.SCOPE_SUBTREE, '(cn=alice)').splitlines()[1],
+                         '  index cn=alice (~1)')
+        self.assertEqual(ldapobj.search_s('o=test', ldap.SCOPE_SUBTREE, '(uid=alice)'),
+                         [alice])
+
+    def test_load_snapshot_ordering_index(self):
+        snapshot = StringIO()
+        MockLdap(TestOrdering.people, ordering_indexes=['uidNumber']).save_snapshot(snapshot)
+        snapshot.seek(0)
+        self.mockldap = MockLdap(ordering_indexes=['uidNumber'])
+        self.mockldap.load_snapshot(snapshot)
+        self.mockldap.start()
+        ldapobj = self.mockldap['ldap://localhost']
+
+        self.assertEqual(ldapobj.explain('o=test', ldap.SCOPE_SUBTREE, '(uidNumber<=9)').splitlines()[1],
+                         '  index uidNumber<=9 (~2)')
+        self.assertEqual(len(ldapobj.search_s('o=test', ldap.SCOPE_SUBTREE, '(uidNumber<=9)')), 2)
+
+    def test_load_snapshot_matching_rules(self):
+        snapshot = StringIO()
+        MockLdap(directory, indexes=['uid'], matching_rules={'uid': CASE_IGNORE}).save_snapshot(snapshot)
+
+        for rules, expected in [({'uid': CASE_IGNORE}, [alice]), (None, [])]:
+            snapshot.seek(0)
+            self.mockldap = MockLdap(indexes=['uid'], matching_rules=rules)
+            self.mockldap.load_snapshot(snapshot)
+            self.mockldap.start()
+            ldapobj = self.mockldap['ldap://localhost']
+
+            self.assertEqual(ldapobj.search_s('o=test', ldap.SCOPE_SUBTREE, '(uid=ALICE)'), expected)
+            self.assertEqual(ldapobj.search_s('o=test', ldap.SCOPE_SUBTREE, '(!(!(uid=ALICE)))'),
+                             expected)
+            self.mockldap.stop_all()
+
+    def test_snapshot_independent(self):
+        self.mockldap = MockLdap()
+        self.mockldap.load_snapshot(self.snapshot)
+        self.mockldap.start()
+        ldapobj = self.mockldap['ldap://localhost']
+
+        ldapobj.delete_s(john[0])
+        ldapobj.modify_s(alice[0], [(ldap.MOD_REPLACE, 'uid', ['alice2'])])
+        self.snapshot.seek(0)
+        self.mockldap.stop_all()
+        self.mockldap.load_snapshot(self.snapshot)
+        self.mockldap.start()
+
+        self.assertEqual(self.mockldap['ldap://localhost'].directory, directory)
+
+    def test_bad_version(self):
+        self.mockldap = MockLdap()
+        snapshot = StringIO()
+        cPickle.dump((0, {}), snapshot)
+        snapshot.seek(0)
+
+        self.assertRaises(ValueError, self.mockldap.load_snapshot, snapshot)
+
+
+class TestMockLdap(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.mockldap = MockLdap(directory)
+
+    @classmethod
+    def tearDownClass(cls):
+        del cls.mockldap
+
+    def tearDown(self):
+        self.mockldap.stop_all()
+
+    def test_uninitialized(self):
+        self.assertRaises(KeyError, lambda: self.mockldap[''])
+
+    def test_duplicate_patch(self):
+        self.mockldap.start()
+
+        self.assertRaises(ValueError, lambda: self.mockldap.start())
+
+    def test_unbalanced_stop(self):
+        self.assertRaises(ValueError, lambda: self.mockldap.stop())
+
+    def test_stop_penultimate(self):
+        self.mockldap.start()
+        self.mockldap.start('mockldap.tests.initialize')
+        self.mockldap.stop()
+
+        self.assert_(self.mockldap[''] is not None)
+
+    def test_stop_last(self):
+        self.mockldap.start()
+        self.mockldap.start('mockldap.tests.initialize')
+        self.mockldap.stop()
+        self.mockldap.stop('mockldap.tests.initialize')
+
+        self.assertRaises(KeyError, lambda: self.mockldap[''])
+
+    def test_initialize(self):
+        self.mockldap.start()
+        conn = ldap.initialize('ldap:///')
+
+        self.assertEqual(conn.methods_called(), ['initialize'])
+
+    def test_specific_content(self):
+        tmp_directory = dict([alice, bob])
+        self.mockldap.set_directory(tmp_directory, uri='ldap://example.com/')
+        self.mockldap.start()
+        conn = ldap.initialize('ldap://example.com/')
+
+        self.assertEqual(conn.directory, tmp_directory)
+
+    def test_no_default(self):
+        mockldap = MockLdap()
+        mockldap.start()
+
+        self.assertRaises(KeyError, lambda: mockldap[''])
+
+    def test_indepdendent_connections(self):
+        self.mockldap.start()
+
+        self.assertNotEqual(self.mockldap['foo'], self.mockldap['bar'])
+
+    def test_volatile_modification(self):
+        self.mockldap.start()
+        conn1 = ldap.initialize('')
+        conn1.directory['cn=alice,ou=example,o=test'][
+            'userPassword'][0] = 'modified'
+        self.mockldap.stop()
+
+        self.mockldap.start()
+        conn2 = ldap.initialize('')
+        self.mockldap.stop()
+
+        self.assertNotEqual(conn1.directory, conn2.directory)
+
+    def test_volatile_fixture(self):
+        tmp_directory = dict([(alice[0], {'uid': ['alice']})])
+        self.mockldap.set_directory(tmp_directory, uri='ldap://example.com/')
+        tmp_directory[alice[0]]['uid'][0] = 'modified'
+        self.mockldap.start()
+        conn = ldap.initialize('ldap://example.com/')
+        conn.directory[alice[0]]['uid'].append('alice2')
+        self.mockldap.stop()
+
+        self.assertEqual(tmp_directory, {alice[0]: {'uid': ['modified']}})
+        self.assertEqual(conn.directory[alice[0]], {'uid': ['alice', 'alice2']})
+
+    def test_volatile_iteration(self):
+        self.mockldap.start()
+        conn1 = ldap.initialize('')
+        for dn, attrs in conn1.directory.iteritems():
+            attrs['modified'] = ['yes']
+        for attrs in conn1.directory.values():
+            attrs['objectClass'].append('modified')
+        self.mockldap.stop()
+
+        self.mockldap.start()
+        conn2 = ldap.initialize('')
+        self.mockldap.stop()
+
+        self.assertEqual(len(conn1.directory.values()), len(directory))
+        self.assertTrue(all(attrs['modified'] == ['yes'] for attrs in conn1.directory.values()))
+        self.assertFalse(any('modified' in attrs for attrs in conn2.directory.values()))
+        self.assertFalse(any('modified' in attrs['objectClass'] for attrs in directory.values()))
+
+    def test_volatile_add_and_delete(self):
+        self.mockldap.start()
+        conn1 = ldap.initialize('')
+        conn1.add_s('cn=mike,ou=example,o=test', [('objectClass', ['top'])])
+        conn1.delete_s(alice[0])
+        self.mockldap.stop()
+
+        self.mockldap.start()
+        conn2 = ldap.initialize('')
+        results = conn2.search_s('o=test', ldap.SCOPE_SUBTREE)
+        self.mockldap.stop()
+
+        self.assertEqual(sorted(results), sorted(directory.iteritems()))
+
+    def test_volatile_search_results(self):
+        self.mockldap.start()
+        conn1 = ldap.initialize('')
+        conn1.modify_s(alice[0], [(ldap.MOD_ADD, 'cn', 'alice2')])
+        self.mockldap.stop()
+
+        self.mockldap.start()
+        conn2 = ldap.initialize('')
+        results = conn2.search_s(alice[0], ldap.SCOPE_BASE)
+        self.mockldap.stop()
+
+        self.assertEqual(results, [alice])